@@ -21,6 +21,10 @@ import collections
 import os
 import time
 import sys
+import csv
+import cStringIO
+import hashlib
+import jsondiff
 
 class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 	protocol_version = 'HTTP/1.1' # Enable keep-alive
@@ -33,6 +37,9 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 		medusaserver.RequestHandler.__init__(self, conn, addr, server)
 		self.subscribed_to_changes = 0
 		self.subscribed_to_console = 0
+		self.export = None
+		self.held_changes = None
+		self.held_error = False
 		self.server.conns.append(self)
 
 	def done(self):
@@ -48,6 +55,9 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 					self.handle_sensorino_console_line)
 			self.subscribed_to_console = 0
 
+		self.export = None
+		self.held_changes = None
+
 	def handle_close(self):
 		self.done()
 
@@ -110,8 +120,8 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 		except:
 			raise Exception(400, e.args[0])
 
-	def post_get_json(self, limit):
-		self.check_ctype([ 'application/json' ])
+	def post_get_json(self, limit, ctypes=[ 'application/json' ]):
+		self.check_ctype(ctypes)
 
 		if self.body.length > limit:
 			raise Exception(413, 'JSON data too long')
@@ -123,6 +133,42 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 		chunk = chunk.encode('utf-8')
 		self.wfile.write(hex(len(chunk))[2:] + '\r\n' + chunk + '\r\n')
 
+	def writable(self):
+		return self.export is not None or \
+			self.held_changes is not None or \
+			medusaserver.RequestHandler.writable(self)
+
+	def handle_write(self):
+		medusaserver.RequestHandler.handle_write(self)
+
+		# Send the state changes coalesced while the client was
+		# too slow as one chunk once it has caught up
+		if self.held_changes is not None and \
+				not self.wfile.congested():
+			change_set = self.held_changes
+			error = self.held_error
+			self.held_changes = None
+			self.held_error = False
+			self.handle_sensorino_state_change(change_set, error)
+
+		if self.export is None:
+			return
+
+		# Only produce the next chunk once the previous one is out,
+		# so that a slow client doesn't make us buffer the export
+		if self.wfile.pending():
+			return
+
+		chunk = next(self.export, None)
+		if chunk is not None:
+			self.send_stream_chunk(chunk)
+			return
+
+		self.export = None
+		self.send_stream_chunk('')
+		self.streaming = 0
+		self.finish()
+
 	def stream_chromium_workaround(self):
 		ua = self.headers.getheader('user-agent', None)
 		if ua is None or 'WebKit' not in ua:
@@ -133,6 +179,16 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 		self.send_stream_chunk('\n' * 32768)
 
 	def handle_sensorino_state_change(self, change_set, error=False):
+		# While the client isn't reading fast enough only remember
+		# what changed, the current values are sent when it catches
+		# up, so the buffer stays bounded however busy the network
+		if self.held_changes is not None or self.wfile.congested():
+			if self.held_changes is None:
+				self.held_changes = set()
+			self.held_changes |= change_set
+			self.held_error = self.held_error or error
+			return
+
 		# Find out the minimum set of changes covering events
 		# in all the set.  Go through the list of events from
 		# shortest (most general) to longest, only add the event
@@ -181,6 +237,20 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 			self.handle_error()
 
 	def handle_sensorino_console_line(self, line):
+		# Console lines can't be merged, rather than buffer them
+		# without limit drop a client that doesn't keep up
+		if self.wfile.congested():
+			sensorino.log_warn(str(self.client_address) +
+					': Dropping slow console client, ' +
+					str(self.wfile.pending()) +
+					' bytes pending')
+			self.done()
+			try:
+				self.close()
+			except:
+				pass
+			return
+
 		json_str = json.dumps(line)
 
 		content = json_str + ','
@@ -278,6 +348,38 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 					raise
 				raise Exception(500, e.args[0])
 
+	def handle_api_console_search(self):
+		self.check_method([ 'GET' ])
+		self.check_params([ 'q', 'at0', 'ago0', 'at1', 'ago1',
+				'limit', 'cursor' ])
+		timestamp0 = self.parse_time_params('at0', 'ago0')
+		timestamp1 = self.parse_time_params('at1', 'ago1')
+		limit, cursor = self.parse_page_params()
+
+		# Any substring of the line, e.g. '"from": 10' or "err"
+		try:
+			text = self.params['q'].decode('utf-8')
+		except KeyError:
+			raise Exception(400, 'q= is required')
+		except UnicodeDecodeError:
+			raise Exception(400, 'Bad q= value')
+		if not text:
+			raise Exception(400, 'q= is required')
+
+		ret, next_cursor = self.server.storage.search_console(text,
+				timestamp0, timestamp1, limit, cursor)
+
+		content = json.dumps(ret).encode('utf-8')
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(content)))
+		if next_cursor is not None:
+			self.send_header("X-Next-Cursor", '%x.%x' % next_cursor)
+		self.end_headers()
+
+		self.wfile.write(content)
+
 	def handle_api_console_stream(self):
 		self.check_params([])
 		self.check_method([ 'GET' ])
@@ -303,6 +405,10 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 
 		self.stream_chromium_workaround()
 
+	def floorplan_etag(self):
+		data = jsondiff.canonical(self.server.floorplan)
+		return '"' + hashlib.sha1(data.encode('utf-8')).hexdigest() + '"'
+
 	def handle_api_floorplan(self):
 		self.check_method([ 'GET', 'POST' ])
 
@@ -317,12 +423,16 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 					get_floorplan_at_timestamp(timestamp)
 				if ret is None:
 					ret = []
+				else:
+					ret = json.loads(ret)
 
 			content = json.dumps(ret).encode('utf-8')
 
 			self.send_response(200)
 			self.send_header("Content-Type", "application/json")
 			self.send_header("Content-Length", str(len(content)))
+			if timestamp is None:
+				self.send_header("ETag", self.floorplan_etag())
 			self.end_headers()
 
 			self.wfile.write(content)
@@ -332,53 +442,118 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 		if self.command == 'POST':
 			self.check_params([])
 
-			content = self.post_get_json(128 * 1024)
+			# Either the whole new floorplan or a JSON Patch
+			# (RFC 6902) against the current one.  With
+			# If-Match set to the ETag of the version the
+			# client has, the save fails if someone else has
+			# changed the floorplan since.
+			content = self.post_get_json(128 * 1024,
+					[ 'application/json',
+						'application/json-patch+json' ])
 			obj = None
 			timestamp = time.time()
 
+			etag = self.headers.getheader('if-match', None)
+			if etag is not None and etag != '*' and \
+					etag != self.floorplan_etag():
+				raise Exception(412, 'Floorplan has changed')
+
 			# Try to ensure nothing is saved when either
 			# parsing or the database return an error
 			try:
 				obj = json.loads(content)
 			except Exception as e:
 				raise Exception(400, 'Bad JSON: ' + e.args[0])
+			if self.body.type == 'application/json-patch+json':
+				try:
+					obj = jsondiff.apply(
+						self.server.floorplan, obj)
+				except ValueError as e:
+					raise Exception(409, 'Patch doesn\'t ' +
+							'apply: ' + e.args[0])
+				content = json.dumps(obj)
+			# Flushed right away so that a database error
+			# is reported here rather than by a later flush
+			storage = self.server.storage
 			try:
-				self.server.storage.save_floorplan_version(
-						timestamp, content)
-				self.server.storage.commit()
+				storage.save_floorplan_version(timestamp,
+						content)
+				storage.flush()
 				self.server.floorplan = obj
 			except Exception as e:
-				raise Exception(400, 'DB error: ' + e.args[0])
+				storage.discard_floorplan_version(timestamp,
+						content)
+				raise Exception(400, 'DB error: ' + str(e))
 
 			self.send_response(200)
 			self.send_header("Content-Type", "application/json")
 			self.send_header("Content-Length", '2')
+			self.send_header("ETag", self.floorplan_etag())
 			self.end_headers()
 
 			self.wfile.write('{}')
 
 			return
 
+	def handle_api_floorplan_diff(self):
+		self.check_method([ 'GET' ])
+		self.check_params([ 'at0', 'ago0', 'at1', 'ago1' ])
+		timestamp0 = self.parse_time_params('at0', 'ago0')
+		timestamp1 = self.parse_time_params('at1', 'ago1')
+		if timestamp0 is None:
+			raise Exception(400, 'at0= or ago0= is required')
+
+		# The JSON Patch that turns the version at timestamp0 into
+		# the one at timestamp1, or the current one
+		versions = []
+		for timestamp in [ timestamp0, timestamp1 ]:
+			if timestamp is None:
+				versions.append(self.server.floorplan)
+				continue
+
+			data = self.server.storage. \
+				get_floorplan_at_timestamp(timestamp)
+			versions.append([] if data is None else json.loads(data))
+
+		content = json.dumps(jsondiff.diff(*versions)).encode('utf-8')
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json-patch+json")
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+
+		self.wfile.write(content)
+
 	def handle_api_value(self, path):
 		self.check_method([ 'GET' ]) # TODO: POST
 
-		self.check_params([ 'at', 'ago', 'at0', 'ago0', 'at1', 'ago1' ])
+		self.check_params([ 'at', 'ago', 'at0', 'ago0', 'at1', 'ago1',
+				'resolution', 'limit', 'cursor' ])
 		timestamp = self.parse_time_params()
 		timestamp0 = self.parse_time_params('at0', 'ago0')
 		timestamp1 = self.parse_time_params('at1', 'ago1')
 
-		try:
-			node_addr, svc_id, typ, chan_id = path
-			svc_id = int(svc_id)
-			chan_id = int(chan_id)
-			if typ in sensorino.known_datatypes_dict:
-				typ = sensorino.datatype_to_name(typ)
-		except:
-			raise Exception(404, 'Bad channel address')
-		try:
-			node_addr = int(node_addr)
-		except:
-			pass
+		# Either 'raw' for the individual values, one of the rollup
+		# period names for aggregates, or 'auto' to pick the finest
+		# one that fits in a single response
+		periods = dict(self.server.storage.rollup_periods)
+		resolution = self.params.get('resolution', 'raw')
+		if resolution not in [ 'raw', 'auto' ] + periods.keys():
+			raise Exception(400, 'Unknown resolution')
+		if resolution != 'raw' and timestamp0 is None:
+			raise Exception(400, 'resolution= requires at0= or ago0=')
+
+		# With limit= or cursor= the period is returned in pages
+		# in ascending order, otherwise only the newest values fit
+		paged = 'limit' in self.params or 'cursor' in self.params
+		if paged and timestamp0 is None:
+			raise Exception(400, 'limit= and cursor= require ' +
+					'at0= or ago0=')
+		if paged:
+			limit, cursor = self.parse_page_params()
+		next_cursor = None
+
+		node_addr, svc_id, typ, chan_id = self.parse_value_path(path)
 
 		if timestamp is None and timestamp0 is None:
 			tree = self.server.state.get_state_tree()
@@ -397,11 +572,32 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 			if timestamp1 is None:
 				timestamp1 = time.time()
 
+			if resolution == 'auto':
+				resolution = self.pick_resolution(path,
+						timestamp0, timestamp1)
+
 			# First load the value at the start of the period
 			val0 = self.server.storage.get_value_at_timestamp( \
 					path, timestamp0)
-			vals = self.server.storage.get_values_within_period( \
-					path, timestamp0, timestamp1)
+			if paged and resolution == 'raw':
+				vals, next_cursor = self.server.storage. \
+					get_values_page(path, timestamp0,
+						timestamp1, limit, cursor)
+			elif paged:
+				vals, next_cursor = self.server.storage. \
+					get_rollups_page(path, timestamp0,
+						timestamp1,
+						periods[resolution],
+						limit, cursor)
+			elif resolution == 'raw':
+				vals = self.server.storage. \
+					get_values_within_period(path,
+						timestamp0, timestamp1)
+			else:
+				vals = self.server.storage. \
+					get_rollups_within_period(path,
+						timestamp0, timestamp1,
+						periods[resolution])
 			if val0 is None and not vals:
 				raise Exception(404, 'No such channel')
 
@@ -412,12 +608,256 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 		self.send_response(200)
 		self.send_header("Content-Type", "application/json")
 		self.send_header("Content-Length", str(len(content)))
+		if next_cursor is not None:
+			self.send_header("X-Next-Cursor", '%x.%x' % next_cursor)
 		self.end_headers()
 
 		self.wfile.write(content)
 
 		return
 
+	def handle_api_values(self):
+		self.check_method([ 'GET' ])
+		self.check_params([ 'channels', 'at0', 'ago0', 'at1', 'ago1',
+				'resolution' ])
+		timestamp0 = self.parse_time_params('at0', 'ago0')
+		timestamp1 = self.parse_time_params('at1', 'ago1')
+		if timestamp0 is None:
+			raise Exception(400, 'at0= or ago0= required')
+		if timestamp1 is None:
+			timestamp1 = time.time()
+
+		# Comma-separated node/service/type/channel paths, the
+		# response has the value.json result for each, in the same
+		# order, or null where value.json would give a 404
+		if 'channels' not in self.params:
+			raise Exception(400, 'channels= required')
+		paths = [ self.parse_value_path(path.split('/'))
+			for path in self.params['channels'].split(',') ]
+		if len(paths) > self.server.storage.max_series:
+			raise Exception(400, 'At most ' +
+					str(self.server.storage.max_series) +
+					' channels allowed')
+
+		periods = dict(self.server.storage.rollup_periods)
+		resolution = self.params.get('resolution', 'raw')
+		if resolution not in [ 'raw' ] + periods.keys():
+			raise Exception(400, 'Unknown resolution')
+
+		series = self.server.storage.get_series_within_period(paths,
+				timestamp0, timestamp1, periods.get(resolution))
+		ret = [ None if s is None else [ s[0] ] + s[1] for s in series ]
+
+		content = json.dumps(ret).encode('utf-8')
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+
+		self.wfile.write(content)
+
+	def handle_api_activity(self):
+		self.check_method([ 'GET' ])
+		self.check_params([ 'node', 'channels', 'at0', 'ago0', 'at1',
+				'ago1', 'buckets' ])
+		timestamp0 = self.parse_time_params('at0', 'ago0')
+		timestamp1 = self.parse_time_params('at1', 'ago1')
+		if timestamp0 is None:
+			raise Exception(400, 'at0= or ago0= required')
+		if timestamp1 is None:
+			timestamp1 = time.time()
+		if timestamp1 <= timestamp0:
+			raise Exception(400, 'Empty time range')
+
+		max_buckets = self.server.storage.max_values
+		try:
+			buckets = int(self.params.get('buckets', 100))
+		except:
+			raise Exception(400, 'Bad buckets= value')
+		if buckets < 1 or buckets > max_buckets:
+			raise Exception(400, 'buckets= must be between 1 and ' +
+					str(max_buckets))
+
+		# Only count the values of one node's channels and/or of the
+		# comma-separated node/service/type/channel paths given,
+		# all channels by default
+		paths = None
+		if 'node' in self.params or 'channels' in self.params:
+			paths = []
+		if 'node' in self.params:
+			node_addr = self.params['node']
+			try:
+				node_addr = int(node_addr)
+			except:
+				pass
+			paths.append([ node_addr ])
+		if 'channels' in self.params:
+			paths += [ self.parse_value_path(path.split('/'))
+				for path in self.params['channels'].split(',') ]
+
+		counts = self.server.storage.get_event_counts(paths,
+				timestamp0, timestamp1, buckets)
+		ret = {
+			'at0': timestamp0,
+			'at1': timestamp1,
+			'counts': counts,
+		}
+
+		content = json.dumps(ret).encode('utf-8')
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+
+		self.wfile.write(content)
+
+	def handle_api_connections(self):
+		self.check_method([ 'GET' ])
+		self.check_params([])
+
+		# How much each connection has waiting to be sent, to spot
+		# slow clients and Bases
+		ret = {
+			'http': [ {
+				'client': conn.client_address[0] + ':' +
+					str(conn.client_address[1]),
+				'path': getattr(conn, 'path', None),
+				'pending': conn.pending(),
+				'congested': bool(getattr(conn.wfile, 'held', 0)),
+			} for conn in self.server.conns if conn is not self ],
+			'bases': [ {
+				'name': name,
+				'client': base.client_address[0] + ':' +
+					str(base.client_address[1]),
+				'pending': base.pending(),
+				'congested': bool(base.held),
+			} for name, base in self.server.bases.items() ],
+		}
+
+		content = json.dumps(ret).encode('utf-8')
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+
+		self.wfile.write(content)
+
+	def parse_value_path(self, path):
+		try:
+			node_addr, svc_id, typ, chan_id = path
+			svc_id = int(svc_id)
+			chan_id = int(chan_id)
+			if typ in sensorino.known_datatypes_dict:
+				typ = sensorino.datatype_to_name(typ)
+		except:
+			raise Exception(404, 'Bad channel address')
+		try:
+			node_addr = int(node_addr)
+		except:
+			pass
+
+		return [ node_addr, svc_id, typ, chan_id ]
+
+	# The export is sent in chunks of about this size
+	export_chunk_size = 16 * 1024
+
+	export_ctypes = {
+		'ndjson': 'application/x-ndjson',
+		'csv': 'text/csv',
+	}
+
+	def handle_api_export(self, fmt):
+		self.check_method([ 'GET' ])
+		self.check_params([ 'channels', 'at0', 'ago0', 'at1', 'ago1' ])
+		timestamp0 = self.parse_time_params('at0', 'ago0')
+		timestamp1 = self.parse_time_params('at1', 'ago1')
+
+		# Comma-separated node/service/type/channel paths, all
+		# channels by default
+		paths = None
+		if 'channels' in self.params:
+			paths = [ self.parse_value_path(path.split('/'))
+				for path in self.params['channels'].split(',') ]
+
+		rows = self.server.storage.export_values(paths,
+				timestamp0, timestamp1)
+
+		self.send_response(200)
+		self.send_header("Content-Type", self.export_ctypes[fmt])
+		self.send_header("Transfer-Encoding", "chunked")
+		self.end_headers()
+
+		# The rows are read and sent from handle_write() as the
+		# client takes them
+		self.export = self.export_chunks(rows, fmt)
+		self.streaming = 1
+
+	def export_chunks(self, rows, fmt):
+		def cell(obj):
+			if isinstance(obj, unicode):
+				return obj.encode('utf-8')
+			return obj
+
+		out = cStringIO.StringIO()
+		writer = csv.writer(out, lineterminator='\n')
+		if fmt == 'csv':
+			writer.writerow([ 'timestamp', 'node', 'service',
+				'type', 'channel', 'value' ])
+
+		for timestamp, path, value in rows:
+			if fmt == 'csv':
+				if not isinstance(value, basestring):
+					value = json.dumps(value)
+				writer.writerow([ '%.3f' % timestamp ] +
+					[ cell(obj) for obj in path +
+						[ None ] * (4 - len(path)) +
+						[ value ] ])
+			else:
+				out.write(json.dumps([ timestamp, path,
+					value ]) + '\n')
+
+			if out.tell() >= self.export_chunk_size:
+				yield out.getvalue().decode('utf-8')
+				out = cStringIO.StringIO()
+				writer = csv.writer(out, lineterminator='\n')
+
+		if out.tell():
+			yield out.getvalue().decode('utf-8')
+
+	def parse_page_params(self):
+		max_limit = self.server.storage.max_values
+
+		try:
+			limit = int(self.params.get('limit', max_limit))
+
+			cursor = None
+			if 'cursor' in self.params:
+				ts, rowid = self.params['cursor'].split('.')
+				cursor = ( int(ts, 16), int(rowid, 16) )
+		except:
+			raise Exception(400, 'Bad limit= or cursor= value')
+
+		if limit < 1 or limit > max_limit:
+			raise Exception(400, 'limit= must be between 1 and ' +
+					str(max_limit))
+
+		return limit, cursor
+
+	def pick_resolution(self, path, t0, t1):
+		storage = self.server.storage
+
+		if storage.estimate_value_count(path, t0, t1) <= \
+				storage.max_values:
+			return 'raw'
+
+		for name, period in storage.rollup_periods:
+			if (t1 - t0) / period <= storage.max_values:
+				return name
+		return name
+
 	def handle_data(self):
 		# Translate path
 		path = self.path.split('#', 1)[0]
@@ -445,10 +885,24 @@ class sensorino_httpd_request_handler(medusaserver.RequestHandler):
 				self.handle_api_sensorino_stream()
 			elif path == '/api/console.json':
 				self.handle_api_console()
+			elif path == '/api/console/search.json':
+				self.handle_api_console_search()
 			elif path == '/api/stream/console.json':
 				self.handle_api_console_stream()
 			elif path == '/api/floorplan.json':
 				self.handle_api_floorplan()
+			elif path == '/api/floorplan/diff.json':
+				self.handle_api_floorplan_diff()
+			elif path == '/api/values.json':
+				self.handle_api_values()
+			elif path == '/api/activity.json':
+				self.handle_api_activity()
+			elif path == '/api/connections.json':
+				self.handle_api_connections()
+			elif path == '/api/export.ndjson':
+				self.handle_api_export('ndjson')
+			elif path == '/api/export.csv':
+				self.handle_api_export('csv')
 			elif len(splitpath) == 6 and splitpath[0] == 'api' and \
 					splitpath[5] == 'value.json':
 				self.handle_api_value(splitpath[1:5])
@@ -472,6 +926,9 @@ class sensorino_httpd_server(medusaserver.Server):
 
 		self.conns = []
 
+		# The Base server's connections by Base name, if any
+		self.bases = {}
+
 		self.user_req_handlers = []
 
 		self.static_root = os.getcwd() + '/static'
@@ -229,14 +229,27 @@ def base_add_node(node):
 base_addr = 0
 
 def base_send_obj(obj):
-	global s
-	for field in obj:
-		if isinstance(obj[field], basestring) or not \
-				isinstance(obj[field], collections.Sequence):
-			continue
-		if len(obj[field]) == 1:
-			obj[field] = obj[field][0]
-	s.send(json.dumps(obj).encode('utf8'))
+	base_send_objs([ obj ])
+
+def base_send_objs(objs):
+	'''Send several messages at once, in a single frame if the
+	server has agreed to framing.'''
+
+	global s, framing
+	for obj in objs:
+		for field in obj:
+			if isinstance(obj[field], basestring) or not \
+					isinstance(obj[field],
+						collections.Sequence):
+				continue
+			if len(obj[field]) == 1:
+				obj[field] = obj[field][0]
+
+	if framing is None:
+		s.send(''.join([ json.dumps(obj).encode('utf8')
+			for obj in objs ]))
+	else:
+		s.send(base_server.pack_frame(framing, objs))
 
 def base_handle_set(node, svc, msg):
 	channels = {}
@@ -334,9 +347,11 @@ def base_handle_request(node, svc, msg):
 def base_handle_input(msg):
 	global nodes, svc_manager_svcs
 
-	# Check message parses as JSON
+	# Check message parses as JSON, unless it came in a frame
 	try:
-		obj = sensorino.message_dict(json.loads(msg))
+		if isinstance(msg, basestring):
+			msg = json.loads(msg)
+		obj = sensorino.message_dict(msg)
 	except:
 		base_send_obj({ 'error': 'syntaxError' })
 		return
@@ -417,21 +432,33 @@ def base_handle_input(msg):
 s = None
 parse_state = None
 
-def base_init(base_name):
-	global s, parse_state
+# The frame format in use, see base_server.py, or None until the
+# server has agreed to one
+framing = None
+framing_asked = False
+
+def base_init(base_name, frame_formats=base_server.frame_formats):
+	global s, parse_state, framing, framing_asked
 	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 	s.connect(config.base_server_address)
 
-	# Introduce ourselves
-	base_send_obj({ 'base-name': base_name })
+	# Introduce ourselves.  Plain JSON is used until the server
+	# replies, servers that don't support framing never do.
+	framing = None
+	framing_asked = bool(frame_formats)
+	hs = { 'base-name': base_name }
+	if frame_formats:
+		hs['framing'] = list(frame_formats)
+	base_send_obj(hs)
 
 	parse_state = base_server.obj_parser()
+	parse_state.one_obj = framing_asked
 
 class BaseDisconnect(Exception):
 	pass
 
 def base_run(timeout):
-	global s, parse_state
+	global s, parse_state, framing, framing_asked
 
 	r, w, e = select.select([ s ], [], [ s ], timeout)
 	if e:
@@ -442,10 +469,24 @@ def base_run(timeout):
 	d = s.recv(8192)
 	if not d:
 		raise BaseDisconnect()
-	for chr in d.decode('utf-8'):
-		obj = parse_state.handle_char(chr)
-		if obj is not None:
-			base_handle_input(obj)
+	objs = parse_state.handle_data(d)
+	if framing_asked and objs:
+		# The server's first message, the reply to the handshake
+		# if it supports framing.  The parser stops after it as
+		# the rest of the chunk may already be framed.
+		framing_asked = False
+		try:
+			reply = json.loads(objs[0])
+		except:
+			reply = None
+		if isinstance(reply, dict) and reply.keys() == [ 'framing' ]:
+			framing = reply['framing']
+			parse_state.frame_format = framing
+			objs = objs[1:]
+		objs += parse_state.handle_data('')
+
+	for obj in objs:
+		base_handle_input(obj)
 
 def base_done():
 	global s
@@ -6,31 +6,195 @@
 #
 # Classes that manage communication with Base nodes.
 #
+# A Base sends a stream of JSON objects, the first one being the
+# {"base-name": ...} handshake.  A Base that also lists the frame
+# formats it supports, as in {"base-name": ..., "framing": [ "json",
+# "msgpack" ]}, gets a {"framing": <format or null>} reply and from
+# then on everything the server sends it is framed.  Once it has the
+# reply, the Base frames what it sends too.  A frame is a 0xff byte,
+# the payload length as a 32-bit big-endian integer and the payload,
+# one or more messages as a JSON array or as MessagePack values one
+# after another.  0xff never appears in UTF-8 text so frames and
+# plain JSON can be told apart anywhere in the stream.
+#
 
 import sensorino
+import timers
 import sys
 import socket
 import asyncore
 import json
+import re
+import struct
+import valuepack
+
+# The rest of a JSON string: everything up to the closing quote, which
+# is group 1, or to the end of the data.  Group 2 is a backslash
+# at the end of the data, escaping whatever comes first in the next
+# chunk.
+string_end = r'[^"\\]*(?:\\.[^"\\]*)*(?:(")|(\\)?\Z)'
+string_end_re = re.compile(string_end, re.S)
+# Outside of strings only the brackets and the opening quotes matter,
+# everything else is skipped by the regex engine
+token_re = re.compile(r'[][{}()]|"' + string_end, re.S)
+
+# Frame payload formats, in the order of preference.  The json module
+# decodes in C, faster than valuepack does in Python.
+frame_formats = [ 'json', 'msgpack' ]
+
+frame_header = struct.Struct('>BI')
+frame_marker = '\xff'
+
+# Frames longer than this are a protocol error
+max_frame = 1024 * 1024
+
+def pack_frame(fmt, objs):
+	'''Return the frame carrying the list of objects.'''
+
+	if fmt == 'json':
+		payload = json.dumps(objs).encode('utf-8')
+	else:
+		payload = ''.join([ valuepack.pack(obj) for obj in objs ])
+	return frame_header.pack(0xff, len(payload)) + payload
+
+def unpack_frame(fmt, payload):
+	'''Return the list of the objects in the frame payload.'''
+
+	if fmt == 'json':
+		objs = json.loads(payload.decode('utf-8'))
+		if not isinstance(objs, list):
+			raise ValueError('Frame payload not a JSON array')
+		return objs
+	return valuepack.unpack_list(payload)
+
+def negotiate_framing(formats):
+	'''Return the frame format to use given the "framing" value of a
+	Base's handshake, or None.'''
+
+	if not isinstance(formats, list):
+		formats = [ formats ]
+	for name in frame_formats:
+		if name in formats:
+			return name
+	return None
 
 class obj_parser():
+	'''Splits the stream of JSON objects sent by a Base into the
+	separate objects.  The data is scanned for the brackets and
+	strings a chunk at a time, the parts of an object not yet
+	complete are kept as a list of slices.  Once frame_format is
+	set, frames are accepted too, see the top of the file.'''
+
 	def __init__(self):
-		self.obj_buffer = ''
+		self.obj_parts = []
 		self.nest_depth = 0
 		self.quote = 0
 		self.escape = 0
 
-	def handle_char(self, ch):
-		self.obj_buffer += ch
+		self.frame_format = None
+		self.frame_parts = None
+		self.frame_left = 0
+
+		# While set, plain JSON parsing stops after one object and
+		# the rest of the data is kept for the next handle_data()
+		# call, so frame_format can be set in between
+		self.one_obj = False
+		self.unparsed = ''
+
+	def handle_data(self, data):
+		'''Return the list of the objects completed by data, the raw
+		bytes received.  JSON text objects are returned as unicode
+		strings, the objects from frames already decoded.'''
+
+		if self.unparsed:
+			data = self.unparsed + data
+			self.unparsed = ''
+
+		if self.frame_format is None:
+			return self.scan_json(data)
+
+		objs = []
+		pos = 0
+		while pos < len(data):
+			if self.frame_parts is not None:
+				# Rest of a frame started in an earlier chunk
+				pos = self.add_frame_part(data, pos, objs)
+			elif data[pos] != frame_marker:
+				# Plain JSON up to the next frame
+				end = data.find(frame_marker, pos)
+				if end < 0:
+					end = len(data)
+				objs += self.scan_json(data[pos:end])
+				pos = end
+			else:
+				# Usually the whole frame is in this chunk
+				end = pos + frame_header.size
+				if end <= len(data):
+					size = frame_header.unpack_from(data,
+							pos)[1]
+					if size > max_frame:
+						raise ValueError('Frame too long')
+					if end + size <= len(data):
+						objs += unpack_frame(
+							self.frame_format,
+							data[end:end + size])
+						pos = end + size
+						continue
+
+				self.frame_parts = []
+				self.frame_left = frame_header.size
+				pos = self.add_frame_part(data, pos, objs)
+
+		return objs
+
+	def add_frame_part(self, data, pos, objs):
+		chunk = data[pos:pos + self.frame_left]
+		self.frame_parts.append(chunk)
+		self.frame_left -= len(chunk)
+		pos += len(chunk)
+		if self.frame_left:
+			return pos
 
-		if self.quote and not self.escape and ch == '\\':
-			self.escape = 1
-		elif not self.escape and ch == '"':
-			self.quote = not self.quote
-		elif not self.quote:
-			if ch in '{[(':
+		frame = ''.join(self.frame_parts)
+		if len(frame) == frame_header.size:
+			# Header complete, now the payload
+			self.frame_left = frame_header.unpack(frame)[1]
+			if self.frame_left > max_frame:
+				raise ValueError('Frame too long')
+			self.frame_parts = [ frame ]
+			if self.frame_left:
+				return pos
+
+		self.frame_parts = None
+		objs += unpack_frame(self.frame_format,
+				frame[frame_header.size:])
+		return pos
+
+	def scan_json(self, data):
+		objs = []
+		start = 0
+		pos = 0
+
+		# Finish a string left open by the previous chunk
+		if self.quote and data:
+			if self.escape:
+				pos = 1
+				self.escape = 0
+			m = string_end_re.match(data, pos)
+			pos = m.end()
+			self.quote = m.group(1) is None
+			self.escape = m.group(2) is not None
+
+		for m in token_re.finditer(data, pos):
+			ch = m.group()[0]
+
+			if ch == '"':
+				# Only the last string can be left open
+				self.quote = m.group(1) is None
+				self.escape = m.group(2) is not None
+			elif ch in '{[(':
 				self.nest_depth += 1
-			elif ch in '}])':
+			else:
 				self.nest_depth -= 1
 
 				if self.nest_depth <= 0:
@@ -41,15 +205,30 @@ class obj_parser():
 					# regardless of what Base we are, i.e.
 					# messages from all the Bases will
 					# reach the server all mixed-up.
-					ret = self.obj_buffer
+					self.obj_parts.append(data[start:m.end()])
+					objs.append(''.join(self.obj_parts).
+							decode('utf-8'))
 
-					self.obj_buffer = ''
+					self.obj_parts = []
 					self.nest_depth = 0
+					start = m.end()
 
-					return ret
-		return None
+					if self.one_obj:
+						self.one_obj = False
+						self.unparsed = data[start:]
+						return objs
+
+		if start < len(data):
+			self.obj_parts.append(data[start:])
+
+		return objs
 
 class sensorino_base_handler(asyncore.dispatcher_with_send):
+	# A Base that stops reading gets no more requests once it has
+	# high_water bytes queued, until they're down to low_water
+	high_water = 64 * 1024
+	low_water = 16 * 1024
+
 	def __init__(self, sock, addr, server):
 		asyncore.dispatcher_with_send.__init__(self, sock)
 
@@ -58,6 +237,21 @@ class sensorino_base_handler(asyncore.dispatcher_with_send):
 		self.name = None
 
 		self.parser = obj_parser()
+		self.framing = None
+		self.held = 0
+
+		if server.pool is not None:
+			server.pool.attach(self)
+
+	def pending(self):
+		return len(self.out_buffer)
+
+	def congested(self):
+		if self.pending() > self.high_water:
+			self.held = 1
+		elif self.pending() <= self.low_water:
+			self.held = 0
+		return self.held
 
 	def handshake(self, obj):
 		try:
@@ -80,7 +274,18 @@ class sensorino_base_handler(asyncore.dispatcher_with_send):
 		sensorino.log_warn(str(self.client_address) +
 				': New Base connected')
 
+		# Bases that don't ask for framing don't get a reply
+		if 'framing' in hs:
+			fmt = negotiate_framing(hs['framing'])
+
+			self.send_json(json.dumps({ 'framing': fmt }))
+			self.framing = fmt
+			self.parser.frame_format = fmt
+
 	def done(self):
+		if self.server.pool is not None:
+			self.server.pool.detach(self)
+
 		if self.name is None:
 			return
 
@@ -106,19 +311,50 @@ class sensorino_base_handler(asyncore.dispatcher_with_send):
 		except:
 			pass
 
+	def initiate_send(self):
+		asyncore.dispatcher_with_send.initiate_send(self)
+		# Wait for the socket to take the rest
+		if self.out_buffer:
+			timers.changed(self)
+
+	def readable(self):
+		# Stop reading while the workers are behind, the pool
+		# tells timers when that changes
+		return self.server.pool is None or \
+			not self.server.pool.congested()
+
 	def handle_read(self):
-		for chr in self.recv(8192).decode('utf-8'):
-			obj = self.parser.handle_char(chr)
-			if obj is not None:
-				if self.name is None:
-					# This is the handshake message
-					self.handshake(obj)
-					continue
+		if self.server.pool is not None:
+			# Parsed in a worker, comes back through
+			# handshake() and server.handle_obj()
+			data = self.recv(8192)
+			if data:
+				self.server.pool.feed(self, data)
+			return
+
+		for obj in self.parser.handle_data(self.recv(8192)):
+			if self.name is None:
+				# This is the handshake message
+				self.handshake(obj)
+				continue
 
-				self.server.handle_obj(obj, self)
+			self.server.handle_obj(obj, self)
 
 	def send_json(self, buffer):
-		self.send(buffer.encode('utf-8'))
+		if self.congested():
+			raise Exception('Send queue full, ' +
+					str(self.pending()) + ' bytes pending')
+
+		if self.framing is None:
+			self.send(buffer.encode('utf-8'))
+		elif self.framing == 'json':
+			# Already the JSON text of the payload's one element
+			payload = ('[' + buffer + ']').encode('utf-8')
+			self.send(frame_header.pack(0xff, len(payload)) +
+					payload)
+		else:
+			self.send(pack_frame(self.framing,
+				[ json.loads(buffer) ]))
 
 class sensorino_base_server(asyncore.dispatcher):
 	# All boilerplate here
@@ -132,6 +368,10 @@ class sensorino_base_server(asyncore.dispatcher):
 		self.bases = {}
 		self.obj_handlers = []
 
+		# An ingest.pool if the Bases' messages are parsed in
+		# worker processes
+		self.pool = None
+
 	def handle_accept(self):
 		pair = self.accept()
 		if pair is None:
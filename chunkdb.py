@@ -0,0 +1,548 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Compressed history storage: instead of one row per value, the values
+# of each channel are packed into blocks covering up to an hour each,
+# using a byte-aligned variant of the Gorilla encoding (Pelkonen et al.,
+# "Gorilla: A Fast, Scalable, In-Memory Time Series Database") --
+# timestamps as delta-of-deltas, floats as the XOR with the previous
+# value.  Everything except the history is kept as in db.connection.
+#
+import os
+import struct
+import json
+import time
+import sqlite3
+import db
+
+# The queries on the chunks table, as in db.py.  find_blocks_sql is
+# completed by one of the conditions.
+find_blocks_sql = 'SELECT start, rowid FROM chunks WHERE '
+chan_blocks_cond = 'chan = ? AND start >= ? AND start < ?'
+last_block_cond = 'chan = ? AND start <= ? ORDER BY start DESC LIMIT 2'
+overlapping_blocks_cond = 'chan = ? AND start >= ? AND start < ? ' + \
+	'AND stop >= ?'
+blocks_within_cond = 'start >= ? AND start < ?'
+block_counts_sql = 'SELECT start, stop, count, rowid FROM chunks ' + \
+	'WHERE start >= ? AND start < ?'
+load_block_sql = 'SELECT chan, start, kind, count, data FROM chunks ' + \
+	'WHERE rowid = ?'
+
+pack_q = struct.Struct('>Q').pack
+unpack_q = struct.Struct('>Q').unpack
+pack_d = struct.Struct('>d').pack
+unpack_d = struct.Struct('>d').unpack
+
+def write_varint(out, n):
+	# Zig-zag so that small negative numbers stay short
+	n = (n << 1) if n >= 0 else ((-n << 1) - 1)
+	while n >= 0x80:
+		out.append(chr(0x80 | (n & 0x7f)))
+		n >>= 7
+	out.append(chr(n))
+
+def read_varint(data, pos):
+	n = 0
+	shift = 0
+	while True:
+		b = ord(data[pos])
+		pos += 1
+		n |= (b & 0x7f) << shift
+		shift += 7
+		if b < 0x80:
+			break
+	return ( (n >> 1) if not n & 1 else -((n + 1) >> 1) ), pos
+
+def value_kind(value):
+	if isinstance(value, float):
+		return 'f'
+	if db.is_numeric(value) and -(1 << 62) < value < (1 << 62):
+		return 'i'
+	return 'j'
+
+def encode_block(kind, timestamps, values):
+	'''Return the packed form of a block.  The first timestamp is
+	not included, it is stored separately as the block's start.'''
+
+	out = []
+	prev_ts = timestamps[0]
+	prev_delta = 0
+	prev = 0
+	for i, ( timestamp, value ) in enumerate(zip(timestamps, values)):
+		if i:
+			delta = timestamp - prev_ts
+			write_varint(out, delta - prev_delta)
+			prev_ts = timestamp
+			prev_delta = delta
+
+		if kind == 'f':
+			bits = unpack_q(pack_d(value))[0]
+			xor = bits ^ prev
+			prev = bits
+			if not xor:
+				out.append('\x00')
+				continue
+			raw = pack_q(xor)
+			lead = 8 - len(raw.lstrip('\x00'))
+			trail = 8 - len(raw.rstrip('\x00'))
+			out.append(chr(0x80 | (lead << 3) | trail) +
+					raw[lead:8 - trail])
+		elif kind == 'i':
+			write_varint(out, value - prev)
+			prev = value
+		else:
+			raw = json.dumps(value)
+			write_varint(out, len(raw))
+			out.append(raw)
+
+	return ''.join(out)
+
+def decode_block(start, kind, count, data):
+	'''Return the lists of timestamps and values in a block.'''
+
+	data = str(data)
+	timestamps = []
+	values = []
+	pos = 0
+	timestamp = start
+	delta = 0
+	prev = 0
+	value = None
+	for i in xrange(count):
+		if i:
+			# Fast path for the common one-byte case
+			b = ord(data[pos])
+			if b < 0x80:
+				pos += 1
+				delta += (b >> 1) ^ -(b & 1)
+			else:
+				dod, pos = read_varint(data, pos)
+				delta += dod
+			timestamp += delta
+		timestamps.append(timestamp)
+
+		if kind == 'f':
+			h = ord(data[pos])
+			pos += 1
+			if h:
+				lead = (h >> 3) & 7
+				n = 8 - lead - (h & 7)
+				prev ^= unpack_q('\x00' * lead +
+						data[pos:pos + n] +
+						'\x00' * (h & 7))[0]
+				pos += n
+			# A block can start with 0.0, all bits unchanged
+			if h or value is None:
+				value = unpack_d(pack_q(prev))[0]
+			values.append(value)
+		elif kind == 'i':
+			diff, pos = read_varint(data, pos)
+			prev += diff
+			values.append(prev)
+		else:
+			n, pos = read_varint(data, pos)
+			values.append(json.loads(data[pos:pos + n]))
+			pos += n
+
+	return timestamps, values
+
+def revert(name='sensorino.db', convert=False):
+	'''Move a history saved in blocks back into the sensorino table
+	for db.connection, the reverse of connection.convert_rows().
+	Without convert only check that there's none to be left out.'''
+
+	# Not creating it, db.connection only sets up new files
+	if not os.path.exists(name):
+		return
+
+	check = sqlite3.connect(name)
+	try:
+		count = check.execute('SELECT COUNT(*) ' +
+				'FROM chunks').fetchone()[0]
+	except sqlite3.OperationalError:
+		count = 0
+	check.close()
+	if not count:
+		return
+	if not convert:
+		raise Exception('The value history is saved in blocks, ' +
+				'set history_convert to convert it back')
+
+	storage = connection(name)
+	storage.revert_rows()
+	storage.close()
+
+class block():
+	def __init__(self, chan, kind, rowid=None):
+		self.chan = chan
+		self.kind = kind
+		self.rowid = rowid # Set once saved in the chunks table
+		self.timestamps = []
+		self.values = []
+
+	def row(self):
+		return ( self.chan, self.timestamps[0], self.timestamps[-1],
+			len(self.timestamps), self.kind,
+			buffer(encode_block(self.kind, self.timestamps,
+				self.values)) )
+
+class connection(db.sample_connection):
+	# Length of the period covered by one block in seconds, a block
+	# is sealed when a value from the next period arrives.
+	block_period = 60 * 60
+
+	# The block being filled for each channel is kept in memory and
+	# saved, in its partial form, this often in seconds.  Up to this
+	# much of the history may be lost when the process is killed.
+	save_interval = 5 * 60
+
+	def __init__(self, name='sensorino.db', shard_months=None,
+			convert=False):
+		if shard_months:
+			raise Exception('History shards are not supported ' +
+					'with compressed storage')
+
+		self.open_blocks = {}
+		self.last_save = time.time()
+
+		# Blocks saved in the current transaction, with the rowid
+		# they had before, and blocks to save again after a rollback
+		self.saved = {}
+		self.unsaved = []
+
+		db.sample_connection.__init__(self, name, convert)
+
+		if self.shards:
+			raise Exception('History shards are not supported ' +
+					'with compressed storage')
+
+		self.cur.execute('CREATE TABLE IF NOT EXISTS chunks (' +
+				'chan INT, ' + # channels.id
+				'start INT, ' + # first timestamp, millisec
+				'stop INT, ' + # last timestamp
+				'count INT, ' +
+				'kind TEXT, ' + # 'f', 'i' or 'j', see value_kind()
+				'data BLOB)')
+		self.cur.execute('CREATE INDEX IF NOT EXISTS chunks_chan ' +
+				'ON chunks (chan, start)')
+		self.cur.execute('CREATE INDEX IF NOT EXISTS chunks_start ' +
+				'ON chunks (start)')
+		self.commit_written()
+
+		self.convert_rows()
+
+	def close(self):
+		# Unconfirmed values go in before the blocks are saved, see
+		# db.connection.close()
+		self.confirm_saved_values(self.provisional.keys())
+		self.write_pending()
+		self.save_blocks(self.open_blocks.values())
+		self.commit_written()
+
+		db.connection.close(self)
+
+	def store_rows(self, rows):
+		self.add_values(rows)
+		self.save_blocks(self.open_blocks.values())
+		self.open_blocks = {}
+
+	def drop_samples(self):
+		self.cur.execute('DELETE FROM chunks')
+		self.open_blocks = {}
+		self.commit_written()
+
+	def block_bucket(self, timestamp):
+		ms = self.block_period * 1000
+		return timestamp - timestamp % ms
+
+	def add_values(self, rows):
+		sealed = []
+		for timestamp, chan, value in rows:
+			kind = value_kind(value)
+			blk = self.open_blocks.get(chan)
+
+			# Blocks never span two periods, only hold one kind of
+			# values and are in timestamp order
+			if blk is not None and (blk.kind != kind or
+					timestamp < blk.timestamps[-1] or
+					self.block_bucket(timestamp) !=
+					self.block_bucket(blk.timestamps[0])):
+				sealed.append(blk)
+				blk = None
+			if blk is None:
+				blk = block(chan, kind)
+				self.open_blocks[chan] = blk
+
+			blk.timestamps.append(timestamp)
+			blk.values.append(value)
+
+		self.save_blocks(sealed)
+
+	def save_blocks(self, blocks):
+		for blk in blocks:
+			if id(blk) not in self.saved:
+				self.saved[id(blk)] = ( blk, blk.rowid )
+
+			if blk.rowid is None:
+				self.cur.execute('INSERT INTO chunks VALUES ' +
+						'( ?, ?, ?, ?, ?, ? )', blk.row())
+				blk.rowid = self.cur.lastrowid
+			else:
+				self.cur.execute('UPDATE chunks SET chan = ?, ' +
+						'start = ?, stop = ?, count = ?, ' +
+						'kind = ?, data = ? WHERE rowid = ?',
+						blk.row() + ( blk.rowid, ))
+
+	def write_pending(self):
+		if self.unsaved:
+			blocks, self.unsaved = self.unsaved, []
+			self.save_blocks(blocks)
+
+		db.sample_connection.write_pending(self)
+
+	def commit_written(self):
+		db.sample_connection.commit_written(self)
+		self.saved = {}
+
+	def rollback_written(self):
+		db.sample_connection.rollback_written(self)
+
+		# Sealed blocks only exist in the chunks table, those and
+		# the rows INSERTed for open blocks are gone
+		for blk, rowid in self.saved.values():
+			blk.rowid = rowid
+			self.unsaved.append(blk)
+		self.saved = {}
+
+	def insert_values(self, rows):
+		self.add_values(rows)
+
+		if time.time() - self.last_save >= self.save_interval:
+			self.save_blocks(self.open_blocks.values())
+			self.last_save = time.time()
+
+	def end_import(self):
+		self.save_blocks(self.open_blocks.values())
+		self.last_save = time.time()
+
+		db.sample_connection.end_import(self)
+
+	def find_blocks(self, cur, cond, params, overlaps):
+		'''Return ( start, ref ) pairs, ordered by start, for the
+		saved blocks matching the SQL condition and the open blocks
+		for which overlaps(block) is true.  ref is the block
+		or its rowid, see load_block().'''
+
+		blocks = [ ( blk.timestamps[0], blk )
+			for blk in self.open_blocks.values() if overlaps(blk) ]
+		open_rowids = set([ blk.rowid for start, blk in blocks ])
+
+		cur.execute(find_blocks_sql + cond, params)
+		blocks += [ row for row in cur.fetchall()
+			if row[1] not in open_rowids ]
+
+		blocks.sort(key = lambda blk: blk[0])
+		return blocks
+
+	def history_queries(self):
+		return [
+			( 'chan_blocks', find_blocks_sql + chan_blocks_cond,
+				'chunks_chan' ),
+			( 'last_block', find_blocks_sql + last_block_cond,
+				'chunks_chan' ),
+			( 'overlapping_blocks', find_blocks_sql +
+				overlapping_blocks_cond, 'chunks_chan' ),
+			( 'blocks_within_period', find_blocks_sql +
+				blocks_within_cond, 'chunks_start' ),
+			( 'block_counts', block_counts_sql, 'chunks_start' ),
+			( 'load_block', load_block_sql, 'INTEGER PRIMARY KEY' ),
+		]
+
+	def load_block(self, cur, ref):
+		if isinstance(ref, block):
+			return ref
+
+		cur.execute(load_block_sql, ( ref, ))
+		chan, start, kind, count, data = cur.fetchone()
+
+		blk = block(chan, kind, ref)
+		blk.timestamps, blk.values = decode_block(start, kind,
+				count, data)
+		return blk
+
+	def chan_blocks(self, cur, chan, t0, t1):
+		'''Blocks of the channel with values in [t0, t1).'''
+
+		return self.find_blocks(cur, chan_blocks_cond,
+				( chan, self.block_bucket(t0), t1 ),
+				lambda blk: blk.chan == chan and
+					blk.timestamps[0] < t1 and
+					blk.timestamps[-1] >= t0)
+
+	def get_event_counts(self, paths, t0, t1, buckets):
+		'''As in db.connection, blocks entirely within one bucket
+		add their count without being decoded.'''
+
+		self.catch_up()
+
+		counts = [ 0 ] * buckets
+		chans = self.match_chans(paths)
+		if chans == []:
+			return counts
+
+		t0 = int(t0 * 1000)
+		t1 = int(t1 * 1000)
+		cond = ''
+		if chans is not None:
+			cond = ' AND chan IN (' + \
+				', '.join([ str(chan) for chan in chans ]) + ')'
+
+		# ( start, stop, count, ref ) like in find_blocks()
+		blocks = [ ( blk.timestamps[0], blk.timestamps[-1],
+				len(blk.timestamps), blk )
+			for blk in self.open_blocks.values()
+			if (chans is None or blk.chan in chans) and
+				blk.timestamps[0] < t1 and
+				blk.timestamps[-1] >= t0 ]
+		open_rowids = set([ blk[3].rowid for blk in blocks ])
+
+		self.rcur.execute(block_counts_sql + cond,
+				( self.block_bucket(t0), t1 ))
+		blocks += [ row for row in self.rcur.fetchall()
+			if row[3] not in open_rowids ]
+
+		for start, stop, count, ref in blocks:
+			first = (start - t0) * buckets / (t1 - t0)
+			if start >= t0 and stop < t1 and \
+					(stop - t0) * buckets / (t1 - t0) == first:
+				counts[first] += count
+				continue
+
+			for timestamp in self.load_block(self.rcur,
+					ref).timestamps:
+				if t0 <= timestamp < t1:
+					counts[(timestamp - t0) * buckets /
+						(t1 - t0)] += 1
+
+		return counts
+
+	def read_samples(self, cur, t0, t1):
+		'''Yield all ( timestamp, chan, value ) tuples with
+		timestamps in [t0, t1) in timestamp order.  None stands for
+		no bound.'''
+
+		if t0 is None:
+			blocks = self.find_blocks(cur, '1', (), lambda blk: True)
+		else:
+			blocks = self.find_blocks(cur, blocks_within_cond,
+					( self.block_bucket(t0), t1 ),
+					lambda blk: blk.timestamps[0] < t1 and
+						blk.timestamps[-1] >= t0)
+
+		# Blocks don't span periods, so sorting the values one
+		# period at a time gives the global order
+		bucket = None
+		samples = []
+		for start, ref in blocks:
+			if self.block_bucket(start) != bucket:
+				for sample in sorted(samples):
+					yield sample
+				samples = []
+				bucket = self.block_bucket(start)
+
+			blk = self.load_block(cur, ref)
+			for timestamp, value in zip(blk.timestamps, blk.values):
+				if (t0 is None or timestamp >= t0) and \
+						(t1 is None or timestamp < t1):
+					samples.append(( timestamp, blk.chan,
+						value ))
+
+		for sample in sorted(samples):
+			yield sample
+
+	def first_timestamp(self, cur):
+		cur.execute('SELECT MIN(start) FROM chunks')
+		starts = [ blk.timestamps[0]
+			for blk in self.open_blocks.values() ]
+		starts.append(cur.fetchone()[0])
+		return min([ start for start in starts if start is not None ]
+				or [ None ])
+
+	def last_sample(self, cur, chan, timestamp):
+		'''Return the last ( timestamp, value ) of the channel at or
+		before timestamp, or None.'''
+
+		def last_in(ref, best):
+			blk = self.load_block(cur, ref)
+			for ts, value in zip(blk.timestamps, blk.values):
+				if ts <= timestamp and (best is None or
+						ts >= best[0]):
+					best = ( ts, value )
+			return best
+
+		# One more in case the newest is the open block's copy
+		blocks = self.find_blocks(cur, last_block_cond,
+				( chan, timestamp ),
+				lambda blk: blk.chan == chan and
+					blk.timestamps[0] <= timestamp)
+		if not blocks:
+			return None
+		best = last_in(blocks[-1][1], None)
+
+		# Values that arrived out of order may be in other blocks
+		# overlapping that one
+		for start, ref in self.find_blocks(cur,
+				overlapping_blocks_cond, ( chan, self.block_bucket(best[0]),
+					blocks[-1][0], best[0] ),
+				lambda blk: blk.chan == chan and
+					blk.timestamps[0] < blocks[-1][0] and
+					blk.timestamps[-1] >= best[0]):
+			best = last_in(ref, best)
+
+		return best
+
+	def chan_samples(self, cur, chan, t0, t1, reverse=False):
+		'''Yield the ( timestamp, value ) tuples of the channel
+		with timestamps in [t0, t1) in timestamp order.'''
+
+		buckets = {}
+		for start, ref in self.chan_blocks(cur, chan, t0, t1):
+			buckets.setdefault(self.block_bucket(start),
+					[]).append(ref)
+
+		# Blocks only overlap when values came out of order, and
+		# only within a period, sort one period at a time
+		for bucket in sorted(buckets, reverse=reverse):
+			samples = []
+			for ref in buckets[bucket]:
+				blk = self.load_block(cur, ref)
+				samples += [ ( ts, value ) for ts, value in
+					zip(blk.timestamps, blk.values)
+					if t0 <= ts < t1 ]
+			if len(buckets[bucket]) > 1:
+				samples.sort(key = lambda sample: sample[0])
+			if reverse:
+				samples.reverse()
+
+			for sample in samples:
+				yield sample
+
+	def expire_values(self, timestamp, limit):
+		'''Delete up to limit blocks older than timestamp, see
+		db.connection.expire_values().'''
+
+		keep = self.expire_snapshots(int(timestamp * 1000))
+		if keep is None:
+			return 0
+
+		open_rowids = [ str(blk.rowid)
+			for blk in self.open_blocks.values()
+			if blk.rowid is not None ]
+		self.cur.execute('DELETE FROM chunks WHERE rowid IN (' +
+				'SELECT rowid FROM chunks WHERE stop < ? ' +
+				'AND rowid NOT IN (' + ', '.join(open_rowids) +
+				') LIMIT ?)', ( keep, limit ))
+		return self.cur.rowcount
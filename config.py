@@ -3,3 +3,38 @@ httpd_address = ( '', 8000 )
 
 # Where we listen for the Base to connect to.
 base_server_address = ( '127.0.0.1', 8888 )
+
+# Number of worker processes decoding and validating the messages from
+# the Bases, see ingest.py.  0 to do everything in the server process,
+# which is enough unless the Bases send hundreds of messages a second.
+base_workers = 0
+
+# How many days of history to keep, None to keep everything.  'values'
+# are the raw channel values, 'rollup-minute', 'rollup-hour' and
+# 'rollup-day' their aggregates used for charts over long periods,
+# 'console' the console log.  E.g. { 'values': 30, 'console': 7 }
+retention = {
+	'values': None,
+	'console': None,
+}
+
+# Store the raw channel values in a separate file for every that many
+# months, e.g. 1 for sensorino-2015-06.db, sensorino-2015-07.db, ...
+# Older files become read-only and are deleted whole by the 'values'
+# retention above.  None to keep everything in sensorino.db.
+history_shard_months = None
+
+# How the raw channel values are stored: 'rows' for one database row per
+# value, 'chunks' for compressed blocks of up to an hour of values per
+# channel (see chunkdb.py), which take several times less space, or
+# 'log' for append-only per-channel files next to the database (see
+# logdb.py), which is cheaper to write to on flash.  The last two can't
+# be combined with history_shard_months.
+history_storage = 'rows'
+
+# Whether a value history saved as 'rows' is converted when the
+# database is opened with 'chunks' or 'log', and back when opened with
+# 'rows' again.  Otherwise the server refuses to start rather than leave
+# the history out.  Go through 'rows' to change between 'chunks' and
+# 'log'.
+history_convert = False
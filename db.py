@@ -9,7 +9,18 @@
 #
 import sqlite3
 import os.path
+import re
+import json
+import zlib
+import time
+import calendar
+import hashlib
+import ast
 import sensorino
+import storage
+import timers
+import jsondiff
+import valuepack
 
 datatype_by_num = {}
 for t, num, py_t in sensorino.known_datatypes:
@@ -32,15 +43,93 @@ def sqlite_to_datatype(val):
 # a nice solution if it wasn't for that.
 sqlite3.register_adapter(bool, lambda b: buffer('\x01' if b else ''))
 
-# Dicts - TODO
-# For now convert them to strings (repr or json.dumps?)
-sqlite3.register_adapter(dict, lambda b: repr(b))
+# Dicts, the values of 'message' channels, are BLOBs too, in the
+# valuepack encoding.  Neither an empty BLOB nor a single 0x01 byte is
+# a valid encoding of a dict so they can't be mistaken for a bool.
+sqlite3.register_adapter(dict, lambda d: buffer(valuepack.pack(d)))
 
 def sqlite_to_value(obj):
 	if isinstance(obj, buffer):
-		return len(obj) > 0
+		if len(obj) <= 1 and obj[:] in [ '', '\x01' ]:
+			return len(obj) > 0
+		# A damaged value shouldn't fail the whole query
+		try:
+			return valuepack.unpack(obj)
+		except ValueError as e:
+			sensorino.log_warn('Unreadable value ' +
+					repr(obj[:16]) + ': ' + str(e))
+			return None
 	return obj
 
+def parse_dict_repr(text):
+	'''Return the dict whose repr() the text is, or None.'''
+
+	try:
+		value = ast.literal_eval(text)
+	except ( ValueError, SyntaxError ):
+		return None
+	if not isinstance(value, dict):
+		return None
+	return value
+
+def is_numeric(value):
+	return isinstance(value, ( int, long, float )) and \
+		not isinstance(value, bool)
+
+# The SQL equivalent, bools are stored as BLOBs
+numeric_cond = 'typeof(value) IN ( \'integer\', \'real\' )'
+
+# The frequent queries, run by the get_* methods and checked by
+# connection.planned_queries().  {table} is the sensorino table of the
+# main file or of a shard, {cond} an optional extra condition.
+value_at_sql = 'SELECT value FROM {table} ' + \
+	'WHERE chan = ? AND timestamp <= ? ' + \
+	'ORDER BY timestamp DESC LIMIT 1'
+values_within_sql = 'SELECT timestamp, value FROM {table} ' + \
+	'WHERE chan = ? AND timestamp >= ? AND timestamp < ? ' + \
+	'ORDER BY timestamp DESC LIMIT ?'
+values_page_sql = 'SELECT rowid, timestamp, value FROM {table} ' + \
+	'WHERE chan = ?'
+values_without_snapshot_sql = 'SELECT chan, value FROM {table} ' + \
+	'WHERE rowid IN (SELECT (SELECT rowid FROM {table} ' + \
+		'WHERE chan = channels.id AND timestamp <= ? ' + \
+		'ORDER BY timestamp DESC LIMIT 1) ' + \
+	'FROM channels)'
+tree_since_snapshot_sql = 'SELECT chan, value FROM {table} ' + \
+	'WHERE timestamp > ? AND timestamp <= ? ORDER BY timestamp'
+event_counts_sql = 'SELECT (timestamp - ?) * ? / ?, COUNT(*) ' + \
+	'FROM {table} WHERE {cond}timestamp >= ? AND timestamp < ? ' + \
+	'GROUP BY 1'
+latest_sql = 'SELECT value FROM sensorino_latest WHERE chan = ?'
+snapshot_before_sql = 'SELECT MAX(timestamp) FROM snapshot ' + \
+	'WHERE timestamp <= ?'
+snapshot_at_sql = 'SELECT timestamp, tree FROM snapshot ' + \
+	'WHERE timestamp <= ? ORDER BY timestamp DESC LIMIT 1'
+rollups_within_sql = 'SELECT timestamp, sum / count, min, max, ' + \
+	'count FROM rollup WHERE chan = ? AND period = ? AND ' + \
+	'timestamp >= ? AND timestamp < ? ' + \
+	'ORDER BY timestamp DESC LIMIT ?'
+rollups_page_sql = 'SELECT rowid, timestamp, sum / count, min, max, ' + \
+	'count FROM rollup WHERE chan = ? AND period = ?'
+console_at_sql = 'SELECT timestamp, line FROM console {cond}' + \
+	'ORDER BY timestamp DESC LIMIT 64'
+console_first_sql = 'SELECT MIN(id) FROM console ' + \
+	'WHERE timestamp = (SELECT MIN(timestamp) FROM console ' + \
+		'WHERE timestamp >= ?)'
+console_last_sql = 'SELECT MAX(id) FROM console ' + \
+	'WHERE timestamp = (SELECT MAX(timestamp) FROM console ' + \
+		'WHERE timestamp < ?)'
+console_scan_sql = 'SELECT id, timestamp, line FROM console ' + \
+	'WHERE line LIKE ? ESCAPE \'\\\' AND id BETWEEN ? AND ? AND ' + \
+	'+timestamp >= ? AND +timestamp < ? ORDER BY id DESC LIMIT ?'
+floorplan_at_sql = 'SELECT base, patch FROM floorplan {cond}' + \
+	'ORDER BY timestamp DESC LIMIT 1'
+
+# Keyset pagination of the values_page_sql or rollups_page_sql rows
+page_sql = '{select} AND timestamp >= ? AND timestamp < ? ' + \
+	'AND NOT (timestamp = ? AND rowid <= ?) ' + \
+	'ORDER BY timestamp, rowid LIMIT ?'
+
 def tree_insert_value(state, path, value):
 	# Create a dict for the node if first sighting
 	if path[0] not in state:
@@ -65,192 +154,1672 @@ def tree_insert_value(state, path, value):
 
 	state[path[-1]] = value
 
-class connection():
-	def __init__(self, name='sensorino.db'):
+def rows_to_tree(rows):
+	tree = {}
+	for node_addr, svc_id, datatype, chan_id, value in rows:
+		path = ( node_addr, svc_id )
+		if datatype is not None:
+			path += ( sqlite_to_datatype(datatype), )
+			if chan_id is not None:
+				path += ( chan_id, )
+
+		tree_insert_value(tree, path, sqlite_to_value(value))
+
+	return tree
+
+def path_to_params(path):
+	params = [ path[0], path[1], None, None ]
+	if len(path) >= 3:
+		params[2] = datatype_to_sqlite(path[2])
+	if len(path) >= 4:
+		params[3] = path[3]
+	return tuple(params)
+
+class connection(storage.storage):
+	# Writes are buffered and committed in a single transaction once
+	# this many rows are queued, or flush_delay seconds after the
+	# first commit() request, whichever comes first.
+	flush_rows = 256
+	flush_delay = 0.5
+
+	# Bump when the schema changes and add the upgrade step to
+	# migrate()
+	schema_version = 13
+
+	# Resolutions, in seconds, of the min/max/avg/count aggregates
+	# kept for numeric channels
+	rollup_periods = [
+		( 'minute', 60 ),
+		( 'hour', 60 * 60 ),
+		( 'day', 24 * 60 * 60 ),
+	]
+
+	# A snapshot of the whole tree is saved every snapshot_interval
+	# seconds or snapshot_changes changed values, whichever comes
+	# first, so that historical trees can be rebuilt from the nearest
+	# snapshot and the few changes after it.
+	snapshot_interval = 30 * 60
+	snapshot_changes = 4096
+
+	# SQLite allows 10 attached databases per connection by default
+	max_attached = 8
+
+	# Rows read per query by export_values()
+	export_batch = 1024
+
+	# Rows per transaction in import_values()
+	import_batch = 50000
+
+	# Floorplan versions are stored as a JSON patch against the last
+	# full copy until the patch would be larger than this fraction
+	# of the document, then a new full copy is stored
+	floorplan_patch_ratio = 0.125
+
+	# Rows sampled per index by ANALYZE, keeps optimize() quick on
+	# big databases at the cost of less exact statistics
+	analysis_limit = 1000
+
+	def __init__(self, name='sensorino.db', shard_months=None):
+		'''If shard_months is given, new history rows go into
+		separate files, one per that many months, next to the main
+		file.  The main file keeps everything else.'''
+
 		exists = os.path.exists(name)
+		self.name = name
 		self.conn = sqlite3.connect(name)
 		self.cur = self.conn.cursor()
 
+		self.shard_months = shard_months
+		self.shards = []
+		self.attached = {}
+		# Set while an import builds the indexes at the end
+		self.defer_indexes = False
+
+		# Rows queued by the save_* methods.  They stay queued until
+		# the transaction they're written in is committed so that a
+		# failed commit loses nothing, see write_pending().
+		self.pending_channels = []
+		self.pending_values = []
+		self.pending_console = []
+		self.pending_floorplan = []
+		# Provisional values to record and references of those
+		# confirmed or discarded, see save_value()
+		self.pending_provisional = []
+		self.pending_settled = []
+		self.flush_timeout = None
+
+		# Number of rows at the start of each queue written in the
+		# current transaction
+		self.written = dict.fromkeys([ 'channels', 'values',
+			'console', 'floorplan', 'provisional', 'settled' ], 0)
+
+		# Number of queued values already in a history that isn't
+		# rolled back with the transaction, see sample_connection
+		self.stored_values = 0
+
+		# Values of Set requests not yet confirmed by the node,
+		# reference -> row.  They only go into the history once
+		# confirmed, see confirm_saved_values().
+		self.provisional = {}
+		self.next_ref = 1
+
 		if not exists:
 			self.setup()
+		self.load_channels()
+		self.cur.execute('SELECT MAX(timestamp) FROM sensorino')
+		self.main_last = self.cur.fetchone()[0]
+		self.migrate()
+		self.load_shards()
+		self.setup_console_search()
+		self.load_provisional()
+
+		# In WAL mode readers don't block the writer or the other
+		# way around, and a commit only needs an fsync at checkpoint
+		# time with synchronous = NORMAL.  Only switched on after
+		# setup() and migrate() as auto_vacuum can't be changed in
+		# WAL mode.
+		self.cur.execute('PRAGMA journal_mode = WAL')
+		self.cur.execute('PRAGMA synchronous = NORMAL')
 
-		# TODO: should we ANALYZE here, or maybe ANALYZE
-		# periodically?
+		self.load_snapshot_info()
+		self.load_floorplan_info()
+
+		# The get_* methods run on a separate read-only connection.
+		# They only see committed data, so they flush whatever is
+		# queued first, see catch_up().  Each statement (or the
+		# explicit transaction around a group of statements) sees
+		# a consistent snapshot of the database and doesn't wait
+		# for the writer.
+		self.rconn = sqlite3.connect(name)
+		self.rconn.isolation_level = None
+		self.rcur = self.rconn.cursor()
+		self.rcur.execute('PRAGMA query_only = ON')
 
 	def close(self):
+		# No answer from the node by now, assume success like
+		# sensorino.py does on a timeout
+		if self.provisional:
+			self.confirm_saved_values(self.provisional.keys())
+			self.flush()
+
+		self.rconn.close()
 		self.conn.close()
 
 	def setup(self):
+		# Let expired data be returned to the filesystem gradually,
+		# must be set before any table is created
+		self.cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+		self.setup_channels()
+
 		# Create the table and indexes related to the sensorino state
-		self.cur.execute('CREATE TABLE sensorino (' +
-				'timestamp INT, ' + # millisec resolution
-				'node_addr BLOB, ' + # NONE affinity
+		self.setup_sensorino()
+		self.setup_latest()
+		self.setup_snapshot()
+		self.setup_rollup()
+		self.setup_shards()
+		self.setup_provisional()
+
+		# Create the table and indexes related to the console state
+		self.setup_console()
+
+		# Create the table and indexes related to the floorplan state
+		self.setup_floorplan()
+
+		self.cur.execute('PRAGMA user_version = ' +
+				str(self.schema_version))
+		self.commit_written()
+
+	def migrate(self):
+		'''Bring the schema of a database created by an older
+		version up to date.  PRAGMA user_version tracks the steps
+		already done.'''
+
+		self.cur.execute('PRAGMA user_version')
+		version = self.cur.fetchone()[0]
+		if version >= self.schema_version:
+			return
+
+		if version < 1:
+			self.migrate_latest()
+		if version < 2:
+			self.migrate_snapshot()
+		if version < 3:
+			self.migrate_rollup()
+		if version < 4:
+			# Let per-channel range scans walk the index in
+			# timestamp order.  Supersedes sensorino_addr.
+			self.cur.execute('CREATE INDEX sensorino_addr_time ' +
+					'ON sensorino (node_addr, svc_id, ' +
+					'datatype, chan_id, timestamp)')
+			self.cur.execute('DROP INDEX sensorino_addr')
+		if version < 5:
+			self.cur.execute('CREATE INDEX rollup_time ON rollup ' +
+					'(period, timestamp)')
+		if version < 6:
+			self.migrate_channels()
+		if version < 7:
+			self.setup_shards()
+		if version < 8:
+			self.drop_failed_values()
+		if version < 9:
+			self.migrate_floorplan()
+		if version < 10:
+			self.pack_message_values()
+		if version < 11:
+			self.drop_success_column()
+		if version < 12:
+			self.setup_provisional()
+		if version < 13:
+			self.migrate_console()
+
+		self.cur.execute('PRAGMA user_version = ' +
+				str(self.schema_version))
+		self.commit_written()
+
+		self.setup_auto_vacuum()
+
+	# Until version 6 the history, sensorino_latest, the rollups and
+	# the snapshots had the full ( node_addr, svc_id, datatype,
+	# chan_id ) path in every row, the steps before that work on
+	# that form.  Failed Set requests were kept in the history with
+	# success = 0 until version 8.
+
+	def migrate_latest(self):
+		'''Version 1 added sensorino_latest.'''
+
+		self.cur.execute('CREATE TABLE sensorino_latest (' +
+				'node_addr BLOB, ' +
 				'svc_id INT, ' +
-				'datatype INT, ' + # int ID if type is known
+				'datatype INT, ' +
 				'chan_id INT, ' +
-				'value BLOB, ' + # NONE affinity
-				'success BOOL)') # INT affinity
-
-		# To be used in all the queries and subqueries in get_value*
-		# or get_timestamp*
-		self.cur.execute('CREATE INDEX sensorino_addr ON sensorino ' +
+				'timestamp INT, ' +
+				'value BLOB)')
+		self.cur.execute('CREATE UNIQUE INDEX sensorino_latest_addr ' +
+				'ON sensorino_latest ' +
 				'(node_addr, svc_id, datatype, chan_id)')
-		self.cur.execute('CREATE INDEX sensorino_time_addr ' +
-				'ON sensorino (timestamp DESC, ' +
-				'node_addr, svc_id, datatype, chan_id)')
-
-		# For some reason the following don't get used...
-		#self.cur.execute('CREATE INDEX sensorino_addr_p ON sensorino' +
-		#		' (node_addr, svc_id, datatype, chan_id) ' +
-		#		'WHERE success')
-		#self.cur.execute('CREATE INDEX sensorino_time_addr_p ' +
-		#		'ON sensorino (timestamp DESC, ' +
-		#		'node_addr, svc_id, datatype, chan_id) ' +
-		#		'WHERE success')
 
-		# Create the table and indexes related to the console state
+		# Backfill from the existing history.  SQLite takes the
+		# bare columns from the row that has the MAX(timestamp).
+		self.cur.execute('INSERT INTO sensorino_latest ' +
+				'SELECT node_addr, svc_id, datatype, ' +
+				'chan_id, MAX(timestamp), value ' +
+				'FROM sensorino WHERE success GROUP BY ' +
+				'node_addr, svc_id, datatype, chan_id')
+
+	def migrate_snapshot(self):
+		'''Version 2 added the snapshots, of [ node_addr, svc_id,
+		datatype, chan_id, value ] rows.'''
+
+		self.setup_snapshot()
+
+		self.snapshot_last = None
+		self.snapshot_count = 0
+
+		def save(timestamp):
+			tree = json.dumps([ path + ( sqlite_to_value(value), )
+				for path, value in values.items() ])
+			self.cur.execute('INSERT INTO snapshot VALUES ( ?, ? )',
+					( timestamp, buffer(zlib.compress(tree)) ))
+			self.snapshot_last = timestamp
+			self.snapshot_count = 0
+
+		values = {}
+		prev = None
+		for row in self.cur.execute('SELECT timestamp, node_addr, ' +
+				'svc_id, datatype, chan_id, value ' +
+				'FROM sensorino WHERE success ' +
+				'ORDER BY timestamp').fetchall():
+			if prev is not None and row[0] != prev and \
+					self.snapshot_due(prev):
+				save(prev)
+
+			values[row[1:5]] = row[5]
+			self.snapshot_count += 1
+			prev = row[0]
+
+	def migrate_rollup(self):
+		'''Version 3 added the rollups.'''
+
+		self.cur.execute('CREATE TABLE rollup (' +
+				'node_addr BLOB, ' +
+				'svc_id INT, ' +
+				'datatype INT, ' +
+				'chan_id INT, ' +
+				'period INT, ' + # seconds
+				'timestamp INT, ' + # millisec resolution
+				'min REAL, ' +
+				'max REAL, ' +
+				'sum REAL, ' +
+				'count INT)')
+		self.cur.execute('CREATE UNIQUE INDEX rollup_addr ON rollup ' +
+				'(node_addr, svc_id, datatype, chan_id, ' +
+				'period, timestamp)')
+
+		for name, period in self.rollup_periods:
+			ms = period * 1000
+			self.cur.execute('INSERT INTO rollup SELECT ' +
+					'node_addr, svc_id, datatype, ' +
+					'chan_id, ?, timestamp - timestamp % ?, ' +
+					'MIN(value), MAX(value), SUM(value), ' +
+					'COUNT(*) FROM sensorino WHERE success ' +
+					'AND chan_id IS NOT NULL AND ' +
+					numeric_cond + ' GROUP BY node_addr, ' +
+					'svc_id, datatype, chan_id, ' +
+					'timestamp - timestamp % ?',
+					( period, ms, ms ))
+
+	def migrate_channels(self):
+		'''Version 6 replaced the paths with the channel ids,
+		keeping all the history.'''
+
+		self.setup_channels()
+		self.cur.execute('INSERT INTO channels ( node_addr, svc_id, ' +
+				'datatype, chan_id ) ' +
+				'SELECT DISTINCT node_addr, svc_id, ' +
+				'datatype, chan_id FROM sensorino ' +
+				'UNION SELECT node_addr, svc_id, datatype, ' +
+				'chan_id FROM sensorino_latest ' +
+				'UNION SELECT node_addr, svc_id, datatype, ' +
+				'chan_id FROM rollup')
+		self.load_channels()
+
+		def convert(table, setup, columns):
+			# Index names are global, drop the old ones first
+			self.cur.execute('SELECT name FROM sqlite_master WHERE ' +
+					'type = \'index\' AND tbl_name = ? AND ' +
+					'sql IS NOT NULL', ( table, ))
+			for row in self.cur.fetchall():
+				self.cur.execute('DROP INDEX ' + row[0])
+
+			# Note: IS is a = that treats two NULLs equal
+			self.cur.execute('ALTER TABLE ' + table + ' RENAME TO ' +
+					table + '_old')
+			setup()
+			self.cur.execute('INSERT INTO ' + table + ' SELECT ' +
+					columns + ' FROM ' + table + '_old ' +
+					'AS t, channels AS c WHERE ' +
+					't.node_addr IS c.node_addr AND ' +
+					't.svc_id IS c.svc_id AND ' +
+					't.datatype IS c.datatype AND ' +
+					't.chan_id IS c.chan_id ORDER BY t.rowid')
+			self.cur.execute('DROP TABLE ' + table + '_old')
+
+		# See drop_failed_values()
+		self.cur.execute('DELETE FROM sensorino WHERE NOT success')
+		convert('sensorino', self.setup_sensorino,
+				't.timestamp, c.id, t.value')
+
+		convert('sensorino_latest', self.setup_latest,
+				'c.id, t.timestamp, t.value')
+		convert('rollup', self.setup_rollup,
+				'c.id, t.period, t.timestamp, t.min, ' +
+				't.max, t.sum, t.count')
+
+		snapshots = self.cur.execute('SELECT rowid, tree ' +
+				'FROM snapshot').fetchall()
+		for rowid, tree in snapshots:
+			rows = json.loads(zlib.decompress(tree))
+			tree = json.dumps([ [ self.channel_id(
+					tuple(row[:4]), True ), row[4] ]
+				for row in rows ])
+			self.cur.execute('UPDATE snapshot SET tree = ? ' +
+					'WHERE rowid = ?',
+					( buffer(zlib.compress(tree)), rowid ))
+		self.write_pending()
+
+	def update_history(self, update, what):
+		'''Call update(table) for the sensorino table of the main
+		file and of each shard, making the sealed shards writable
+		for the time of the update.  what describes the update in
+		the warning logged if a shard can't be updated.'''
+
+		update('sensorino')
+
+		self.load_shards()
+		for shard in self.shards:
+			path = os.path.join(os.path.dirname(self.name), shard[2])
+			try:
+				if shard[3]:
+					os.chmod(path, 0644)
+				update(self.history_table(self.conn, shard))
+				self.commit_written()
+				self.detach_shard(shard)
+				if shard[3]:
+					os.chmod(path, 0444)
+			except Exception as e:
+				sensorino.log_warn('Could not ' + what + ' in ' +
+						shard[2] + ': ' + str(e))
+
+	def has_success_column(self, table):
+		# Tables created by migrate_channels() or after version 10
+		# don't have it
+		schema, dot, name = table.rpartition('.')
+		self.cur.execute('PRAGMA ' + schema + dot + 'table_info(' +
+				name + ')')
+		return 'success' in [ row[1] for row in self.cur.fetchall() ]
+
+	def drop_failed_values(self):
+		'''Delete the history rows of Set requests that failed,
+		which before the provisional values were kept in the
+		history with success = 0.'''
+
+		def drop(table):
+			if self.has_success_column(table):
+				self.cur.execute('DELETE FROM ' + table +
+						' WHERE NOT success')
+
+		self.update_history(drop, 'drop the failed values')
+
+	def drop_success_column(self):
+		'''The success column has been 1 in every row since version
+		8, version 11 removed it.'''
+
+		def drop(table):
+			if self.has_success_column(table):
+				self.cur.execute('ALTER TABLE ' + table +
+						' DROP COLUMN success')
+
+		self.update_history(drop, 'drop the success column')
+
+	def setup_provisional(self):
+		# Copies of the provisional values so that they're not
+		# lost if the process dies before the node answers, see
+		# load_provisional()
+		self.cur.execute('CREATE TABLE provisional (' +
+				'ref INTEGER PRIMARY KEY, ' +
+				'timestamp INT, ' + # millisec resolution
+				'chan INT, ' + # channels.id
+				'value BLOB)')
+
+	def load_provisional(self):
+		'''Confirm the values of Set requests that were still
+		waiting for the node's answer when the process died.  The
+		answer can't be known any more, assume success as close()
+		and sensorino.py do on a timeout.'''
+
+		self.cur.execute('SELECT ref, timestamp, chan, value ' +
+				'FROM provisional ORDER BY ref')
+		rows = self.cur.fetchall()
+		if not rows:
+			return
+
+		sensorino.log_warn(str(len(rows)) + ' values of Set ' +
+				'requests left unconfirmed, saving them')
+		for ref, timestamp, chan, value in rows:
+			self.provisional[ref] = ( timestamp, chan,
+					sqlite_to_value(value) )
+		self.next_ref = rows[-1][0] + 1
+		self.confirm_saved_values([ row[0] for row in rows ])
+
+	def pack_message_values(self):
+		'''Until version 10 dicts were stored as their repr()
+		strings, parse those back and store the dicts packed.'''
+
+		kind = datatype_to_sqlite('message')
+		chans = set([ chan for chan, params in self.channel_paths.items()
+			if params[2] == kind ])
+		if not chans:
+			return
+
+		cond = ' WHERE chan IN (' + \
+			', '.join([ str(chan) for chan in chans ]) + ') ' + \
+			'AND typeof(value) = \'text\''
+
+		def convert(table):
+			rows = self.cur.execute('SELECT rowid, value FROM ' +
+					table + cond).fetchall()
+			updates = []
+			for rowid, text in rows:
+				value = parse_dict_repr(text)
+				if value is not None:
+					updates.append(( value, rowid ))
+			self.cur.executemany('UPDATE ' + table + ' SET ' +
+					'value = ? WHERE rowid = ?', updates)
+
+		self.update_history(convert, 'pack the message values')
+		convert('sensorino_latest')
+
+		# The snapshots hold the decoded values, as JSON
+		for rowid, tree in self.cur.execute('SELECT rowid, tree ' +
+				'FROM snapshot').fetchall():
+			rows = json.loads(zlib.decompress(tree))
+			changed = False
+			for row in rows:
+				if row[0] not in chans or \
+						not isinstance(row[1], basestring):
+					continue
+				value = parse_dict_repr(row[1])
+				if value is not None:
+					row[1] = value
+					changed = True
+			if changed:
+				self.cur.execute('UPDATE snapshot SET tree = ? ' +
+						'WHERE rowid = ?', ( buffer(
+							zlib.compress(json.dumps(rows))),
+						rowid ))
+
+	def migrate_floorplan(self):
+		'''Until version 9 every floorplan version was stored in
+		full, store them again as patches.'''
+
+		self.cur.execute('DROP INDEX floorplan_time')
+		self.cur.execute('ALTER TABLE floorplan RENAME TO floorplan_old')
+		self.setup_floorplan()
+
+		self.floorplan_last = None
+		self.floorplan_base = None
+		for timestamp, data in self.cur.execute('SELECT timestamp, ' +
+				'version FROM floorplan_old ' +
+				'ORDER BY timestamp').fetchall():
+			try:
+				self.store_floorplan(timestamp, data)
+			except ValueError:
+				sensorino.log_warn('Dropping unreadable ' +
+						'floorplan version from ' +
+						str(timestamp))
+
+		self.cur.execute('DROP TABLE floorplan_old')
+
+	def setup_console(self):
+		# The explicit id, unlike a rowid, is kept by VACUUM, the
+		# search index refers to the lines by it
 		self.cur.execute('CREATE TABLE console (' +
+				'id INTEGER PRIMARY KEY, ' +
 				'timestamp INT, ' + # millisec resolution
 				'line TEXT)')
 		self.cur.execute('CREATE INDEX console_time ON console ' +
 				'(timestamp DESC)')
 
-		# Create the table and indexes related to the floorplan state
+	def migrate_console(self):
+		'''Version 13 gave the console lines an explicit id, keeping
+		their rowids.  The search index is rebuilt on it by
+		setup_console_search().'''
+
+		self.cur.execute('SELECT 1 FROM sqlite_master ' +
+				'WHERE name = \'console_fts\'')
+		if self.cur.fetchone() is not None:
+			self.cur.execute('DROP TABLE console_fts')
+
+		self.cur.execute('DROP INDEX console_time')
+		self.cur.execute('ALTER TABLE console RENAME TO console_old')
+		self.setup_console()
+		self.cur.execute('INSERT INTO console SELECT rowid, ' +
+				'timestamp, line FROM console_old ORDER BY rowid')
+		self.cur.execute('DROP TABLE console_old')
+
+	def setup_console_search(self):
+		'''Full-text index of the console lines for
+		search_console(), if the SQLite library has FTS5 and the
+		trigram tokenizer (3.34 and later).  Without it searches
+		scan the whole console table.'''
+
+		self.cur.execute('SELECT 1 FROM sqlite_master ' +
+				'WHERE name = \'console_fts\'')
+		exists = self.cur.fetchone() is not None
+
+		try:
+			if exists:
+				self.cur.execute('SELECT 1 FROM console_fts ' +
+						'LIMIT 0')
+			else:
+				# The index has no copy of the text and
+				# refers to the console rows by id.  It
+				# answers LIKE queries for any substring of
+				# 3 or more characters, such as a node
+				# address or a message type in the JSON.
+				# Without token positions (detail=none) it's
+				# about a third of the size and LIKE still
+				# checks the candidate rows' text.
+				self.cur.execute('CREATE VIRTUAL TABLE ' +
+						'console_fts USING fts5(line, ' +
+						'content=\'console\', ' +
+						'content_rowid=\'id\', ' +
+						'tokenize=\'trigram\', ' +
+						'detail=none)')
+				self.cur.execute('INSERT INTO console_fts ' +
+						'(console_fts) VALUES ' +
+						'(\'rebuild\')')
+				self.commit_written()
+			self.console_search = True
+		except sqlite3.OperationalError as e:
+			self.conn.rollback()
+			sensorino.log_warn('No console search index: ' + str(e))
+			self.console_search = False
+
+	def setup_channels(self):
+		# Every path ever seen gets a small integer id and the rest
+		# of the tables refer to the path by that id
+		self.cur.execute('CREATE TABLE channels (' +
+				'id INTEGER PRIMARY KEY, ' +
+				'node_addr BLOB, ' + # NONE affinity
+				'svc_id INT, ' +
+				'datatype INT, ' + # int ID if type is known
+				'chan_id INT)')
+		self.cur.execute('CREATE UNIQUE INDEX channels_addr ' +
+				'ON channels (node_addr, svc_id, datatype, ' +
+				'chan_id)')
+
+	def load_channels(self):
+		self.channels = {}
+		self.channel_paths = {}
+		self.next_channel = 1
+
+		try:
+			self.cur.execute('SELECT id, node_addr, svc_id, ' +
+					'datatype, chan_id FROM channels')
+		except sqlite3.OperationalError:
+			# Not created yet, see migrate_channels()
+			return
+
+		for row in self.cur.fetchall():
+			self.channels[row[1:]] = row[0]
+			self.channel_paths[row[0]] = row[1:]
+		self.next_channel = max(self.channel_paths.keys() + [ 0 ]) + 1
+
+	def channel_id(self, params, create=False):
+		'''Look up the id of the path given as a path_to_params()
+		tuple.  Unless create is set, None is returned for paths
+		never seen before.'''
+
+		if params in self.channels or not create:
+			return self.channels.get(params)
+
+		# Allocate here and INSERT with the rest of the queued rows
+		chan = self.next_channel
+		self.next_channel += 1
+		self.channels[params] = chan
+		self.channel_paths[chan] = params
+		self.pending_channels.append(( chan, ) + params)
+
+		return chan
+
+	def chan_rows_to_tree(self, rows):
+		return rows_to_tree([ self.channel_paths[chan] + ( value, )
+			for chan, value in rows ])
+
+	def chan_path(self, chan):
+		'''The path of the channel, as in the state tree.'''
+
+		node_addr, svc_id, datatype, chan_id = self.channel_paths[chan]
+		path = [ node_addr, svc_id ]
+		if datatype is not None:
+			path.append(sqlite_to_datatype(datatype))
+			if chan_id is not None:
+				path.append(chan_id)
+		return path
+
+	def export_chans(self, paths):
+		'''Channel ids for export_values(), None for all.'''
+
+		if paths is None:
+			return None
+		return [ chan for chan in [ self.channel_id(path_to_params(path))
+			for path in paths ] if chan is not None ]
+
+	def match_chans(self, paths):
+		'''Ids of the channels at or under any of the paths, which
+		may be prefixes of a channel's path, or None for all.'''
+
+		if paths is None:
+			return None
+
+		prefixes = set()
+		for path in paths:
+			prefix = tuple(path[:2])
+			if len(path) >= 3:
+				prefix += ( datatype_to_sqlite(path[2]), ) + \
+					tuple(path[3:4])
+			prefixes.add(prefix)
+
+		return [ chan for chan, params in self.channel_paths.items()
+			if any([ params[:len(prefix)] == prefix
+				for prefix in prefixes ]) ]
+
+	def setup_sensorino(self, schema='main'):
+		self.cur.execute('CREATE TABLE ' + schema + '.sensorino (' +
+				'timestamp INT, ' + # millisec resolution
+				'chan INT, ' + # channels.id
+				'value BLOB)') # NONE affinity
+
+		if not self.defer_indexes:
+			self.setup_sensorino_indexes(schema)
+
+	def setup_sensorino_indexes(self, schema='main'):
+		# For the per-channel queries, walks each channel's rows
+		# in timestamp order
+		self.cur.execute('CREATE INDEX IF NOT EXISTS ' + schema +
+				'.sensorino_chan_time ' +
+				'ON sensorino (chan, timestamp)')
+		# For the queries on all channels within a time range
+		self.cur.execute('CREATE INDEX IF NOT EXISTS ' + schema +
+				'.sensorino_time ' +
+				'ON sensorino (timestamp DESC, chan)')
+
+	def setup_shards(self):
+		# History files holding the sensorino rows from [start, stop),
+		# see history_shards()
+		self.cur.execute('CREATE TABLE shards (' +
+				'start INT, ' + # millisec resolution
+				'stop INT, ' +
+				'file TEXT, ' + # relative to the main file
+				'sealed BOOL)')
+
+	def load_shards(self):
+		self.shards = [ list(row) for row in self.cur.execute(
+			'SELECT start, stop, file, sealed FROM shards ' +
+			'ORDER BY start') ]
+
+	def history_shards(self, t0, t1):
+		'''Return the shards whose rows may fall within [t0, t1),
+		in ascending time order.  None stands for the sensorino
+		table in the main file, which holds everything older than
+		the first shard, and for an unbounded side of the range.'''
+
+		shards = []
+		if self.main_last is not None and \
+				(t0 is None or t0 <= self.main_last):
+			shards.append(None)
+		for shard in self.shards:
+			if (t0 is None or shard[1] > t0) and \
+					(t1 is None or shard[0] < t1):
+				shards.append(shard)
+		return shards
+
+	def shard_schema(self, shard):
+		return 'shard_' + str(shard[0])
+
+	def history_table(self, conn, shard, keep=()):
+		'''Return the name of the sensorino table of the shard,
+		attaching the shard file to conn if needed.  The schemas in
+		keep, of the other shards in use, aren't detached to make
+		room.'''
+
+		if shard is None:
+			return 'sensorino'
+
+		schema = self.shard_schema(shard)
+		attached = self.attached.setdefault(conn, [])
+		if schema in attached:
+			attached.remove(schema)
+		else:
+			# ATTACH and DETACH commit the open transaction, do
+			# it here so that the queues are kept in step
+			if conn is self.conn:
+				self.commit_written()
+
+			# Detach the least recently used shard above the limit
+			if len(attached) >= self.max_attached:
+				old = [ name for name in attached
+					if name not in keep ][0]
+				attached.remove(old)
+				conn.execute('DETACH ' + old)
+			conn.execute('ATTACH ? AS ' + schema, ( os.path.join(
+				os.path.dirname(self.name), shard[2]), ))
+			conn.execute('PRAGMA ' + schema + '.synchronous = NORMAL')
+		attached.append(schema)
+
+		return schema + '.sensorino'
+
+	def detach_shard(self, shard):
+		schema = self.shard_schema(shard)
+		for conn, attached in self.attached.items():
+			if schema in attached:
+				if conn is self.conn:
+					self.commit_written()
+				attached.remove(schema)
+				conn.execute('DETACH ' + schema)
+
+	def attach_for_write(self, rows):
+		'''Attach the shards that the ( timestamp, chan, value ) rows
+		at the start of the list go in, for as many rows as all
+		their shards can be attached at once, and return the number
+		of those rows.  Called before the rows are written so that
+		no ATTACH commits the transaction halfway through.'''
+
+		shards = {}
+		count = 0
+		for row in rows:
+			shard = self.shard_for_write(row[0])
+			if shard and shard[0] not in shards:
+				if len(shards) >= self.max_attached:
+					break
+				shards[shard[0]] = shard
+			count += 1
+
+		keep = [ self.shard_schema(shard) for shard in shards.values() ]
+		for shard in shards.values():
+			self.history_table(self.conn, shard, keep)
+		return count
+
+	def shard_for_write(self, timestamp):
+		'''Find or create the shard a new value with the given
+		timestamp goes in.  Returns False if that shard has been
+		sealed already.'''
+
+		# Anything older than the first shard goes in the main file
+		if not self.shards:
+			if not self.shard_months or (self.main_last is not None
+					and timestamp <= self.main_last):
+				return None
+		elif timestamp < self.shards[0][0]:
+			return None
+
+		prev_end = None
+		if self.main_last is not None:
+			prev_end = self.main_last + 1
+		next_start = None
+		for shard in self.shards:
+			if timestamp >= shard[1]:
+				prev_end = shard[1]
+				continue
+			if timestamp < shard[0]:
+				next_start = shard[0]
+				break
+			return not shard[3] and shard
+
+		# Periods start on the first day of a month, UTC.  If the
+		# setting is removed after shards have been created new
+		# shards are still needed, make them monthly.
+		months = self.shard_months or 1
+		t = time.gmtime(timestamp / 1000)
+		month = (t.tm_year * 12 + t.tm_mon - 1) // months * months
+		start = calendar.timegm(( month // 12, month % 12 + 1, 1,
+			0, 0, 0 )) * 1000
+		month += months
+		end = calendar.timegm(( month // 12, month % 12 + 1, 1,
+			0, 0, 0 )) * 1000
+
+		# Don't overlap the neighbours or the main file
+		if prev_end is not None:
+			start = max(start, prev_end)
+		if next_start is not None:
+			end = min(end, next_start)
+
+		return self.create_shard(start, end)
+
+	def create_shard(self, start, end):
+		name = os.path.splitext(os.path.basename(self.name))[0]
+		shard = [ start, end, name + time.strftime('-%Y-%m.db',
+			time.gmtime(start / 1000)), False ]
+
+		# ATTACH and the DDL commit the current transaction
+		table = self.history_table(self.conn, shard)
+		schema = table.split('.')[0]
+		self.cur.execute('PRAGMA ' + schema + '.journal_mode = WAL')
+		self.setup_sensorino(schema)
+		self.cur.execute('INSERT INTO shards VALUES ( ?, ?, ?, 0 )',
+				shard[0:3])
+		self.commit_written()
+
+		self.shards.append(shard)
+		self.shards.sort()
+
+		# The older shards are sealed later by seal_shards(), not
+		# here while rows for them may still be queued
+		return shard
+
+	def seal_shards(self, limit=None):
+		'''Seal up to limit of the shards that no longer receive
+		writes, all by default.  Returns the number of those left
+		unsealed.'''
+
+		# Keep the two newest shards writable, values can arrive a
+		# little late and Set requests can be marked failed after
+		# the period has ended
+		old = [ shard for shard in self.shards[:-2] if not shard[3] ]
+		if not old:
+			return 0
+
+		# Rows for these may be queued
+		self.flush()
+
+		if limit is not None:
+			old = old[:limit]
+		for shard in old:
+			self.seal_shard(shard)
+
+		return len([ shard for shard in self.shards[:-2]
+			if not shard[3] ])
+
+	def seal_shard(self, shard):
+		'''Make a shard that receives no more writes compact and
+		read-only, after this it can be kept on a slower or
+		read-only medium.  Runs a VACUUM so it may take a while for
+		a big shard.'''
+
+		path = os.path.join(os.path.dirname(self.name), shard[2])
+
+		# Only one connection may have the file open to leave WAL
+		self.detach_shard(shard)
+		schema = self.history_table(self.conn, shard).split('.')[0]
+		try:
+			self.cur.execute('PRAGMA ' + schema +
+					'.journal_mode = DELETE')
+			self.cur.execute('VACUUM ' + schema)
+		except Exception as e:
+			sensorino.log_warn('Could not compact ' + shard[2] +
+					': ' + str(e))
+		self.detach_shard(shard)
+		os.chmod(path, 0444)
+
+		self.cur.execute('UPDATE shards SET sealed = 1 ' +
+				'WHERE start = ?', ( shard[0], ))
+		self.commit_written()
+		shard[3] = True
+
+	def drop_shard(self, shard):
+		'''Delete the shard and its file.  Returns the number of
+		rows it had.'''
+
+		table = self.history_table(self.conn, shard)
+		self.cur.execute('SELECT COUNT(*) FROM ' + table)
+		count = self.cur.fetchone()[0]
+		self.detach_shard(shard)
+
+		self.cur.execute('DELETE FROM shards WHERE start = ?',
+				( shard[0], ))
+		self.commit_written()
+		self.shards.remove(shard)
+
+		path = os.path.join(os.path.dirname(self.name), shard[2])
+		for suffix in [ '', '-wal', '-shm' ]:
+			if os.path.exists(path + suffix):
+				os.remove(path + suffix)
+
+		return count
+
+	def setup_latest(self):
+		# The last confirmed value of each channel, so that the
+		# current state can be loaded without looking at the
+		# history.  Updated together with the sensorino table.
+		self.cur.execute('CREATE TABLE sensorino_latest (' +
+				'chan INTEGER PRIMARY KEY, ' +
+				'timestamp INT, ' +
+				'value BLOB)')
+
+	def rebuild_latest(self):
+		self.cur.execute('DELETE FROM sensorino_latest')
+
+		# SQLite takes the bare columns from the row that has the
+		# MAX(timestamp).  Newer shards replace the older values.
+		for shard in self.history_shards(None, None):
+			self.cur.execute('INSERT OR REPLACE INTO sensorino_latest ' +
+					'SELECT chan, MAX(timestamp), value ' +
+					'FROM ' + self.history_table(self.conn, shard) +
+					' GROUP BY chan')
+
+	def setup_auto_vacuum(self):
+		self.cur.execute('PRAGMA auto_vacuum')
+		if self.cur.fetchone()[0] == 2:
+			return
+
+		# Databases created before auto_vacuum was enabled need a
+		# full VACUUM for the setting to take effect.  This needs
+		# as much free space as the database takes, if it fails
+		# freed pages are still reused, only not returned.
+		self.commit_written()
+		try:
+			self.cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+			self.cur.execute('VACUUM')
+		except Exception as e:
+			sensorino.log_warn('Could not enable auto_vacuum: ' +
+					str(e))
+
+	def setup_snapshot(self):
+		# Full trees as of given timestamps, as zlib-compressed JSON
+		# lists of [ chan, value ] pairs
+		self.cur.execute('CREATE TABLE snapshot (' +
+				'timestamp INT, ' + # millisec resolution
+				'tree BLOB)')
+		self.cur.execute('CREATE INDEX snapshot_time ON snapshot ' +
+				'(timestamp DESC)')
+
+	def load_snapshot_info(self):
+		self.cur.execute('SELECT MAX(timestamp) FROM snapshot')
+		self.snapshot_last = self.cur.fetchone()[0]
+		self.snapshot_count = 0
+		self.last_value_timestamp = None
+
+	def snapshot_due(self, timestamp):
+		return self.snapshot_last is None or \
+			self.snapshot_count >= self.snapshot_changes or \
+			timestamp - self.snapshot_last >= \
+				self.snapshot_interval * 1000
+
+	def save_snapshot(self, timestamp, rows):
+		tree = json.dumps([ ( chan, sqlite_to_value(value) )
+				for chan, value in rows ])
+		self.conn.execute('INSERT INTO snapshot VALUES ( ?, ? )',
+				( timestamp, buffer(zlib.compress(tree)) ))
+
+		self.snapshot_last = timestamp
+		self.snapshot_count = 0
+
+	def take_snapshot(self):
+		query = 'SELECT chan, value FROM sensorino_latest'
+		rows = self.cur.execute(query).fetchall()
+
+		self.save_snapshot(self.last_value_timestamp, rows)
+
+	def rebuild_snapshots(self):
+		'''Regenerate all of the snapshots from the history in one
+		pass.'''
+
+		self.cur.execute('DELETE FROM snapshot')
+		self.snapshot_last = None
+		self.snapshot_count = 0
+
+		values = {}
+		prev = None
+		for shard in self.history_shards(None, None):
+			query = 'SELECT timestamp, chan, value FROM ' + \
+				self.history_table(self.conn, shard) + \
+				' ORDER BY timestamp'
+
+			for timestamp, chan, value in \
+					self.cur.execute(query).fetchall():
+				# Only snapshot once all the changes sharing a
+				# timestamp are included
+				if prev is not None and timestamp != prev and \
+						self.snapshot_due(prev):
+					self.save_snapshot(prev, values.items())
+
+				values[chan] = value
+				self.snapshot_count += 1
+				prev = timestamp
+
+	def patch_snapshots(self, rows):
+		'''Add the ( timestamp, chan, value ) rows, already in the
+		history, to the snapshots taken since each row's timestamp
+		and before the channel's next change.  take_snapshot() runs
+		ahead of the values written later with older timestamps,
+		such as a Set confirmed late, and the snapshots are only
+		ever replayed forward.'''
+
+		written = self.pending_values[:self.written['values']]
+		trees = {}
+		for timestamp, chan, value in rows:
+			query = 'SELECT rowid, tree FROM snapshot ' + \
+				'WHERE timestamp >= ?'
+			params = ( timestamp, )
+			stops = [ row[0] for row in written
+				if row[1] == chan and row[0] > timestamp ]
+			stop = self.next_change(chan, timestamp)
+			if stop is not None:
+				stops.append(stop)
+			if stops:
+				query += ' AND timestamp < ?'
+				params += ( min(stops), )
+
+			for rowid, tree in self.cur.execute(query,
+					params).fetchall():
+				if rowid not in trees:
+					trees[rowid] = dict(json.loads(
+						zlib.decompress(tree)))
+				trees[rowid][chan] = value
+
+		self.cur.executemany('UPDATE snapshot SET tree = ? ' +
+				'WHERE rowid = ?', [ ( buffer(zlib.compress(
+					json.dumps(tree.items()))), rowid )
+				for rowid, tree in trees.items() ])
+
+	def next_change(self, chan, timestamp):
+		'''Return the timestamp of the channel's first value after
+		timestamp in the committed history, or None.  Looked up
+		through the read connection so that no shard is attached to
+		the writer in the middle of write_pending().'''
+
+		for shard in self.history_shards(timestamp + 1, None):
+			self.rcur.execute('SELECT MIN(timestamp) FROM ' +
+					self.history_table(self.rconn, shard) +
+					' WHERE chan = ? AND timestamp > ?',
+					( chan, timestamp ))
+			stop = self.rcur.fetchone()[0]
+			if stop is not None:
+				return stop
+		return None
+
+	def setup_floorplan(self):
+		# Full copies of floorplan versions, each stored once
+		# however many versions have the same content
+		self.cur.execute('CREATE TABLE floorplan_doc (' +
+				'hash TEXT PRIMARY KEY, ' + # SHA-1 of data
+				'data TEXT)') # canonical JSON
+
+		# Every version saved is the full copy with the given hash
+		# and, unless NULL, a JSON patch applied to it
 		self.cur.execute('CREATE TABLE floorplan (' +
 				'timestamp INT, ' + # millisec resolution
-				'version TEXT)')
+				'hash TEXT, ' + # of the version, once patched
+				'base TEXT, ' + # floorplan_doc.hash
+				'patch TEXT)')
 		self.cur.execute('CREATE INDEX floorplan_time ON floorplan ' +
 				'(timestamp DESC)')
 
-		self.conn.commit()
+	def load_floorplan_info(self):
+		self.cur.execute('SELECT hash, base FROM floorplan ' +
+				'ORDER BY timestamp DESC LIMIT 1')
+		row = self.cur.fetchone()
+		self.floorplan_last = None
+		self.floorplan_base = None
+		if row is not None:
+			self.floorplan_last = row[0]
+			self.floorplan_base = ( row[1],
+				json.loads(self.load_floorplan_doc(self.cur,
+					row[1])) )
+
+	def load_floorplan_doc(self, cur, digest):
+		cur.execute('SELECT data FROM floorplan_doc WHERE hash = ?',
+				( digest, ))
+		return cur.fetchone()[0]
+
+	def store_floorplan(self, timestamp, data):
+		obj = json.loads(data)
+		data = jsondiff.canonical(obj)
+		digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+		# Saved again without changes
+		if digest == self.floorplan_last:
+			return
+		self.floorplan_last = digest
+
+		# Same as an earlier full copy, e.g. after an undo
+		self.cur.execute('SELECT 1 FROM floorplan_doc WHERE hash = ?',
+				( digest, ))
+		if self.cur.fetchone() is not None:
+			self.cur.execute('INSERT INTO floorplan VALUES ' +
+					'( ?, ?, ?, NULL )',
+					( timestamp, digest, digest ))
+			return
+
+		if self.floorplan_base is not None:
+			patch = jsondiff.canonical(jsondiff.diff(
+				self.floorplan_base[1], obj))
+			if len(patch) <= len(data) * self.floorplan_patch_ratio:
+				self.cur.execute('INSERT INTO floorplan ' +
+						'VALUES ( ?, ?, ?, ? )',
+						( timestamp, digest,
+						self.floorplan_base[0], patch ))
+				return
+
+		self.cur.execute('INSERT INTO floorplan_doc VALUES ( ?, ? )',
+				( digest, data ))
+		self.cur.execute('INSERT INTO floorplan VALUES ' +
+				'( ?, ?, ?, NULL )', ( timestamp, digest, digest ))
+		self.floorplan_base = ( digest, obj )
+
+	def setup_rollup(self):
+		# Per-channel aggregates of numeric values over the periods
+		# starting at timestamp, one set for each of rollup_periods
+		self.cur.execute('CREATE TABLE rollup (' +
+				'chan INT, ' +
+				'period INT, ' + # seconds
+				'timestamp INT, ' + # millisec resolution
+				'min REAL, ' +
+				'max REAL, ' +
+				'sum REAL, ' +
+				'count INT)')
+		self.cur.execute('CREATE UNIQUE INDEX rollup_chan ON rollup ' +
+				'(chan, period, timestamp)')
+		self.cur.execute('CREATE INDEX rollup_time ON rollup ' +
+				'(period, timestamp)')
+
+	def rebuild_rollups(self):
+		'''Regenerate all of the rollups from the history.'''
+
+		self.cur.execute('DELETE FROM rollup')
+
+		# Shards start on month boundaries except the first one,
+		# whose buckets may span the main file too
+		shards = self.history_shards(None, None)
+		groups = [ [ shard ] for shard in shards ]
+		if len(shards) > 1 and shards[0] is None:
+			groups[0:2] = [ shards[0:2] ]
+
+		for group in groups:
+			history = self.history_union(self.conn, group)
+
+			for name, period in self.rollup_periods:
+				ms = period * 1000
+				self.cur.execute('INSERT INTO rollup ' +
+					'SELECT chan, ?, ' +
+					'timestamp - timestamp % ?, ' +
+					'MIN(value), MAX(value), SUM(value), ' +
+					'COUNT(*) FROM ' + history + ' WHERE ' +
+					'chan IN (SELECT id FROM ' +
+					'channels WHERE chan_id IS NOT NULL) ' +
+					'AND ' + numeric_cond + ' GROUP BY ' +
+					'chan, timestamp - timestamp % ?',
+					( period, ms, ms ))
+
+	def history_union(self, conn, shards):
+		'''Return a FROM clause covering the sensorino tables of
+		all of the shards given.'''
+
+		keep = [ self.shard_schema(shard) for shard in shards if shard ]
+		tables = [ self.history_table(conn, shard, keep)
+			for shard in shards ]
+		if len(tables) == 1:
+			return tables[0]
+
+		return '(' + ' UNION ALL '.join([ 'SELECT timestamp, chan, ' +
+			'value FROM ' + table for table in tables ]) + ')'
+
+	def update_rollups(self, rows):
+		# Aggregate the new rows in memory first, then merge into
+		# the stored aggregates with one statement per bucket
+		buckets = {}
+		for timestamp, chan, value in rows:
+			if self.channel_paths[chan][3] is None or \
+					not is_numeric(value):
+				continue
+
+			for name, period in self.rollup_periods:
+				ms = period * 1000
+				key = ( chan, period, timestamp - timestamp % ms )
+				if key not in buckets:
+					buckets[key] = ( value, value, value, 1 )
+					continue
+				mn, mx, sm, cnt = buckets[key]
+				buckets[key] = ( min(mn, value), max(mx, value),
+						sm + value, cnt + 1 )
+
+		for key, agg in buckets.items():
+			self.cur.execute('UPDATE rollup SET ' +
+					'min = MIN(min, ?), max = MAX(max, ?), ' +
+					'sum = sum + ?, count = count + ? ' +
+					'WHERE chan = ? AND period = ? AND ' +
+					'timestamp = ?', agg + key)
+			if self.cur.rowcount == 0:
+				self.cur.execute('INSERT INTO rollup VALUES ' +
+						'( ?, ?, ?, ?, ?, ?, ? )',
+						key + agg)
 
 	def get_value_at_timestamp(self, path, timestamp):
-		# Add the path elements to query parameters
-		params = [ path[0], path[1], None, None ]
-		if len(path) >= 3:
-			params[2] = datatype_to_sqlite(path[2])
-		if len(path) >= 4:
-			params[3] = path[3]
-
-		# Get the value of last change preceding the timestamp
-		if timestamp is not None:
-			time_cond = ' AND timestamp <= ?'
-			params += [ int(timestamp * 1000) ]
-		else:
-			time_cond = ''
+		self.catch_up()
 
-		# Note: IS is a = that treats two NULLs equal
-		query = 'SELECT value FROM sensorino WHERE ' + \
-			'node_addr IS ? AND ' + \
-			'svc_id IS ? AND ' + \
-			'datatype IS ? AND ' + \
-			'chan_id IS ? AND ' + \
-			'success' + time_cond + \
-			' ORDER BY timestamp DESC LIMIT 1'
+		chan = self.channel_id(path_to_params(path))
+		if chan is None:
+			return None
 
-		result = self.cur.execute(query, tuple(params))
+		if timestamp is None:
+			self.rcur.execute(latest_sql, ( chan, ))
+			val = self.rcur.fetchone()
+		else:
+			# Get the value of last change preceding the
+			# timestamp, starting with the newest shard
+			timestamp = int(timestamp * 1000)
+			val = None
+			for shard in self.history_shards(None, timestamp + 1)[::-1]:
+				query = value_at_sql.format(table =
+					self.history_table(self.rconn, shard))
+				self.rcur.execute(query, ( chan, timestamp ))
+				val = self.rcur.fetchone()
+				if val is not None:
+					break
+			else:
+				return self.snapshot_value(chan, timestamp)
 
-		val = self.cur.fetchone()
 		if val is None:
 			return None
 		return sqlite_to_value(val[0])
 
+	def snapshot_value(self, chan, timestamp):
+		'''Return the channel's value in the newest snapshot at or
+		before timestamp, or None.  For channels with no change
+		left in the history before timestamp, the changes older than
+		the oldest snapshot may have expired, see expire_values().'''
+
+		self.rcur.execute(snapshot_at_sql, ( timestamp, ))
+		snapshot = self.rcur.fetchone()
+		if snapshot is None:
+			return None
+		return dict(json.loads(zlib.decompress(snapshot[1]))).get(chan)
+
 	def get_tree_at_timestamp(self, timestamp):
-		params = ()
+		self.catch_up()
 
-		# Get the value of last change preceding the timestamp
-		if timestamp is not None:
-			time_cond = ' AND timestamp <= ?'
-			timestamp = int(timestamp * 1000)
-			params += ( timestamp, timestamp )
-		else:
-			time_cond = ''
+		if timestamp is None:
+			return self.get_tree_current()
+
+		timestamp = int(timestamp * 1000)
+
+		self.rcur.execute(snapshot_before_sql, ( timestamp, ))
+		since = self.rcur.fetchone()[0]
+		if since is None:
+			return self.read_tree_without_snapshot(timestamp)
+
+		# Shards can't be attached within a transaction
+		shards = self.history_shards(since + 1, timestamp + 1)
+		if len(shards) > self.max_attached:
+			return self.read_tree_without_snapshot(timestamp)
+		keep = [ self.shard_schema(shard) for shard in shards if shard ]
+		tables = [ self.history_table(self.rconn, shard, keep)
+			for shard in shards ]
+
+		# The snapshot and the changes after it must come from the
+		# same version of the database
+		self.rcur.execute('BEGIN')
+		try:
+			self.rcur.execute('SELECT tree FROM snapshot ' +
+					'WHERE timestamp = ?', ( since, ))
+			snapshot = self.rcur.fetchone()
+
+			# Start with the nearest earlier snapshot and replay
+			# only the changes since
+			values = None
+			if snapshot is not None:
+				values = dict(json.loads(
+					zlib.decompress(snapshot[0])))
+				for table in tables:
+					query = tree_since_snapshot_sql. \
+						format(table = table)
+					for chan, value in self.rcur.execute(
+							query, ( since, timestamp )):
+						values[chan] = value
+		finally:
+			self.rcur.execute('COMMIT')
+
+		# Dropped by another writer in the meantime
+		if values is None:
+			return self.read_tree_without_snapshot(timestamp)
 
-		# Note: IS is a = that treats two NULLs equal
-		query = 'SELECT path.*, (SELECT value FROM sensorino WHERE ' + \
-				'node_addr IS path.node_addr AND ' + \
-				'svc_id IS path.svc_id AND ' + \
-				'datatype IS path.datatype AND ' + \
-				'chan_id IS path.chan_id AND ' + \
-				'success' + time_cond + \
-				' ORDER BY timestamp DESC LIMIT 1) ' + \
-			'FROM (SELECT DISTINCT node_addr, svc_id, ' + \
-				'datatype, chan_id FROM sensorino WHERE ' + \
-				'success' + time_cond + ') AS path'
-
-		results = self.cur.execute(query, params)
-
-		tree = {}
-		for node_addr, svc_id, datatype, chan_id, value in results:
-			state = tree
-			path = ( node_addr, svc_id )
-			if datatype is not None:
-				path += ( sqlite_to_datatype(datatype), )
-				if chan_id is not None:
-					path += ( chan_id, )
-
-			tree_insert_value(tree, path, sqlite_to_value(value))
-
-		return tree
+		return self.chan_rows_to_tree(values.items())
+
+	def read_tree_without_snapshot(self, timestamp):
+		shards = self.history_shards(None, timestamp + 1)[::-1]
+		tables = ( self.history_table(self.rconn, shard)
+			for shard in shards )
+
+		return self.chan_rows_to_tree(self.read_values_without_snapshot(
+			timestamp, tables).items())
+
+	def read_values_without_snapshot(self, timestamp, tables):
+		# Get the value of last change preceding the timestamp for
+		# every channel, going from the newest table to the oldest
+		# until all channels are found
+		values = {}
+		for table in tables:
+			query = values_without_snapshot_sql.format(table = table)
+
+			for chan, value in self.rcur.execute(query,
+					( timestamp, )).fetchall():
+				if chan not in values:
+					values[chan] = value
+			if len(values) >= len(self.channel_paths):
+				break
+
+		return values
 
 	def get_value_current(self, path):
 		return self.get_value_at_timestamp(path, None)
 
 	def get_tree_current(self):
-		return self.get_tree_at_timestamp(None)
+		self.catch_up()
+
+		query = 'SELECT chan, value FROM sensorino_latest'
+
+		return self.chan_rows_to_tree(self.rcur.execute(query))
 
 	def get_values_within_period(self, path, t0, t1):
-		# Note: IS is a = that treats two NULLs equal
-		query = 'SELECT timestamp, value FROM sensorino WHERE ' + \
-			'timestamp >= ? AND timestamp < ? AND ' + \
-			'node_addr IS ? AND ' + \
-			'svc_id IS ? AND ' + \
-			'datatype IS ? AND ' + \
-			'chan_id IS ? AND ' + \
-			'success ORDER BY timestamp DESC LIMIT 1024'
-
-		params = [
-			int(t0 * 1000), int(t1 * 1000),
-			path[0], path[1], None, None ]
-
-		if len(path) >= 3:
-			params[4] = datatype_to_sqlite(path[2])
-		if len(path) >= 4:
-			params[5] = path[3]
+		'''Return the newest max_values ( timestamp, value ) tuples
+		from [t0, t1) in ascending order.'''
+
+		self.catch_up()
+
+		chan = self.channel_id(path_to_params(path))
+		if chan is None:
+			return []
+
+		t0 = int(t0 * 1000)
+		t1 = int(t1 * 1000)
+
+		# Newest shard first, stop once there are enough values
+		values = []
+		for shard in self.history_shards(t0, t1)[::-1]:
+			query = values_within_sql.format(table =
+				self.history_table(self.rconn, shard))
+
+			values += self.rcur.execute(query, ( chan, t0, t1,
+				self.max_values - len(values) )).fetchall()
+			if len(values) >= self.max_values:
+				break
 
 		return [ ( 0.001 * timestamp, sqlite_to_value(value) ) for \
-			timestamp, value in \
-			self.cur.execute(query, tuple(params)) ][::-1]
+			timestamp, value in values[::-1] ]
+
+	def get_values_page(self, path, t0, t1, limit, cursor=None):
+		'''Return up to limit ( timestamp, value ) tuples from
+		[t0, t1) in ascending order, starting after the cursor
+		if given, and the cursor for the next page or None if
+		there are no more values.'''
+
+		self.catch_up()
+
+		chan = self.channel_id(path_to_params(path))
+		if chan is None:
+			return [], None
+
+		t0 = int(t0 * 1000)
+		start = t0
+		if cursor is not None:
+			start = max(t0, cursor[0])
+
+		# The shards don't overlap so a ( timestamp, rowid ) cursor
+		# identifies the shard too
+		values = []
+		for shard in self.history_shards(start, int(t1 * 1000)):
+			page, next_cursor = self.get_page(
+					values_page_sql.format(table =
+					self.history_table(self.rconn, shard)),
+					( chan, ),
+					t0, t1, limit - len(values), cursor,
+					lambda row: ( 0.001 * row[1],
+						sqlite_to_value(row[2]) ))
+			values += page
+			if next_cursor is not None:
+				return values, next_cursor
+
+		return values, None
+
+	def get_rollups_within_period(self, path, t0, t1, period):
+		'''Return the newest max_values ( timestamp, avg, min, max,
+		count ) tuples for the period-long buckets overlapping
+		[t0, t1), in ascending order.'''
+
+		self.catch_up()
+
+		chan = self.channel_id(path_to_params(path))
+		if chan is None:
+			return []
+
+		query = 'SELECT * FROM (' + rollups_within_sql + ') ' + \
+			'ORDER BY timestamp'
+
+		ms = period * 1000
+		t0 = int(t0 * 1000)
+		params = ( chan, period, t0 - t0 % ms, int(t1 * 1000),
+			self.max_values )
+
+		return [ ( 0.001 * row[0], ) + row[1:] for row in
+			self.rcur.execute(query, params) ]
+
+	def get_rollups_page(self, path, t0, t1, period, limit, cursor=None):
+		'''Like get_values_page() for the rollups of given period.'''
+
+		self.catch_up()
+
+		chan = self.channel_id(path_to_params(path))
+		if chan is None:
+			return [], None
+
+		ms = period * 1000
+		t0 = int(t0 * 1000)
+		return self.get_page(rollups_page_sql,
+				( chan, period ), t0 - t0 % ms, t1,
+				limit, cursor,
+				lambda row: ( 0.001 * row[1], ) + row[2:])
+
+	def get_series_within_period(self, paths, t0, t1, period=None):
+		'''For each path return the value at t0, as from
+		get_value_at_timestamp(), and the values within [t0, t1), as
+		from get_values_within_period(), or the rollups as from
+		get_rollups_within_period() if period is given.  Returns
+		a ( value, values ) pair, or None if there's neither, per
+		path.'''
+
+		# One query per channel and kind: SQLite runs in-process so
+		# the statements are only seeks on the same indexes.  A
+		# compound SELECT of all of them was measured slower.
+		result = []
+		for path in paths:
+			value = self.get_value_at_timestamp(path, t0)
+			if period is None:
+				values = self.get_values_within_period(path,
+						t0, t1)
+			else:
+				values = self.get_rollups_within_period(path,
+						t0, t1, period)
+
+			if value is None and not values:
+				result.append(None)
+			else:
+				result.append(( value, values ))
+		return result
+
+	def get_event_counts(self, paths, t0, t1, buckets):
+		'''Split [t0, t1) into buckets periods of equal length and
+		return the number of values saved within each, counting
+		only the channels under paths, see match_chans().'''
+
+		self.catch_up()
+
+		counts = [ 0 ] * buckets
+		chans = self.match_chans(paths)
+		if chans == []:
+			return counts
+
+		if chans is None:
+			cond = ''
+		elif len(chans) == 1:
+			cond = 'chan = ' + str(chans[0]) + ' AND '
+		else:
+			cond = 'chan IN (' + \
+				', '.join([ str(chan) for chan in chans ]) + \
+				') AND '
+
+		# Both indexes cover ( chan, timestamp ) so the rows
+		# themselves are never read.  The rollups would be cheaper
+		# still but only count the numeric values.
+		t0 = int(t0 * 1000)
+		t1 = int(t1 * 1000)
+		for shard in self.history_shards(t0, t1):
+			query = event_counts_sql.format(table =
+				self.history_table(self.rconn, shard),
+				cond = cond)
+
+			for bucket, count in self.rcur.execute(query,
+					( t0, buckets, t1 - t0, t0, t1 )):
+				counts[bucket] += count
+
+		return counts
+
+	def get_page(self, select, params, t0, t1, limit, cursor, conv):
+		# Keyset pagination: the cursor is the ( timestamp, rowid )
+		# of the last row returned, rows are ordered the same way.
+		# The timestamp bound alone lets the index range scan start
+		# right at the cursor, the rowid skips the few rows already
+		# returned that share its timestamp.
+		if cursor is None:
+			cursor = ( t0, 0 )
+		query = page_sql.format(select = select)
+		params = tuple(params) + ( max(t0, cursor[0]),
+				int(t1 * 1000) ) + tuple(cursor) + ( limit, )
+
+		rows = self.rcur.execute(query, params).fetchall()
+
+		next_cursor = None
+		if len(rows) == limit:
+			next_cursor = ( rows[-1][1], rows[-1][0] )
+		return [ conv(row) for row in rows ], next_cursor
+
+	def export_values(self, paths, t0=None, t1=None):
+		'''Yield ( timestamp, path, value ) for the values of the
+		channels given, or of all channels if paths is None, with
+		timestamps in [t0, t1) in ascending order.  None stands for
+		no bound.  Every export_batch rows are read by a separate
+		query, so any amount of history can be exported in constant
+		memory and other queries can run in between.'''
+
+		self.catch_up()
+
+		chans = self.export_chans(paths)
+		if chans == []:
+			return
+
+		if chans is None:
+			cond = '1'
+		elif len(chans) == 1:
+			cond = 'chan = ' + str(chans[0])
+		else:
+			# The unary + keeps the time index in use so that
+			# there's no sort of the whole range
+			cond = '+chan IN (' + \
+				', '.join([ str(chan) for chan in chans ]) + ')'
+
+		t0 = 0 if t0 is None else int(t0 * 1000)
+		if t1 is None:
+			t1 = 1 << 40
+
+		cursor = None
+		for shard in self.history_shards(t0, int(t1 * 1000)):
+			while True:
+				# Dropped by the retention engine meanwhile
+				if shard is not None and shard not in self.shards:
+					break
 
-	def save_value(self, timestamp, path, value):
-		query = 'INSERT INTO sensorino VALUES ( ?, ?, ?, ?, ?, ?, 1 )'
-		params = [ int(timestamp * 1000),
-			path[0], path[1], None, None,
-			value ]
+				page, cursor = self.get_page('SELECT rowid, ' +
+						'timestamp, chan, value FROM ' +
+						self.history_table(self.rconn,
+							shard) +
+						' WHERE ' + cond, (),
+						t0, t1, self.export_batch, cursor,
+						lambda row: ( 0.001 * row[1],
+							self.chan_path(row[2]),
+							sqlite_to_value(row[3]) ))
+				for row in page:
+					yield row
+				if cursor is None:
+					break
 
-		if len(path) >= 3:
-			params[3] = datatype_to_sqlite(path[2])
-		if len(path) >= 4:
-			params[4] = path[3]
+	def estimate_value_count(self, path, t0, t1):
+		'''Quick upper bound on the number of numeric values saved
+		for the path within [t0, t1), from the finest rollups that
+		need no more than max_values rows to cover the period.'''
 
-		params = tuple(params)
-		self.cur.execute(query, params)
+		self.catch_up()
 
-		# The return value to be used as parameter to a potential
-		# mark_saved_value_failure call
-		return params[0:5]
+		chan = self.channel_id(path_to_params(path))
+		if chan is None:
+			return 0
 
-	def mark_saved_value_failure(self, change):
-		# In the typical case a rollback would do, too
+		for name, period in self.rollup_periods:
+			if (t1 - t0) / period <= self.max_values:
+				break
 
-		query = 'UPDATE sensorino SET success = 0 WHERE ' + \
-			'timestamp IS ? AND node_addr IS ? AND ' + \
-			'svc_id IS ? AND datatype IS ? AND chan_id IS ?'
-		params = change
+		ms = period * 1000
+		t0 = int(t0 * 1000)
+		params = ( chan, period, t0 - t0 % ms, int(t1 * 1000) )
 
-		self.cur.execute(query, params)
+		self.rcur.execute('SELECT SUM(count) FROM rollup WHERE ' +
+				'chan = ? AND period = ? AND ' +
+				'timestamp >= ? AND timestamp < ?', params)
+		return self.rcur.fetchone()[0] or 0
+
+	def save_value(self, timestamp, path, value, provisional=False):
+		'''Queue a new value of a channel.  A provisional value is
+		kept aside until confirm_saved_values() or
+		discard_saved_values() is called with the reference
+		returned.'''
+
+		chan = self.channel_id(path_to_params(path), True)
+		params = ( int(timestamp * 1000), chan, value )
+		ref = self.next_ref
+		self.next_ref += 1
+
+		# Creating a new shard here rather than in write_pending()
+		# commits the transaction before any rows are inserted
+		if self.shard_for_write(params[0]) is False:
+			sensorino.log_warn('Dropping value for a sealed ' +
+					'period: ' + str(path))
+			return ref
+
+		if provisional:
+			self.provisional[ref] = params
+			self.pending_provisional.append(( ref, ) + params)
+		else:
+			self.pending_values.append(params)
+
+		return ref
+
+	def confirm_saved_values(self, refs):
+		for ref in refs:
+			params = self.provisional.pop(ref, None)
+			if params is None:
+				continue
+
+			self.pending_values.append(params)
+			self.pending_settled.append(( ref, ))
+
+	def discard_saved_values(self, refs):
+		for ref in refs:
+			if self.provisional.pop(ref, None) is not None:
+				self.pending_settled.append(( ref, ))
 
 	def get_console_at_timestamp(self, timestamp):
+		self.catch_up()
+
 		params = ()
 
 		# Get the last 64 lines preceding the timestamp
@@ -260,22 +1829,71 @@ class connection():
 		else:
 			time_cond = ''
 
-		query = 'SELECT timestamp, line FROM console ' + time_cond + \
-			'ORDER BY timestamp DESC LIMIT 64'
+		query = console_at_sql.format(cond = time_cond)
 
 		return [ ( 0.001 * timestamp, line ) for timestamp, line in
-			self.cur.execute(query, params) ][::-1]
+			self.rcur.execute(query, params) ][::-1]
 
 	def get_console_current(self):
 		return self.get_console_at_timestamp(None)
 
+	def search_console(self, text, t0, t1, limit, cursor=None):
+		'''Return up to limit ( timestamp, line ) pairs from
+		[t0, t1) where the line contains text, ignoring case, newest
+		first, and the cursor for the next page or None.  None
+		stands for no bound.  The cursor is the ( timestamp, id )
+		of the last line returned.'''
+
+		self.catch_up()
+
+		t0 = 0 if t0 is None else int(t0 * 1000)
+		t1 = 1 << 62 if t1 is None else int(t1 * 1000)
+
+		# Lines are logged in time order so the period maps to an
+		# id range, which is then read newest first only until the
+		# page is full
+		self.rcur.execute(console_first_sql, ( t0, ))
+		first = self.rcur.fetchone()[0]
+		self.rcur.execute(console_last_sql, ( t1, ))
+		last = self.rcur.fetchone()[0]
+		if first is None or last is None:
+			return [], None
+		if cursor is not None:
+			last = min(last, cursor[1] - 1)
+
+		# Text shorter than a trigram can't use the index, nor can
+		# a LIKE with an ESCAPE clause
+		if self.console_search and len(text) >= 3 and \
+				'%' not in text and '_' not in text:
+			query = 'SELECT c.id, c.timestamp, c.line ' + \
+				'FROM console_fts f JOIN console c ' + \
+				'ON c.id = f.rowid WHERE f.line LIKE ? ' + \
+				'AND f.rowid BETWEEN ? AND ? AND ' + \
+				'c.timestamp >= ? AND c.timestamp < ? ' + \
+				'ORDER BY f.rowid DESC LIMIT ?'
+			pattern = '%' + text + '%'
+		else:
+			query = console_scan_sql
+			pattern = '%' + text.replace('\\', '\\\\'). \
+				replace('%', '\\%').replace('_', '\\_') + '%'
+
+		rows = self.rcur.execute(query, ( pattern, first, last,
+			t0, t1, limit )).fetchall()
+
+		next_cursor = None
+		if len(rows) == limit:
+			next_cursor = ( rows[-1][1], rows[-1][0] )
+		return [ ( 0.001 * timestamp, line )
+			for line_id, timestamp, line in rows ], next_cursor
+
 	def save_console_line(self, timestamp, line):
-		query = 'INSERT INTO console VALUES ( ?, ? )'
 		params = ( int(timestamp * 1000), line )
 
-		self.cur.execute(query, params)
+		self.pending_console.append(params)
 
 	def get_floorplan_at_timestamp(self, timestamp):
+		self.catch_up()
+
 		params = ()
 
 		# Get the last floorplan version preceding the timestamp
@@ -285,24 +1903,811 @@ class connection():
 		else:
 			time_cond = ''
 
-		query = 'SELECT version FROM floorplan ' + time_cond + \
-			'ORDER BY timestamp DESC LIMIT 1'
+		query = floorplan_at_sql.format(cond = time_cond)
 
-		result = self.cur.execute(query, params)
+		result = self.rcur.execute(query, params)
 
-		val = self.cur.fetchone()
+		val = self.rcur.fetchone()
 		if val is None:
 			return None
-		return val[0]
+
+		data = self.load_floorplan_doc(self.rcur, val[0])
+		if val[1] is None:
+			return data
+		return jsondiff.canonical(jsondiff.apply(json.loads(data),
+			json.loads(val[1])))
 
 	def get_floorplan_current(self):
 		return self.get_floorplan_at_timestamp(None)
 
 	def save_floorplan_version(self, timestamp, data):
-		query = 'INSERT INTO floorplan VALUES ( ?, ? )'
 		params = ( int(timestamp * 1000), data )
 
-		self.cur.execute(query, params)
+		self.pending_floorplan.append(params)
+
+	def discard_floorplan_version(self, timestamp, data):
+		'''Take a version saved with save_floorplan_version() back
+		out of the queue, e.g. after flush() has failed.'''
+
+		params = ( int(timestamp * 1000), data )
+
+		if params in self.pending_floorplan[self.written['floorplan']:]:
+			self.pending_floorplan.remove(params)
+
+	def delete_batch(self, table, timestamp, limit, cond='', params=()):
+		query = 'DELETE FROM ' + table + ' WHERE rowid IN (' + \
+			'SELECT rowid FROM ' + table + ' WHERE ' + \
+			'timestamp < ?' + cond + ' LIMIT ?)'
+
+		self.write_pending()
+		self.cur.execute(query, ( timestamp, ) + params + ( limit, ))
+		return self.cur.rowcount
+
+	def expire_values(self, timestamp, limit):
+		'''Delete up to limit history rows older than timestamp and
+		return the number of rows deleted.  Rows newer than the
+		newest snapshot preceding the timestamp are kept so that
+		trees can still be rebuilt for any time after it.  Values
+		older than that are still found in the snapshot, see
+		snapshot_value().'''
+
+		timestamp = int(timestamp * 1000)
+
+		self.write_pending()
+		self.cur.execute('SELECT MAX(timestamp) FROM snapshot ' +
+				'WHERE timestamp <= ?', ( timestamp, ))
+		keep = self.cur.fetchone()[0]
+		if keep is None:
+			return 0
+
+		self.cur.execute('DELETE FROM snapshot WHERE timestamp < ?',
+				( keep, ))
+
+		# Shards are only deleted whole, once all of their rows
+		# have expired
+		count = 0
+		for shard in list(self.shards):
+			if shard[1] <= keep:
+				count += self.drop_shard(shard)
+
+		return count + self.delete_batch('sensorino', keep, limit)
+
+	def expire_console(self, timestamp, limit):
+		if not self.console_search:
+			return self.delete_batch('console',
+					int(timestamp * 1000), limit)
+
+		# The index entries can only be removed with the text they
+		# were created from
+		self.write_pending()
+		rows = self.cur.execute('SELECT id, line FROM console ' +
+				'WHERE timestamp < ? LIMIT ?',
+				( int(timestamp * 1000), limit )).fetchall()
+		self.cur.executemany('INSERT INTO console_fts ' +
+				'(console_fts, rowid, line) ' +
+				'VALUES (\'delete\', ?, ?)', rows)
+		self.cur.executemany('DELETE FROM console WHERE id = ?',
+				[ ( line_id, ) for line_id, line in rows ])
+		return len(rows)
+
+	def expire_rollups(self, period, timestamp, limit):
+		return self.delete_batch('rollup', int(timestamp * 1000),
+				limit, ' AND period = ?', ( period, ))
+
+	def reclaim_space(self, pages):
+		'''Return up to pages free pages to the filesystem.  Returns
+		the number of bytes freed and the number of free pages
+		left.'''
+
+		self.flush()
+
+		page_size = self.cur.execute('PRAGMA page_size').fetchone()[0]
+		before = self.cur.execute('PRAGMA page_count').fetchone()[0]
+		self.cur.execute('PRAGMA incremental_vacuum(' +
+				str(int(pages)) + ')').fetchall()
+		after = self.cur.execute('PRAGMA page_count').fetchone()[0]
+		# The file is only truncated when the WAL is checkpointed
+		self.cur.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+		left = self.cur.execute('PRAGMA freelist_count').fetchone()[0]
+
+		# The freelist doesn't shrink without auto_vacuum
+		if self.cur.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+			left = 0
+
+		return ( before - after ) * page_size, left
+
+	def unwritten(self, queue, count=None):
+		'''Return the rows of the queue not yet written in the
+		current transaction, or the first count of them, and count
+		them as written.'''
+
+		rows = getattr(self, 'pending_' + queue)
+		start = self.written[queue]
+		end = len(rows) if count is None else start + count
+		self.written[queue] = end
+		return rows[start:end]
+
+	def write_pending(self):
+		'''INSERT the queued rows not yet written in the current
+		transaction, without committing.  The get_* queries don't
+		see them until the transaction is committed, they're only
+		removed from the queues then, see commit_written().'''
+
+		channels = self.unwritten('channels')
+		if channels:
+			self.cur.executemany('INSERT INTO channels VALUES ' +
+					'( ?, ?, ?, ?, ? )', channels)
+
+		# The values go in runs whose shards can all be attached
+		# together.  A batch only needs more than one transaction
+		# if its values span more than max_attached shards.
+		while self.written['values'] < len(self.pending_values):
+			start = self.written['values']
+			count = self.attach_for_write(self.pending_values[start:])
+			values = self.unwritten('values', count)
+			self.insert_values(values[max(self.stored_values -
+				start, 0):])
+			self.write_derived(values)
+
+		console = self.unwritten('console')
+		if console:
+			self.cur.execute('SELECT MAX(id) FROM console')
+			last = self.cur.fetchone()[0] or 0
+			self.cur.executemany('INSERT INTO console ' +
+					'( timestamp, line ) VALUES ( ?, ? )',
+					console)
+
+			if self.console_search:
+				self.cur.execute('INSERT INTO console_fts ' +
+						'(rowid, line) SELECT id, ' +
+						'line FROM console ' +
+						'WHERE id > ?', ( last, ))
+		for timestamp, data in self.unwritten('floorplan'):
+			self.store_floorplan(timestamp, data)
+
+		# In the same transaction as the last of the values, at
+		# worst a crash before the commit saves a value twice
+		provisional = self.unwritten('provisional')
+		if provisional:
+			self.cur.executemany('INSERT INTO provisional ' +
+					'VALUES ( ?, ?, ?, ? )', provisional)
+		settled = self.unwritten('settled')
+		if settled:
+			self.cur.executemany('DELETE FROM provisional ' +
+					'WHERE ref = ?', settled)
+
+	def write_derived(self, values):
+		'''Update sensorino_latest, the rollups and the snapshots
+		with ( timestamp, chan, value ) rows added to the history.'''
+
+		# Only the newest row of each channel matters for
+		# sensorino_latest.  Confirmed Set values may be older
+		# than what's there already.
+		latest = {}
+		for timestamp, chan, value in values:
+			if chan not in latest or timestamp >= latest[chan][1]:
+				latest[chan] = ( chan, timestamp, value,
+						chan, timestamp )
+		self.cur.executemany('INSERT OR REPLACE INTO ' +
+				'sensorino_latest SELECT ?, ?, ? ' +
+				'WHERE NOT EXISTS (SELECT 1 FROM ' +
+				'sensorino_latest WHERE chan = ? AND ' +
+				'timestamp > ?)', latest.values())
+
+		self.update_rollups(values)
+
+		# Snapshots already taken after some of the rows
+		if self.snapshot_last is not None:
+			self.patch_snapshots([ row for row in values
+				if row[0] <= self.snapshot_last ])
+
+		self.snapshot_count += len(values)
+		self.last_value_timestamp = max(self.last_value_timestamp,
+				max(row[0] for row in values))
+
+		if self.snapshot_due(self.last_value_timestamp):
+			self.take_snapshot()
+
+	def commit_written(self):
+		'''Commit the current transaction and drop the rows written
+		in it from the queues.'''
 
-	def commit(self):
 		self.conn.commit()
+		self.stored_values = max(self.stored_values -
+				self.written['values'], 0)
+		for queue, count in self.written.items():
+			del getattr(self, 'pending_' + queue)[:count]
+			self.written[queue] = 0
+
+	def rollback_written(self):
+		'''Roll back the current transaction.  The rows written in
+		it are still queued and are written again by the next
+		write_pending().'''
+
+		self.conn.rollback()
+		self.written = dict.fromkeys(self.written, 0)
+
+		# Forget what was derived from the rows rolled back.  The
+		# channel ids allocated stay, their rows are still queued.
+		self.cur.execute('SELECT MAX(timestamp) FROM sensorino')
+		self.main_last = self.cur.fetchone()[0]
+		self.load_snapshot_info()
+		self.load_floorplan_info()
+
+	def insert_values(self, rows):
+		'''Add ( timestamp, chan, value ) rows to the history.'''
+
+		# Group by the shard each row goes in
+		groups = {}
+		for row in rows:
+			shard = self.shard_for_write(row[0])
+			if shard is False:
+				# Sealed since the row was queued, e.g. a Set
+				# confirmed late
+				sensorino.log_warn('Dropping value for a ' +
+						'sealed period: channel ' +
+						str(row[1]))
+				continue
+			groups.setdefault(shard and shard[0],
+					( shard, [] ))[1].append(row)
+			if shard is None:
+				self.main_last = max(self.main_last, row[0])
+
+		# From write_pending() the shards are attached already.
+		# Otherwise attaching one may detach a shard whose rows
+		# are in by then.
+		for shard, rows in groups.values():
+			self.cur.executemany('INSERT INTO ' +
+					self.history_table(self.conn, shard) +
+					' VALUES ( ?, ?, ? )', rows)
+
+	def import_values(self, rows, drop_indexes=True):
+		'''Add ( timestamp, path, value ) rows to the history in
+		bulk, e.g. from a backup or from export_values() of another
+		database, then regenerate sensorino_latest, the rollups and
+		the snapshots in one pass each.  Returns the number of rows
+		imported.  Nothing else should be writing to the database
+		meanwhile.'''
+
+		self.flush()
+		self.begin_import(drop_indexes)
+
+		count = 0
+		batch = []
+		chans = {}
+		try:
+			for timestamp, path, value in rows:
+				# Skip path_to_params() for paths already seen
+				key = tuple(path)
+				chan = chans.get(key)
+				if chan is None:
+					chan = self.channel_id(
+						path_to_params(path), True)
+					chans[key] = chan
+				timestamp = int(timestamp * 1000)
+				if self.shard_for_write(timestamp) is False:
+					continue
+
+				batch.append(( timestamp, chan, value ))
+				if len(batch) >= self.import_batch:
+					self.import_batch_rows(batch)
+					count += len(batch)
+					batch = []
+
+			self.import_batch_rows(batch)
+			count += len(batch)
+		finally:
+			self.end_import()
+
+		self.rebuild_latest()
+		self.rebuild_rollups()
+		self.rebuild_snapshots()
+		self.commit_written()
+
+		# Nothing else is running, seal now what the import has
+		# completed instead of waiting for the maintenance engine
+		self.seal_shards()
+
+		return count
+
+	def begin_import(self, drop_indexes):
+		# A crash means starting the import over anyway
+		self.cur.execute('PRAGMA synchronous = OFF')
+
+		# Building the indexes once at the end, from sorted data,
+		# is much cheaper than updating them on every INSERT.  The
+		# shards created meanwhile start without them.
+		if drop_indexes:
+			self.defer_indexes = True
+			for schema in self.import_schemas():
+				self.cur.execute('DROP INDEX IF EXISTS ' +
+						schema + '.sensorino_chan_time')
+				self.cur.execute('DROP INDEX IF EXISTS ' +
+						schema + '.sensorino_time')
+
+	def import_schemas(self):
+		'''Yield the schemas of the sensorino tables that an import
+		can write to, attaching the shards in turn.'''
+
+		yield 'main'
+		for shard in self.shards:
+			if not shard[3]:
+				self.history_table(self.conn, shard)
+				yield self.shard_schema(shard)
+
+	def import_batch_rows(self, rows):
+		# Only the channels are queued, see import_values()
+		self.write_pending()
+		self.insert_values(rows)
+		self.commit_written()
+
+	def end_import(self):
+		self.defer_indexes = False
+		for schema in self.import_schemas():
+			self.setup_sensorino_indexes(schema)
+		self.cur.execute('PRAGMA synchronous = NORMAL')
+
+	def optimize(self):
+		'''Refresh the statistics the query planner works from.  The
+		first run analyzes everything, the later ones only the tables
+		that changed enough since, see PRAGMA optimize.  Shards are
+		left alone, most of them are sealed.'''
+
+		self.flush()
+		self.cur.execute('PRAGMA analysis_limit = ' +
+				str(self.analysis_limit))
+		self.cur.execute('SELECT 1 FROM sqlite_master ' +
+				'WHERE name = \'sqlite_stat1\'')
+		if self.cur.fetchone() is None:
+			self.cur.execute('ANALYZE main')
+		else:
+			self.cur.execute('PRAGMA main.optimize').fetchall()
+		self.commit_written()
+
+	def history_queries(self):
+		'''( name, query, index ) for the frequent queries on the
+		value history, see planned_queries().'''
+
+		table = { 'table': 'sensorino', 'cond': '' }
+		return [
+			( 'value_at', value_at_sql.format(**table),
+				'sensorino_chan_time' ),
+			( 'values_within_period',
+				values_within_sql.format(**table),
+				'sensorino_chan_time' ),
+			( 'values_page', page_sql.format(select =
+					values_page_sql.format(**table)),
+				'sensorino_chan_time' ),
+			( 'values_without_snapshot',
+				values_without_snapshot_sql.format(**table),
+				'sensorino_chan_time' ),
+			( 'tree_since_snapshot',
+				tree_since_snapshot_sql.format(**table),
+				'sensorino_time' ),
+			( 'event_counts', event_counts_sql.format(**table),
+				'sensorino_time' ),
+		]
+
+	def planned_queries(self):
+		'''( name, query, index ) for the queries that run most
+		often or on the most rows and the index each is meant to
+		use.  The get_* methods run the same SQL.'''
+
+		at = { 'cond': 'WHERE timestamp <= ? ' }
+		return self.history_queries() + [
+			( 'latest', latest_sql, 'INTEGER PRIMARY KEY' ),
+			( 'snapshot_before', snapshot_before_sql,
+				'snapshot_time' ),
+			( 'snapshot_at', snapshot_at_sql, 'snapshot_time' ),
+			( 'rollups_within_period', rollups_within_sql,
+				'rollup_chan' ),
+			( 'rollups_page', page_sql.format(select =
+					rollups_page_sql),
+				'rollup_chan' ),
+			( 'console_at', console_at_sql.format(**at),
+				'console_time' ),
+			( 'console_first', console_first_sql, 'console_time' ),
+			( 'console_last', console_last_sql, 'console_time' ),
+			( 'console_scan', console_scan_sql,
+				'INTEGER PRIMARY KEY' ),
+			( 'floorplan_at', floorplan_at_sql.format(**at),
+				'floorplan_time' ),
+		]
+
+	def get_query_plans(self):
+		'''Return ( name, index, plan, ok ) for each query in
+		planned_queries(), plan being the EXPLAIN QUERY PLAN
+		details and ok False if the index isn't used.'''
+
+		result = []
+		for name, query, index in self.planned_queries():
+			# The plan doesn't depend on the values, only on
+			# their number
+			params = ( 0, ) * query.count('?')
+			rows = self.rcur.execute('EXPLAIN QUERY PLAN ' + query,
+					params).fetchall()
+			plan = '; '.join([ row[-1] for row in rows ])
+
+			result.append(( name, index, plan,
+				re.search(r'\b' + index + r'\b', plan) is not None ))
+		return result
+
+	def pending_count(self):
+		return len(self.pending_values) + len(self.pending_console) + \
+			len(self.pending_floorplan)
+
+	def flush(self):
+		'''Write all queued rows and commit now.  If that fails the
+		transaction is rolled back and the rows stay queued.'''
+
+		if self.flush_timeout is not None:
+			try:
+				timers.cancel(self.flush_timeout)
+			except:
+				pass
+			self.flush_timeout = None
+
+		try:
+			self.write_pending()
+			self.commit_written()
+		except:
+			self.rollback_written()
+			raise
+
+	def catch_up(self):
+		'''Called by the get_* methods so that they see the rows
+		saved so far.  Costs nothing unless rows are queued, the
+		flush_delay batching only applies while nothing reads.'''
+
+		if self.pending_count():
+			self.try_flush()
+
+	def try_flush(self):
+		'''flush() where there's no one to report a failure to, the
+		rows are tried again with the next flush.'''
+
+		try:
+			self.flush()
+		except Exception as e:
+			sensorino.log_err('Database flush failed: ' + str(e))
+
+	def handle_flush_timeout(self):
+		self.flush_timeout = None
+		self.try_flush()
+
+	def commit(self):
+		'''Mark the end of a logical group of changes.  The
+		transaction is only committed once enough rows have been
+		queued or after flush_delay, so that bursts of messages
+		cost one fsync instead of one per message.'''
+
+		if self.pending_count() >= self.flush_rows:
+			self.try_flush()
+		elif self.flush_timeout is None:
+			self.flush_timeout = timers.call_later(
+					self.handle_flush_timeout,
+					self.flush_delay)
+
+class sample_connection(connection):
+	'''Base for the storage engines that keep the value history
+	somewhere other than the sensorino table.  Everything else is
+	stored as in connection.  Subclasses implement insert_values(),
+	store_rows(), drop_samples(), chan_samples(), read_samples(),
+	first_timestamp() and expire_values().  A history saved by
+	connection is only converted if convert is set, see
+	convert_rows() and revert_rows() for the way back.'''
+
+	def __init__(self, name='sensorino.db', convert=False):
+		# Until the subclass has moved the rows out of the
+		# sensorino table the rebuild_* methods of connection
+		# apply, as during the migrations
+		self.converted = False
+		self.convert = convert
+
+		connection.__init__(self, name)
+
+	def convert_rows(self):
+		'''Move any values saved by connection into the engine's
+		storage, called by the subclass once it's set up.'''
+
+		self.converted = True
+
+		self.cur.execute('SELECT COUNT(*) FROM sensorino')
+		if not self.cur.fetchone()[0]:
+			return
+		# Nothing is deleted unless asked for
+		if not self.convert:
+			raise Exception('The value history is saved as rows, ' +
+					'set history_convert to convert it')
+
+		self.cur.execute('SELECT timestamp, chan, value ' +
+				'FROM sensorino ' +
+				'ORDER BY chan, timestamp')
+		self.store_rows([ ( timestamp, chan, sqlite_to_value(value) )
+			for timestamp, chan, value in self.cur.fetchall() ])
+
+		self.cur.execute('DELETE FROM sensorino')
+		self.commit_written()
+		self.main_last = None
+
+	def revert_rows(self):
+		'''Move the whole value history back into the sensorino
+		table so that connection can open the database again.
+		The latest values, rollups and snapshots stay valid.'''
+
+		connection.insert_values(self,
+				list(self.read_samples(self.cur, None, None)))
+		self.drop_samples()
+
+	def store_rows(self, rows):
+		'''Save ( timestamp, chan, value ) rows sorted by channel
+		and time, converted from the sensorino table.'''
+		raise NotImplementedError()
+
+	def drop_samples(self):
+		'''Remove the whole history from the engine's storage and
+		commit the rows put back into the sensorino table, in the
+		same transaction where possible.'''
+		raise NotImplementedError()
+
+	def history_queries(self):
+		return []
+
+	def rollback_written(self):
+		# The values written are in the history whatever happens
+		# to the transaction, only what's derived from them is
+		# written again
+		self.stored_values = max(self.stored_values,
+				self.written['values'])
+		connection.rollback_written(self)
+
+	def get_event_counts(self, paths, t0, t1, buckets):
+		self.catch_up()
+
+		chans = self.match_chans(paths)
+		if chans is None:
+			chans = self.channel_paths.keys()
+
+		counts = [ 0 ] * buckets
+		t0 = int(t0 * 1000)
+		t1 = int(t1 * 1000)
+		for chan in chans:
+			for timestamp, value in self.chan_samples(self.rcur,
+					chan, t0, t1):
+				counts[(timestamp - t0) * buckets / (t1 - t0)] += 1
+		return counts
+
+	def chan_samples(self, cur, chan, t0, t1, reverse=False):
+		'''Yield the ( timestamp, value ) tuples of the
+		channel with timestamps in [t0, t1) in timestamp order.'''
+		raise NotImplementedError()
+
+	def read_samples(self, cur, t0, t1):
+		'''Yield all ( timestamp, chan, value ) tuples
+		with timestamps in [t0, t1) in timestamp order.  None
+		stands for no bound.'''
+		raise NotImplementedError()
+
+	def last_sample(self, cur, chan, timestamp):
+		'''Return the last ( timestamp, value ) of the channel at or
+		before timestamp, or None.'''
+
+		for sample in self.chan_samples(cur, chan, -(1 << 62),
+				timestamp + 1, True):
+			return sample
+		return None
+
+	def next_change(self, chan, timestamp):
+		# No shards here, the samples written in the current
+		# transaction count too
+		for sample in self.chan_samples(self.cur, chan,
+				timestamp + 1, 1 << 62):
+			return sample[0]
+		return None
+
+	def get_value_at_timestamp(self, path, timestamp):
+		self.catch_up()
+
+		if timestamp is None:
+			return connection.get_value_at_timestamp(self,
+					path, None)
+
+		chan = self.channel_id(path_to_params(path))
+		if chan is None:
+			return None
+
+		timestamp = int(timestamp * 1000)
+		sample = self.last_sample(self.rcur, chan, timestamp)
+		if sample is None:
+			return self.snapshot_value(chan, timestamp)
+		return sample[1]
+
+	def get_tree_at_timestamp(self, timestamp):
+		self.catch_up()
+
+		if timestamp is None:
+			return self.get_tree_current()
+
+		timestamp = int(timestamp * 1000)
+
+		self.rcur.execute(snapshot_at_sql, ( timestamp, ))
+		snapshot = self.rcur.fetchone()
+		if snapshot is None:
+			values = {}
+			for chan in self.channel_paths:
+				sample = self.last_sample(self.rcur, chan,
+						timestamp)
+				if sample is not None:
+					values[chan] = sample[1]
+		else:
+			# Start with the nearest earlier snapshot and replay
+			# only the changes since
+			values = dict(json.loads(zlib.decompress(snapshot[1])))
+			for ts, chan, value in self.read_samples(self.rcur,
+					snapshot[0] + 1, timestamp + 1):
+				values[chan] = value
+
+		return self.chan_rows_to_tree(values.items())
+
+	def get_values_within_period(self, path, t0, t1):
+		self.catch_up()
+
+		chan = self.channel_id(path_to_params(path))
+		if chan is None:
+			return []
+
+		# Newest first, stop once there are enough values
+		values = []
+		for timestamp, value in self.chan_samples(self.rcur, chan,
+				int(t0 * 1000), int(t1 * 1000), True):
+			values.append(( 0.001 * timestamp, value ))
+			if len(values) >= self.max_values:
+				break
+
+		return values[::-1]
+
+	def get_values_page(self, path, t0, t1, limit, cursor=None):
+		'''Same as connection.get_values_page() except that the
+		cursor is the timestamp of the last value returned and
+		the number of values returned with that timestamp.'''
+
+		self.catch_up()
+
+		chan = self.channel_id(path_to_params(path))
+		if chan is None:
+			return [], None
+
+		t0 = int(t0 * 1000)
+		if cursor is None:
+			cursor = ( t0, 0 )
+		skip = cursor[1]
+
+		values = []
+		count = 0
+		for timestamp, value in self.chan_samples(self.rcur, chan,
+				max(t0, cursor[0]), int(t1 * 1000)):
+			if timestamp == cursor[0] and skip:
+				skip -= 1
+				continue
+
+			values.append(( 0.001 * timestamp, value ))
+
+			# Number of values with this timestamp so far
+			if len(values) > 1 and timestamp == prev:
+				count += 1
+			elif timestamp == cursor[0]:
+				count = cursor[1] + 1
+			else:
+				count = 1
+			prev = timestamp
+
+			if len(values) == limit:
+				return values, ( timestamp, count )
+
+		return values, None
+
+	def rebuild_latest(self):
+		if not self.converted:
+			return connection.rebuild_latest(self)
+
+		self.cur.execute('DELETE FROM sensorino_latest')
+
+		latest = {}
+		for timestamp, chan, value in self.read_samples(self.cur,
+				None, None):
+			latest[chan] = ( chan, timestamp, value )
+		self.cur.executemany('INSERT INTO sensorino_latest ' +
+				'VALUES ( ?, ?, ? )', latest.values())
+
+	def rebuild_snapshots(self):
+		if not self.converted:
+			return connection.rebuild_snapshots(self)
+
+		self.cur.execute('DELETE FROM snapshot')
+		self.snapshot_last = None
+		self.snapshot_count = 0
+
+		values = {}
+		prev = None
+		for timestamp, chan, value in self.read_samples(self.cur,
+				None, None):
+			if prev is not None and timestamp != prev and \
+					self.snapshot_due(prev):
+				self.save_snapshot(prev, values.items())
+
+			values[chan] = value
+			self.snapshot_count += 1
+			prev = timestamp
+
+	def rebuild_rollups(self):
+		if not self.converted:
+			return connection.rebuild_rollups(self)
+
+		self.cur.execute('DELETE FROM rollup')
+
+		rows = []
+		for sample in self.read_samples(self.cur, None, None):
+			rows.append(sample)
+			if len(rows) >= 4096:
+				self.update_rollups(rows)
+				rows = []
+		self.update_rollups(rows)
+
+	# Length in seconds of the time windows that export_values()
+	# reads one at a time
+	export_window = 24 * 60 * 60
+
+	def first_timestamp(self, cur):
+		'''Return the oldest timestamp in the history, or a lower
+		bound, or None if the history is empty.'''
+		raise NotImplementedError()
+
+	def export_values(self, paths, t0=None, t1=None):
+		self.catch_up()
+
+		chans = self.export_chans(paths)
+		if chans == []:
+			return
+		if chans is not None:
+			chans = set(chans)
+
+		# A separate cursor, the reads are interleaved with other
+		# queries
+		cur = self.rconn.cursor()
+
+		if t0 is None:
+			t0 = self.first_timestamp(cur)
+			if t0 is None:
+				return
+		else:
+			t0 = int(t0 * 1000)
+		if t1 is None:
+			cur.execute('SELECT MAX(timestamp) FROM sensorino_latest')
+			t1 = (cur.fetchone()[0] or t0) + 1
+		else:
+			t1 = int(t1 * 1000)
+
+		ms = self.export_window * 1000
+		for start in xrange(t0, t1, ms):
+			for timestamp, chan, value in self.read_samples(cur,
+					start, min(start + ms, t1)):
+				if chans is None or chan in chans:
+					yield 0.001 * timestamp, \
+						self.chan_path(chan), value
+
+	def expire_snapshots(self, timestamp):
+		'''Drop the snapshots no longer needed once the history
+		before timestamp is gone and return the timestamp of the
+		oldest snapshot kept, values older than that can go, or
+		None if nothing can be expired yet.'''
+
+		self.write_pending()
+		self.cur.execute('SELECT MAX(timestamp) FROM snapshot ' +
+				'WHERE timestamp <= ?', ( timestamp, ))
+		keep = self.cur.fetchone()[0]
+		if keep is None:
+			return None
+
+		self.cur.execute('DELETE FROM snapshot WHERE timestamp < ?',
+				( keep, ))
+		return keep
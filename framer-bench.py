@@ -0,0 +1,144 @@
+#! /usr/bin/python
+#
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Measure how fast base_server.obj_parser splits the stream received
+# from a Base into JSON objects, against the per-character parser it
+# replaced, and how fast it decodes the same messages sent in the
+# frames that a Base can negotiate.  The stream is a mix of the
+# messages a busy Base sends, received in the 8KB pieces that
+# handle_read() reads.
+
+import sys
+import time
+import json
+import random
+import codecs
+
+import base_server
+
+class char_parser():
+	'''The old obj_parser, fed one character at a time.'''
+
+	def __init__(self):
+		self.obj_buffer = ''
+		self.nest_depth = 0
+		self.quote = 0
+		self.escape = 0
+		self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+	def handle_char(self, ch):
+		self.obj_buffer += ch
+
+		if self.quote and not self.escape and ch == '\\':
+			self.escape = 1
+		elif not self.escape and ch == '"':
+			self.quote = not self.quote
+		elif not self.quote:
+			if ch in '{[(':
+				self.nest_depth += 1
+			elif ch in '}])':
+				self.nest_depth -= 1
+
+				if self.nest_depth <= 0:
+					ret = self.obj_buffer
+
+					self.obj_buffer = ''
+					self.nest_depth = 0
+
+					return ret
+		return None
+
+	def handle_data(self, data):
+		# Like the old handle_read(), except that a character split
+		# between two chunks no longer makes it raise an exception
+		objs = []
+		for ch in self.decoder.decode(data):
+			obj = self.handle_char(ch)
+			if obj is not None:
+				objs.append(obj)
+		return objs
+
+# ( name, parser, frame format, messages per frame ), the plain JSON
+# objects are decoded with json.loads() as the server does it, those
+# from frames come decoded
+parsers = [
+	( 'per-char', char_parser, None, None ),
+	( 'chunked', base_server.obj_parser, None, None ),
+	( 'json', base_server.obj_parser, 'json', 1 ),
+	( 'json x16', base_server.obj_parser, 'json', 16 ),
+	( 'msgpack', base_server.obj_parser, 'msgpack', 1 ),
+	( 'msgpack x16', base_server.obj_parser, 'msgpack', 16 ),
+]
+
+messages = 50000
+chunk_size = 8192
+rounds = 3
+
+def make_messages():
+	random.seed(1)
+	msgs = []
+	for i in xrange(messages):
+		kind = random.random()
+		if kind < 0.8:
+			msg = { 'type': 'publish', 'from': random.randint(1, 30),
+				'serviceId': random.randint(0, 5),
+				'float': [ round(random.random() * 30, 2)
+					for j in range(random.randint(1, 3)) ],
+				'switch': random.random() < 0.5 }
+		elif kind < 0.95:
+			msg = { 'type': 'publish', 'from': random.randint(1, 30),
+				'serviceId': 0,
+				'message': u'Kitchen \u2013 door {' +
+					str(i) + '} opened' }
+		else:
+			msg = { 'type': 'err', 'from': random.randint(1, 30),
+				'error': 'xmitError' }
+		msgs.append(msg)
+	return msgs
+
+def make_stream(msgs, fmt, per_frame):
+	if fmt is None:
+		# Non-ASCII as is, the old parser can't handle a backslash
+		# in a string, see the commit that replaced it
+		data = ''.join([ json.dumps(msg,
+			ensure_ascii=False).encode('utf-8') for msg in msgs ])
+	else:
+		data = ''.join([ base_server.pack_frame(fmt,
+			msgs[i:i + per_frame])
+			for i in xrange(0, len(msgs), per_frame) ])
+
+	return [ data[i:i + chunk_size]
+		for i in xrange(0, len(data), chunk_size) ]
+
+def run(name, parser, fmt, per_frame, msgs):
+	chunks = make_stream(msgs, fmt, per_frame)
+	size = sum([ len(chunk) for chunk in chunks ])
+	best = None
+	for i in range(rounds):
+		state = parser()
+		if fmt is not None:
+			state.frame_format = fmt
+		t = time.time()
+		objs = []
+		for chunk in chunks:
+			objs += state.handle_data(chunk)
+		if fmt is None:
+			objs = [ json.loads(obj) for obj in objs ]
+		elapsed = time.time() - t
+		if best is None or elapsed < best:
+			best = elapsed
+
+	print('%-11s %7.2fMB  %6.2fMB/s  %9d objects/s' % ( name,
+		size / 1e6, size / best / 1e6, len(msgs) / best ))
+	if objs != msgs:
+		print('  objects differ from those sent')
+
+msgs = make_messages()
+print(str(len(msgs)) + ' objects in ' + str(chunk_size) + ' byte chunks')
+for name, parser, fmt, per_frame in parsers:
+	run(name, parser, fmt, per_frame, msgs)
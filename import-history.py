@@ -0,0 +1,99 @@
+#! /usr/bin/python
+#
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Load channel values in bulk into the server's database, e.g. to
+# restore a backup made with /api/export.ndjson or /api/export.csv or to
+# migrate the history from another system.  The input is in either of
+# the export formats:
+#
+#   [ 1420070400.5, [ 10, 2, "float", 0 ], 21.5 ]
+#
+# one per line, or CSV with the timestamp,node,service,type,channel,value
+# header line.  CSV values are parsed as JSON where possible, as strings
+# otherwise.  Stop the server while the import runs.  Sorting the
+# input by time makes the import faster and, with the 'chunks' storage,
+# the result smaller.
+#
+# Usage: import-history.py [--csv] [--keep-indexes] [--db FILE] FILE...
+# "-" reads the standard input.
+
+import sys
+import json
+import csv
+import time
+import argparse
+
+import config
+import db
+import chunkdb
+import logdb
+
+def read_ndjson(f):
+	for line in f:
+		if not line.strip():
+			continue
+		timestamp, path, value = json.loads(line)
+		yield timestamp, path, value
+
+def read_csv(f):
+	def parse_elem(elem, conv):
+		try:
+			return conv(elem)
+		except ValueError:
+			return elem.decode('utf-8')
+
+	reader = csv.reader(f)
+	header = next(reader, None)
+	if header != [ 'timestamp', 'node', 'service', 'type', 'channel',
+			'value' ]:
+		raise Exception('Unknown CSV columns: ' + str(header))
+
+	for row in reader:
+		timestamp, node_addr, svc_id, typ, chan_id, value = row
+		path = [ parse_elem(node_addr, int),
+			parse_elem(svc_id, int) ]
+		if typ != '':
+			path.append(typ)
+			if chan_id != '':
+				path.append(int(chan_id))
+		yield float(timestamp), path, parse_elem(value, json.loads)
+
+parser = argparse.ArgumentParser(
+		description='Bulk import of channel values.')
+parser.add_argument('files', metavar='FILE', nargs='+')
+parser.add_argument('--csv', action='store_true',
+		help='input is CSV rather than NDJSON')
+parser.add_argument('--keep-indexes', action='store_true',
+		help='don\'t rebuild the indexes, faster when importing ' +
+			'little into a big database')
+parser.add_argument('--db', default='sensorino.db')
+args = parser.parse_args()
+
+if config.history_storage == 'chunks':
+	storage = chunkdb.connection(args.db,
+			convert=config.history_convert)
+elif config.history_storage == 'log':
+	storage = logdb.connection(args.db, convert=config.history_convert)
+else:
+	chunkdb.revert(args.db, config.history_convert)
+	logdb.revert(args.db, config.history_convert)
+	storage = db.connection(args.db,
+			shard_months=config.history_shard_months)
+
+def read_all():
+	for name in args.files:
+		f = sys.stdin if name == '-' else open(name, 'rb')
+		for row in (read_csv if args.csv else read_ndjson)(f):
+			yield row
+
+start = time.time()
+count = storage.import_values(read_all(), not args.keep_indexes)
+storage.close()
+
+sys.stderr.write('Imported ' + str(count) + ' values in %.1fs\n' %
+		(time.time() - start))
@@ -0,0 +1,371 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Decoding and validation of the messages received from the Bases,
+# optionally in worker processes.  With a pool the main process still
+# owns the Base sockets but only passes the bytes received to the
+# worker assigned to the connection.  The worker splits them into
+# messages, decodes them and does the validation that doesn't depend
+# on the sensorino state, then sends back a record per message.  The
+# main process is left with the state validation and with applying the
+# messages, see server.base_message_handler().  All of a Base's
+# messages go through one worker so their order is kept.
+#
+# Main process to worker: a '>BII' header, the command, connection id
+# and length, followed by that many bytes received from the Base.
+# Worker to main process: a '>I' length followed by a marshalled list
+# of records, see worker.parse().
+#
+
+import sensorino
+import base_server
+import timers
+import os
+import socket
+import asyncore
+import multiprocessing
+import signal
+import marshal
+import struct
+import json
+
+cmd_header = struct.Struct('>BII')
+cmd_data = 0
+cmd_close = 1
+
+batch_header = struct.Struct('>I')
+
+class parsed_message():
+	'''A message as returned by parse_message(), passed to the
+	base_server object handlers in place of the raw object.'''
+
+	def __init__(self, raw_msg, msg, valid):
+		self.raw_msg = raw_msg
+		self.msg = msg
+		self.valid = valid
+
+def parse_message(obj):
+	'''Decode a message received from a Base, the JSON text or the
+	object from a frame, and validate what can be validated without
+	the state.  Returns a parsed_message whose msg is None if the
+	message is not even a JSON object.'''
+
+	# Messages that came in frames are decoded already, the console
+	# still gets the JSON text
+	if isinstance(obj, basestring):
+		raw_msg = obj
+		obj = None
+	else:
+		raw_msg = json.dumps(obj)
+
+	msg = None
+	try:
+		if obj is None:
+			obj = json.loads(raw_msg)
+		msg = sensorino.message_dict(obj)
+
+		# Basic validation
+		if 'type' not in msg and 'error' not in msg:
+			raise Exception('No type')
+		type = msg.get('type', 'err')
+
+		if type not in [ 'publish', 'request', 'set', 'err' ]:
+			raise Exception('Unknown type')
+
+		if type == 'publish':
+			sensorino.validate_incoming_publish(msg)
+		elif type == 'request':
+			sensorino.validate_incoming_request(msg)
+		elif type == 'set':
+			sensorino.validate_incoming_set(msg)
+		else:
+			sensorino.validate_incoming_error(msg)
+
+		valid = True
+	except Exception as e:
+		sensorino.log_warn(str(e.args))
+
+		valid = False
+
+	return parsed_message(raw_msg, msg, valid)
+
+class worker():
+	'''The worker process side, reads the commands until the main
+	process closes its end of the socket.'''
+
+	def __init__(self, sock):
+		self.sock = sock
+		self.parsers = {}
+
+	def run(self):
+		# Ctrl-C is for the main process, we exit once it's gone
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+		buf = ''
+		while True:
+			data = self.sock.recv(65536)
+			if not data:
+				break
+			buf += data
+
+			records = []
+			pos = 0
+			while pos + cmd_header.size <= len(buf):
+				cmd, conn_id, size = \
+					cmd_header.unpack_from(buf, pos)
+				end = pos + cmd_header.size + size
+				if end > len(buf):
+					break
+
+				if cmd == cmd_data:
+					self.parse(conn_id, buf[end - size:end],
+							records)
+				elif conn_id in self.parsers:
+					del self.parsers[conn_id]
+				pos = end
+			buf = buf[pos:]
+
+			if records:
+				batch = marshal.dumps(records)
+				self.sock.sendall(batch_header.pack(len(batch)) +
+						batch)
+
+		self.sock.close()
+
+	def parse(self, conn_id, data, records):
+		'''Add a ( conn_id, kind, raw_msg, msg, valid ) record for each
+		object completed by data.  kind is 'handshake' for the first
+		object on a connection, raw_msg being the text to pass to
+		base_server's handshake(), 'msg' for messages and 'error'
+		with the exception text in raw_msg if the stream can't be
+		parsed, the connection's data is ignored after that.'''
+
+		if conn_id not in self.parsers:
+			parser = base_server.obj_parser()
+			# Until the first object is complete, which may take
+			# more than one chunk
+			parser.handshake_pending = True
+			self.parsers[conn_id] = parser
+		parser = self.parsers[conn_id]
+		if parser is None:
+			return
+
+		try:
+			objs = parser.handle_data(data)
+		except Exception as e:
+			records.append(( conn_id, 'error', str(e), None, False ))
+			self.parsers[conn_id] = None
+			return
+
+		for obj in objs:
+			if parser.handshake_pending:
+				records.append(( conn_id, 'handshake', obj,
+					None, False ))
+				parser.handshake_pending = False
+
+				# The main process negotiates the same
+				# frame format, see handshake()
+				try:
+					hs = json.loads(obj)
+					if 'framing' in hs:
+						parser.frame_format = base_server. \
+							negotiate_framing(
+							hs['framing'])
+				except:
+					pass
+				continue
+
+			parsed = parse_message(obj)
+			msg = parsed.msg
+			if msg is not None:
+				msg = dict(msg)
+			records.append(( conn_id, 'msg', parsed.raw_msg, msg,
+				parsed.valid ))
+
+class worker_channel(asyncore.dispatcher_with_send):
+	'''The main process end of the socket to a worker.'''
+
+	# Stop reading from the Bases while more than high_water bytes
+	# are waiting to be sent to the worker, until they're down to
+	# low_water
+	high_water = 1024 * 1024
+	low_water = 256 * 1024
+
+	def __init__(self, sock, pool):
+		asyncore.dispatcher_with_send.__init__(self, sock)
+
+		self.pool = pool
+		self.in_buffer = ''
+		self.held = 0
+
+	def initiate_send(self):
+		# dispatcher_with_send only sends 512 bytes at a time
+		num_sent = asyncore.dispatcher.send(self,
+				self.out_buffer[:65536])
+		self.out_buffer = self.out_buffer[num_sent:]
+
+		held = self.held
+		if len(self.out_buffer) > self.high_water:
+			self.held = 1
+		elif len(self.out_buffer) <= self.low_water:
+			self.held = 0
+		if self.held != held:
+			self.pool.held_changed()
+
+		if self.out_buffer:
+			timers.changed(self)
+
+	def congested(self):
+		return self.held
+
+	def handle_read(self):
+		self.in_buffer += self.recv(65536)
+
+		pos = 0
+		while pos + batch_header.size <= len(self.in_buffer):
+			size = batch_header.unpack_from(self.in_buffer, pos)[0]
+			end = pos + batch_header.size + size
+			if end > len(self.in_buffer):
+				break
+
+			batch = marshal.loads(self.in_buffer[end - size:end])
+			for record in batch:
+				self.pool.handle_record(*record)
+			pos = end
+		self.in_buffer = self.in_buffer[pos:]
+
+	def handle_close(self):
+		sensorino.log_err('Base message worker exited, restarting')
+		self.close()
+		self.pool.respawn(self)
+
+class pool():
+	'''Worker processes parsing the Bases' messages, count of them.
+	The records are handed to the handlers' base_server.  Best
+	created before the database is opened, the workers close what
+	they inherit anyway, see run_worker().'''
+
+	def __init__(self, count):
+		self.channels = [ None ] * count
+		self.processes = [ None ] * count
+		self.held = 0
+
+		self.conns = {}
+		self.conn_ids = {}
+		self.next_id = 0
+
+		for i in xrange(count):
+			self.spawn(i)
+
+	def spawn(self, i):
+		sock, worker_sock = socket.socketpair()
+		proc = multiprocessing.Process(target=run_worker,
+				args=( worker_sock, ))
+		proc.daemon = True
+		proc.start()
+		worker_sock.close()
+
+		self.channels[i] = worker_channel(sock, self)
+		self.processes[i] = proc
+
+	def respawn(self, channel):
+		'''Replace the worker behind channel, which has exited.  The
+		Bases it was parsing for are dropped as the parts of their
+		messages received so far went with it.'''
+
+		i = self.channels.index(channel)
+		self.spawn(i)
+		self.held_changed()
+
+		for conn_id, handler in self.conns.items():
+			if conn_id % len(self.channels) == i:
+				self.drop(handler, 'Base message worker exited')
+
+	def congested(self):
+		return self.held
+
+	def held_changed(self):
+		held = max([ channel.held for channel in self.channels ])
+		if held == self.held:
+			return
+		self.held = held
+
+		# The Bases stop or resume reading
+		for handler in self.conns.values():
+			timers.changed(handler)
+
+	def channel(self, conn_id):
+		return self.channels[conn_id % len(self.channels)]
+
+	def attach(self, handler):
+		if handler in self.conn_ids:
+			return
+		self.conn_ids[handler] = self.next_id
+		self.conns[self.next_id] = handler
+		self.next_id = (self.next_id + 1) & 0xffffffff
+
+	def feed(self, handler, data):
+		self.attach(handler)
+		conn_id = self.conn_ids[handler]
+
+		self.channel(conn_id).send(cmd_header.pack(cmd_data,
+			conn_id, len(data)) + data)
+
+	def detach(self, handler):
+		if handler not in self.conn_ids:
+			return
+		conn_id = self.conn_ids.pop(handler)
+		del self.conns[conn_id]
+
+		self.channel(conn_id).send(cmd_header.pack(cmd_close,
+			conn_id, 0))
+
+	def handle_record(self, conn_id, kind, raw_msg, msg, valid):
+		# Records may still arrive for a Base that's just gone
+		if conn_id not in self.conns:
+			return
+		handler = self.conns[conn_id]
+
+		if kind == 'handshake':
+			handler.handshake(raw_msg)
+			if not handler.connected:
+				# Rejected and closed
+				self.detach(handler)
+		elif kind == 'error':
+			self.drop(handler, raw_msg)
+		else:
+			if msg is not None:
+				msg = sensorino.message_dict(msg)
+			handler.server.handle_obj(parsed_message(raw_msg, msg,
+					valid), handler)
+
+	def drop(self, handler, reason):
+		sensorino.log_err(str(handler.client_address) +
+				': Dropping base: ' + reason)
+		handler.done()
+		try:
+			handler.close()
+		except:
+			pass
+
+def inherited_fds():
+	try:
+		return [ int(fd) for fd in os.listdir('/proc/self/fd') ]
+	except OSError:
+		return range(3, os.sysconf('SC_OPEN_MAX'))
+
+def run_worker(sock):
+	# Close everything inherited from the main process: its end of
+	# sock, so that the worker sees it closed when the main process
+	# exits, the Base sockets, so that the Bases see them closed,
+	# and the listening sockets and database files
+	for fd in inherited_fds():
+		if fd > 2 and fd != sock.fileno():
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+	worker(sock).run()
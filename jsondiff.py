@@ -0,0 +1,203 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# JSON Patch (RFC 6902) support: diff() produces a patch that turns one
+# JSON document into another and apply() applies a patch to a document.
+# diff() only emits add, remove and replace operations, apply() accepts
+# all six.  Documents are the decoded Python objects, not JSON text.
+#
+import copy
+import json
+import difflib
+
+def canonical(obj):
+	'''A fixed JSON encoding of the object, equal documents give equal
+	strings.'''
+	return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+def equal(a, b):
+	# In Python True == 1, in JSON they're different values
+	if isinstance(a, bool) or isinstance(b, bool):
+		return type(a) == type(b) and a == b
+	if isinstance(a, dict) and isinstance(b, dict):
+		return len(a) == len(b) and \
+			all([ key in b and equal(a[key], b[key]) for key in a ])
+	if isinstance(a, list) and isinstance(b, list):
+		return len(a) == len(b) and \
+			all([ equal(x, y) for x, y in zip(a, b) ])
+	if isinstance(a, (dict, list)) or isinstance(b, (dict, list)):
+		return False
+	return a == b
+
+def escape(token):
+	return unicode(token).replace('~', '~0').replace('/', '~1')
+
+def diff(a, b, path=''):
+	'''Return the list of operations that turn a into b.'''
+
+	if isinstance(a, dict) and isinstance(b, dict):
+		ops = []
+		for key in sorted(a):
+			if key not in b:
+				ops.append({ 'op': 'remove',
+					'path': path + '/' + escape(key) })
+		for key in sorted(b):
+			if key not in a:
+				ops.append({ 'op': 'add',
+					'path': path + '/' + escape(key),
+					'value': b[key] })
+			else:
+				ops += diff(a[key], b[key],
+						path + '/' + escape(key))
+		return ops
+
+	if isinstance(a, list) and isinstance(b, list):
+		# Match up the unchanged elements so that inserting or
+		# deleting one in the middle is a single operation.  Only
+		# the elements in changed runs are compared by content.
+		# Equal encodings mean equal elements, the reverse doesn't
+		# matter much so skip the slow sort_keys.
+		matcher = difflib.SequenceMatcher(None,
+				[ json.dumps(elem) for elem in a ],
+				[ json.dumps(elem) for elem in b ], False)
+
+		# Index of a[i] in the list as patched so far is i + offset
+		ops = []
+		offset = 0
+		for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+			if tag == 'equal':
+				continue
+
+			common = min(i2 - i1, j2 - j1)
+			for k in range(common):
+				ops += diff(a[i1 + k], b[j1 + k],
+						path + '/' + str(i1 + k + offset))
+
+			pos = path + '/' + str(i1 + common + offset)
+			for k in range(i2 - i1 - common):
+				ops.append({ 'op': 'remove', 'path': pos })
+			for k in range(j2 - j1 - common):
+				ops.append({ 'op': 'add', 'path': path + '/' +
+					str(i1 + common + offset + k),
+					'value': b[j1 + common + k] })
+			offset += (j2 - j1) - (i2 - i1)
+		return ops
+
+	if equal(a, b):
+		return []
+	return [ { 'op': 'replace', 'path': path, 'value': b } ]
+
+def parse_pointer(pointer):
+	if pointer == '':
+		return []
+	if not isinstance(pointer, basestring) or not pointer.startswith('/'):
+		raise ValueError('Bad JSON pointer: ' + repr(pointer))
+
+	return [ token.replace('~1', '/').replace('~0', '~')
+		for token in pointer[1:].split('/') ]
+
+def list_index(container, token, append=False):
+	if append and token == '-':
+		return len(container)
+	if not token.isdigit() or (len(token) > 1 and token[0] == '0'):
+		raise ValueError('Bad array index: ' + token)
+
+	index = int(token)
+	if index > len(container) or (index == len(container) and not append):
+		raise ValueError('Array index out of range: ' + token)
+	return index
+
+def resolve(doc, tokens):
+	for token in tokens:
+		if isinstance(doc, dict) and token in doc:
+			doc = doc[token]
+		elif isinstance(doc, list):
+			doc = doc[list_index(doc, token)]
+		else:
+			raise ValueError('No such path: /' + '/'.join(tokens))
+	return doc
+
+def apply(doc, patch):
+	'''Return a copy of doc with the patch applied.  Raises ValueError
+	if the patch is malformed or doesn't apply, e.g. a test operation
+	fails.'''
+
+	# Operations modify the document in place, the root is held in
+	# a list so that it can be replaced too
+	root = [ copy.deepcopy(doc) ]
+
+	def parent(path):
+		tokens = parse_pointer(path)
+		if not tokens:
+			return root, None
+		return resolve(root[0], tokens[:-1]), tokens[-1]
+
+	def add(path, value):
+		container, token = parent(path)
+		if container is root:
+			root[0] = value
+		elif isinstance(container, dict):
+			container[token] = value
+		elif isinstance(container, list):
+			container.insert(list_index(container, token, True),
+					value)
+		else:
+			raise ValueError('Not a container: ' + path)
+
+	def replace(path, value):
+		resolve(root[0], parse_pointer(path))
+		container, token = parent(path)
+		if container is root:
+			root[0] = value
+		elif isinstance(container, list):
+			container[list_index(container, token)] = value
+		else:
+			container[token] = value
+
+	def remove(path):
+		container, token = parent(path)
+		if container is root:
+			raise ValueError('Can\'t remove the root')
+		if isinstance(container, dict) and token in container:
+			return container.pop(token)
+		if isinstance(container, list):
+			return container.pop(list_index(container, token))
+		raise ValueError('No such path: ' + path)
+
+	if not isinstance(patch, list):
+		raise ValueError('A patch is a list of operations')
+
+	for op in patch:
+		try:
+			name = op['op']
+			path = op['path']
+
+			if name == 'add':
+				add(path, copy.deepcopy(op['value']))
+			elif name == 'remove':
+				remove(path)
+			elif name == 'replace':
+				replace(path, copy.deepcopy(op['value']))
+			elif name == 'move':
+				if path.startswith(op['from'] + '/'):
+					raise ValueError('Can\'t move into ' +
+							'itself: ' + path)
+				add(path, remove(op['from']))
+			elif name == 'copy':
+				add(path, copy.deepcopy(resolve(root[0],
+					parse_pointer(op['from']))))
+			elif name == 'test':
+				if not equal(resolve(root[0],
+						parse_pointer(path)),
+						op['value']):
+					raise ValueError('Test failed: ' + path)
+			else:
+				raise ValueError('Unknown operation: ' +
+						repr(name))
+		except (KeyError, TypeError):
+			raise ValueError('Malformed operation: ' + repr(op))
+
+	return root[0]
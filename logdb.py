@@ -0,0 +1,430 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Append-only log history storage: the values of each channel go into
+# their own files, one per file_period, as fixed-format records that
+# are only ever appended and are read back through mmap.  A sparse
+# index next to each file keeps the offset and the time range of every
+# index_records records so reads skip the parts of the file out of
+# the range asked for.  On flash storage a sequential append is much
+# cheaper than the page rewrites that an INSERT into the sensorino table
+# and its two indexes costs.  Everything except the history is kept as
+# in db.connection.
+#
+import os
+import shutil
+import mmap
+import struct
+import json
+import heapq
+import collections
+import db
+import chunkdb
+
+# Record: timestamp in millisec, value kind (see chunkdb.value_kind())
+# then the value, a double, a long long or length-prefixed JSON
+record_header = struct.Struct('>qc')
+value_f = struct.Struct('>d')
+value_i = struct.Struct('>q')
+value_len = struct.Struct('>I')
+
+# Index entry: end offset, min timestamp, max timestamp, record count
+index_entry = struct.Struct('>qqqq')
+
+def pack_record(timestamp, value):
+	kind = chunkdb.value_kind(value)
+	header = record_header.pack(timestamp, kind)
+	if kind == 'f':
+		return header + value_f.pack(value)
+	if kind == 'i':
+		return header + value_i.pack(value)
+
+	raw = json.dumps(value)
+	return header + value_len.pack(len(raw)) + raw
+
+class channel_log():
+	'''The values of one channel within one file_period.'''
+
+	def __init__(self, path, index_records):
+		self.path = path
+		self.index_records = index_records
+
+		for suffix in [ '.log', '.idx' ]:
+			if not os.path.exists(path + suffix):
+				open(path + suffix, 'wb').close()
+		self.file = open(path + '.log', 'r+b')
+		self.index = open(path + '.idx', 'r+b')
+		self.size = os.fstat(self.file.fileno()).st_size
+		self.map = None
+
+		# [ start, end, min, max, count ] for each indexed run of
+		# records, the last one may still be growing
+		self.segments = []
+		start = 0
+		data = self.index.read()
+		for pos in xrange(0, len(data) - index_entry.size + 1,
+				index_entry.size):
+			entry = index_entry.unpack_from(data, pos)
+			# The log is always written before the index, but
+			# after a power loss either may have been cut short
+			if entry[0] > self.size:
+				break
+			self.segments.append([ start ] + list(entry))
+			start = entry[0]
+		self.index.seek(len(self.segments) * index_entry.size)
+		self.index.truncate()
+		self.indexed = len(self.segments)
+
+		self.recover(start)
+
+	def recover(self, start):
+		'''Index the records after the last index entry and drop
+		a partial record at the end, if any.'''
+
+		pos = start
+		data = self.view(self.size)
+		while pos + record_header.size <= self.size:
+			timestamp, kind = record_header.unpack_from(data, pos)
+			end = pos + record_header.size
+			if kind in 'fi':
+				end += 8
+			elif end + value_len.size <= self.size:
+				end += value_len.size + \
+					value_len.unpack_from(data, end)[0]
+			else:
+				break
+			if end > self.size:
+				break
+
+			self.add_record(pos, end, timestamp)
+			pos = end
+
+		if pos < self.size:
+			self.map = None
+			self.file.truncate(pos)
+			self.size = pos
+		self.write_index()
+
+	def close(self):
+		# A reader still going through the records keeps its
+		# own reference to the map
+		self.map = None
+		self.file.close()
+		self.index.close()
+
+	def view(self, end):
+		'''Return a map of the file covering at least [0, end).'''
+
+		if self.map is None or len(self.map) < end:
+			self.map = None
+			if self.size:
+				self.map = mmap.mmap(self.file.fileno(), 0,
+						access=mmap.ACCESS_READ)
+		return self.map
+
+	def add_record(self, start, end, timestamp):
+		if not self.segments or \
+				self.segments[-1][4] >= self.index_records:
+			self.segments.append([ start, end, timestamp,
+				timestamp, 0 ])
+		seg = self.segments[-1]
+		seg[1] = end
+		seg[2] = min(seg[2], timestamp)
+		seg[3] = max(seg[3], timestamp)
+		seg[4] += 1
+
+	def write_index(self):
+		# Only full segments are written, the last one is found
+		# again by recover() after a restart
+		full = [ seg for seg in self.segments[self.indexed:]
+			if seg[4] >= self.index_records ]
+		if not full:
+			return
+
+		self.index.write(''.join([ index_entry.pack(*seg[1:])
+			for seg in full ]))
+		self.index.flush()
+		self.indexed += len(full)
+
+	def append(self, rows):
+		'''Append ( timestamp, value ) rows.'''
+
+		records = []
+		pos = self.size
+		for timestamp, value in rows:
+			record = pack_record(timestamp, value)
+			records.append(record)
+			self.add_record(pos, pos + len(record), timestamp)
+			pos += len(record)
+
+		self.file.seek(self.size)
+		self.file.write(''.join(records))
+		self.file.flush()
+		self.size = pos
+
+		self.write_index()
+
+	def records(self, data, start, end):
+		'''Yield the ( timestamp, offset, value ) of the records
+		in [start, end) of the map.'''
+
+		pos = start
+		while pos < end:
+			timestamp, kind = record_header.unpack_from(data, pos)
+			offset = pos
+			pos += record_header.size
+			if kind == 'f':
+				value = value_f.unpack_from(data, pos)[0]
+				pos += 8
+			elif kind == 'i':
+				value = value_i.unpack_from(data, pos)[0]
+				pos += 8
+			else:
+				n = value_len.unpack_from(data, pos)[0]
+				pos += value_len.size
+				value = json.loads(data[pos:pos + n])
+				pos += n
+			yield timestamp, offset, value
+
+	def samples(self, t0, t1, reverse=False):
+		'''Yield the ( timestamp, offset, value ) of the records
+		with timestamps in [t0, t1) in timestamp order, in append
+		order for equal timestamps.'''
+
+		# Copies, with the map, stay valid if the log is appended
+		# to or closed in the meantime
+		segs = [ tuple(seg) for seg in self.segments
+			if seg[2] < t1 and seg[3] >= t0 ]
+		if not segs:
+			return
+		data = self.view(max([ seg[1] for seg in segs ]))
+		if reverse:
+			segs.sort(key = lambda seg: -seg[3])
+		else:
+			segs.sort(key = lambda seg: seg[2])
+
+		# Records are normally in order, but values that arrived
+		# late make segments overlap.  Once the segments are
+		# sorted by their time range, the samples beyond the
+		# bound of the next segment can't be preceded by anything
+		# still to be read.
+		pending = []
+		for seg in segs + [ None ]:
+			if seg is None:
+				ready = pending
+				pending = []
+			elif reverse:
+				ready = [ s for s in pending if s[0] > seg[3] ]
+				pending = [ s for s in pending if s[0] <= seg[3] ]
+			else:
+				ready = [ s for s in pending if s[0] < seg[2] ]
+				pending = [ s for s in pending if s[0] >= seg[2] ]
+
+			ready.sort(key = lambda s: s[0:2], reverse=reverse)
+			for sample in ready:
+				yield sample
+
+			if seg is not None:
+				pending += [ record for record in
+					self.records(data, seg[0], seg[1])
+					if t0 <= record[0] < t1 ]
+
+	def count(self):
+		return sum([ seg[4] for seg in self.segments ])
+
+def log_dir(name):
+	return os.path.splitext(name)[0] + '-log'
+
+def revert(name='sensorino.db', convert=False):
+	'''Move a history saved in logs back into the sensorino table
+	for db.connection, see chunkdb.revert().'''
+
+	path = log_dir(name)
+	if not os.path.isdir(path) or not [ f
+			for chan in os.listdir(path)
+			for f in os.listdir(os.path.join(path, chan))
+			if f.endswith('.log') ]:
+		return
+	if not convert:
+		raise Exception('The value history is saved in logs, ' +
+				'set history_convert to convert it back')
+
+	storage = connection(name)
+	storage.revert_rows()
+	storage.close()
+
+class connection(db.sample_connection):
+	# Length of the period covered by one log file in seconds.
+	# Expired values are removed one whole file at a time.
+	file_period = 7 * 24 * 60 * 60
+
+	# Records per sparse index entry
+	index_records = 128
+
+	# Files kept open, the newest ones are the ones appended to
+	max_open_logs = 32
+
+	def __init__(self, name='sensorino.db', shard_months=None,
+			convert=False):
+		if shard_months:
+			raise Exception('History shards are not supported ' +
+					'with log storage')
+
+		# One directory per channel, one file pair per period,
+		# named after the period's start
+		self.log_dir = log_dir(name)
+		if not os.path.isdir(self.log_dir):
+			os.mkdir(self.log_dir)
+		self.log_files = {}
+		for chan in os.listdir(self.log_dir):
+			starts = set([ int(os.path.splitext(f)[0]) for f in
+				os.listdir(os.path.join(self.log_dir, chan))
+				if f.endswith('.log') ])
+			self.log_files[int(chan)] = sorted(starts)
+		self.logs = collections.OrderedDict()
+
+		db.sample_connection.__init__(self, name, convert)
+
+		if self.shards:
+			raise Exception('History shards are not supported ' +
+					'with log storage')
+
+		self.convert_rows()
+
+	def close(self):
+		db.connection.close(self)
+		self.close_logs()
+
+	def close_logs(self):
+		for log in self.logs.values():
+			log.close()
+		self.logs.clear()
+
+	def store_rows(self, rows):
+		self.insert_values(rows)
+
+	def drop_samples(self):
+		# Files can't be part of the transaction, the values
+		# are better twice in the history than lost
+		self.commit_written()
+
+		self.close_logs()
+		self.log_files = {}
+		shutil.rmtree(self.log_dir)
+
+	def file_start(self, timestamp):
+		ms = self.file_period * 1000
+		return timestamp - timestamp % ms
+
+	def get_log(self, chan, start, create=False):
+		key = ( chan, start )
+		if key in self.logs:
+			log = self.logs.pop(key)
+			self.logs[key] = log
+			return log
+
+		starts = self.log_files.setdefault(chan, [])
+		if start not in starts:
+			if not create:
+				return None
+
+			path = os.path.join(self.log_dir, str(chan))
+			if not os.path.isdir(path):
+				os.mkdir(path)
+			starts.append(start)
+			starts.sort()
+
+		if len(self.logs) >= self.max_open_logs:
+			self.logs.popitem(False)[1].close()
+
+		log = channel_log(os.path.join(self.log_dir, str(chan),
+			str(start)), self.index_records)
+		self.logs[key] = log
+		return log
+
+	def insert_values(self, rows):
+		# The rollups, snapshots and sensorino_latest are updated
+		# in the transaction that follows, if it's rolled back the
+		# values stay in the logs, see
+		# db.sample_connection.rollback_written()
+		files = {}
+		for timestamp, chan, value in rows:
+			key = ( chan, self.file_start(timestamp) )
+			files.setdefault(key, []).append(( timestamp, value ))
+
+		for ( chan, start ), rows in files.items():
+			self.get_log(chan, start, True).append(rows)
+
+	def log_samples(self, chan, t0, t1, reverse=False):
+		'''Yield ( timestamp, offset, value ) like
+		channel_log.samples() for all of the channel's files.'''
+
+		starts = [ start for start in self.log_files.get(chan, [])
+			if start < t1 and
+				start + self.file_period * 1000 > t0 ]
+		if reverse:
+			starts.reverse()
+
+		for start in starts:
+			log = self.get_log(chan, start)
+			for sample in log.samples(t0, t1, reverse):
+				yield sample
+
+	def chan_samples(self, cur, chan, t0, t1, reverse=False):
+		for timestamp, offset, value in self.log_samples(chan,
+				t0, t1, reverse):
+			yield timestamp, value
+
+	def read_samples(self, cur, t0, t1):
+		if t0 is None:
+			t0 = -(1 << 62)
+		if t1 is None:
+			t1 = 1 << 62
+
+		def tagged(chan):
+			for timestamp, offset, value in \
+					self.log_samples(chan, t0, t1):
+				yield timestamp, chan, offset, value
+
+		# Equal timestamps of one channel are always in the same
+		# file so the offset keeps them in order
+		for timestamp, chan, offset, value in heapq.merge(
+				*[ tagged(chan) for chan in self.log_files ]):
+			yield timestamp, chan, value
+
+	def first_timestamp(self, cur):
+		starts = [ starts[0] for starts in self.log_files.values()
+			if starts ]
+		return min(starts or [ None ])
+
+	def expire_values(self, timestamp, limit):
+		'''Delete log files with only values older than timestamp,
+		up to about limit values, see
+		db.connection.expire_values().'''
+
+		keep = self.expire_snapshots(int(timestamp * 1000))
+		if keep is None:
+			return 0
+
+		count = 0
+		for chan, starts in self.log_files.items():
+			for start in list(starts):
+				if start + self.file_period * 1000 > keep or \
+						count >= limit:
+					break
+
+				key = ( chan, start )
+				log = self.get_log(chan, start)
+				count += log.count()
+				starts.remove(start)
+				self.logs.pop(key).close()
+
+				path = os.path.join(self.log_dir, str(chan),
+						str(start))
+				for suffix in [ '.log', '.idx' ]:
+					os.remove(path + suffix)
+
+		return count
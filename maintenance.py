@@ -0,0 +1,91 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# The Maintenance Engine -- every now and then, once the server has
+# nothing else to do, seals the history shards that no longer receive
+# writes, refreshes the storage's query planner statistics and checks
+# that the frequent queries still use the indexes they're meant to.  A
+# plan that stops doing so is logged with the plan chosen instead.
+#
+import sensorino
+import timers
+
+import time
+
+class engine():
+	# Delay between the end of one run and the start of the next
+	run_interval = 6 * 60 * 60
+
+	# Delay before the first run, the server is busy starting up
+	start_delay = 10 * 60
+
+	# While the server is busy, check again after this long
+	busy_delay = 5
+
+	def __init__(self, storage):
+		self.storage = storage
+
+		# name -> plan of the queries found not using their
+		# index, so that each problem is only logged once
+		self.bad_plans = {}
+		self.last_report = None
+
+		self.timeout = timers.call_later(self.run, self.start_delay)
+
+	def run(self):
+		self.timeout = None
+
+		if not timers.is_idle():
+			self.timeout = timers.call_later(self.run,
+					self.busy_delay)
+			return
+
+		# One shard per idle moment, sealing runs a VACUUM that
+		# blocks the server meanwhile
+		try:
+			left = self.storage.seal_shards(1)
+		except Exception as e:
+			sensorino.log_err('Sealing a shard failed: ' + str(e))
+			left = 0
+		if left:
+			self.timeout = timers.call_later(self.run,
+					self.busy_delay)
+			return
+
+		start = time.time()
+		try:
+			self.storage.optimize()
+			plans = self.storage.get_query_plans()
+		except Exception as e:
+			sensorino.log_err('Database maintenance failed: ' +
+					str(e))
+			plans = None
+
+		if plans is not None:
+			self.check_plans(plans)
+			self.last_report = {
+				'time': start,
+				'duration': time.time() - start,
+				'plans': dict([ ( name, plan ) for
+					name, index, plan, ok in plans ]),
+			}
+
+		self.timeout = timers.call_later(self.run, self.run_interval)
+
+	def check_plans(self, plans):
+		for name, index, plan, ok in plans:
+			if ok:
+				if name in self.bad_plans:
+					sensorino.log_warn('Query ' + name +
+						' uses ' + index + ' again')
+					del self.bad_plans[name]
+				continue
+
+			if self.bad_plans.get(name) == plan:
+				continue
+			self.bad_plans[name] = plan
+			sensorino.log_warn('Query ' + name + ' no longer ' +
+					'uses ' + index + ': ' + plan)
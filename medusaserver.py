@@ -32,6 +32,8 @@ Subclasses of RequestHandler only have to override the handle_data() method
 
 import asynchat, asyncore, socket, SimpleHTTPServer, select, urllib
 import posixpath, sys, cgi, cStringIO, os, traceback, shutil
+import timers
+from errno import EWOULDBLOCK, EAGAIN
 
 class CI_dict(dict):
     """Dictionary with case-insensitive keys
@@ -60,28 +62,65 @@ class CI_dict(dict):
 
 class socketStream:
 
-    def __init__(self, sock):
-        """Initiate a socket (non-blocking) and a buffer"""
+    # Once more than high_water bytes are waiting to be sent the
+    # stream is congested until they're down to low_water, see
+    # congested()
+    high_water = 256 * 1024
+    low_water = 64 * 1024
+
+    def __init__(self, sock, channel=None):
+        """Initiate a socket (non-blocking) and a buffer, channel is
+        the dispatcher to wake up when the socket can take more"""
         self.sock = sock
+        self.channel = channel
         self.buffer = cStringIO.StringIO()
         self.closed = 1   # compatibility with SocketServer
+        self.held = 0
 
     def write(self, data):
         """Buffer the input, then send as many bytes as possible"""
         self.buffer.write(data)
-        if self.writable():
-            buff = self.buffer.getvalue()
-            # next try/except clause suggested by Robert Brown
-            try:
-                    sent = self.sock.send(buff)
-            except:
+        self.flush()
+
+    def flush(self):
+        """Send as much of the buffer as the socket takes without
+        blocking, the rest is sent from the handler's handle_write()"""
+        if not self.buffer.tell():
+            return
+
+        buff = self.buffer.getvalue()
+        # next try/except clause suggested by Robert Brown
+        try:
+                sent = self.sock.send(buff)
+        except socket.error, why:
+                if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                    # Socket buffer full, try again later
+                    sent = 0
+                else:
                     # Catch socket exceptions and abort
                     # writing the buffer
-                    sent = len(data)
+                    sent = len(buff)
+        except:
+                sent = len(buff)
 
-            # reset the buffer to the data that has not yet be sent
-            self.buffer = cStringIO.StringIO()
-            self.buffer.write(buff[sent:])
+        # reset the buffer to the data that has not yet be sent
+        self.buffer = cStringIO.StringIO()
+        self.buffer.write(buff[sent:])
+        if sent < len(buff) and self.channel is not None:
+            timers.changed(self.channel)
+
+    def pending(self):
+        """Number of bytes written but not sent yet"""
+        return self.buffer.tell()
+
+    def congested(self):
+        """Whether the writer should hold back new data because the
+        peer isn't reading fast enough"""
+        if self.pending() > self.high_water:
+            self.held = 1
+        elif self.pending() <= self.low_water:
+            self.held = 0
+        return self.held
 
     def finish(self):
         """When all data has been received, send what remains
@@ -89,14 +128,21 @@ class socketStream:
         data = self.buffer.getvalue()
         # send data
         while len(data):
-            while not self.writable():
+            while not self.writable(None):
                 pass
             sent = self.sock.send(data)
             data = data[sent:]
+        self.buffer = cStringIO.StringIO()
 
-    def writable(self):
-        """Used as a flag to know if something can be sent to the socket"""
-        return select.select([],[self.sock],[])[1]
+    def writable(self, timeout=0):
+        """Used as a flag to know if something can be sent to the socket,
+        waits up to timeout seconds, None for no limit.  poll() rather
+        than select() which fails for file descriptors above 1024"""
+        p = select.poll()
+        p.register(self.sock, select.POLLOUT)
+        if timeout is not None:
+            timeout *= 1000
+        return p.poll(timeout)
 
 class RequestHandler(asynchat.async_chat,
     SimpleHTTPServer.SimpleHTTPRequestHandler):
@@ -122,6 +168,29 @@ class RequestHandler(asynchat.async_chat,
         # buffer the response and headers to avoid several calls to select()
         self.wfile = cStringIO.StringIO()
         self.close_connection = 1
+        self.finishing = 0
+
+    def pending(self):
+        """Bytes of the response not sent yet"""
+        if isinstance(self.wfile, socketStream):
+            return self.wfile.pending()
+        return 0
+
+    def readable(self):
+        """Don't start on the next request until the response is out"""
+        return not self.finishing and asynchat.async_chat.readable(self)
+
+    def writable(self):
+        """Also wake up when the socket can take more of the response"""
+        return self.pending() or asynchat.async_chat.writable(self)
+
+    def handle_write(self):
+        if self.pending():
+            self.wfile.flush()
+            if self.finishing and not self.pending():
+                self.end_response()
+        else:
+            asynchat.async_chat.handle_write(self)
 
     def collect_incoming_data(self, data):
         """Collect the data arriving on the connection"""
@@ -193,7 +262,7 @@ class RequestHandler(asynchat.async_chat,
         if self.request_version != 'HTTP/0.9':
             self.wfile.write("\r\n")
         self.start_resp = cStringIO.StringIO(self.wfile.getvalue())
-        self.wfile = socketStream(self.connection)
+        self.wfile = socketStream(self.connection, self)
         self.copyfile(self.start_resp, self.wfile)
 
     def handle_error(self):
@@ -206,14 +275,25 @@ class RequestHandler(asynchat.async_chat,
         shutil.copyfileobj(source, outputfile, length = 128*1024)
 
     def finish(self):
-        """Send data, then close"""
-        try:
-            self.wfile.finish()
-        except AttributeError:
+        """Send data, then close.  What the socket doesn't take right
+        away is sent from handle_write() so that a slow client doesn't
+        block the server"""
+        if not isinstance(self.wfile, socketStream):
             # if end_headers() wasn't called, wfile is a StringIO
             # this happens for error 404 in self.send_head() for instance
             self.wfile.seek(0)
-            self.copyfile(self.wfile, socketStream(self.connection))
+            data = self.wfile
+            self.wfile = socketStream(self.connection, self)
+            self.copyfile(data, self.wfile)
+        else:
+            self.wfile.flush()
+        if self.pending():
+            self.finishing = 1
+            timers.changed(self)
+        else:
+            self.end_response()
+
+    def end_response(self):
         if self.close_connection:
             self.close()
         else:
@@ -234,18 +314,23 @@ class Server(asyncore.dispatcher):
         # lower this to 5 if your OS complains
         self.listen(1024)
 
+    # take up to this many waiting connections at once
+    accepts_per_event = 64
+
     def handle_accept(self):
-        try:
-            conn, addr = self.accept()
-        except socket.error:
-            self.log_info('warning: server accept() threw an exception', 'warning')
-            return
-        except TypeError:
-            self.log_info('warning: server accept() threw EWOULDBLOCK', 'warning')
-            return
-        # creates an instance of the handler class to handle the request/response
-        # on the incoming connexion
-        self.handler(conn, addr, self)
+        for i in xrange(self.accepts_per_event):
+            try:
+                conn, addr = self.accept()
+            except socket.error:
+                self.log_info('warning: server accept() threw an exception', 'warning')
+                return
+            except TypeError:
+                if not i:
+                    self.log_info('warning: server accept() threw EWOULDBLOCK', 'warning')
+                return
+            # creates an instance of the handler class to handle the request/response
+            # on the incoming connexion
+            self.handler(conn, addr, self)
 
 if __name__ == "__main__":
     # launch the server on the specified port
@@ -0,0 +1,122 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# The Retention Engine -- periodically deletes data older than the
+# configured age from the history tables, a small batch at a time so
+# that the event loop never stalls, and gives the freed space back to
+# the filesystem.
+#
+import sensorino
+import timers
+
+import time
+
+class engine():
+	# Rows deleted per step, and the delay between steps while there's
+	# work left.  Each step is a short transaction.
+	batch = 500
+	step_delay = 0.2
+
+	# Pages returned to the filesystem per step
+	vacuum_pages = 256
+
+	# Delay between the end of one pass and the start of the next
+	pass_interval = 60 * 60
+
+	def __init__(self, storage, rules):
+		'''rules maps 'values', 'console' and 'rollup-<name>', where
+		name is one of the storage's rollup period names, to the
+		number of days to keep, or None to keep forever.'''
+
+		self.storage = storage
+		self.rules = rules
+
+		self.tasks = []
+		self.report = {}
+		self.last_report = None
+
+		for name in rules:
+			if name in [ 'values', 'console' ]:
+				continue
+			if name.startswith('rollup-') and name[7:] in \
+					dict(storage.rollup_periods):
+				continue
+			raise Exception('Unknown retention rule \'' + name +
+					'\'')
+
+		# Start the first pass soon but not during start-up
+		self.timeout = timers.call_later(self.start_pass, 60)
+
+	def start_pass(self):
+		now = time.time()
+		periods = dict(self.storage.rollup_periods)
+
+		self.tasks = []
+		self.report = { 'bytes': 0 }
+		for name, days in self.rules.items():
+			if days is None:
+				continue
+			before = now - days * 24 * 60 * 60
+
+			if name == 'values':
+				task = ( self.storage.expire_values, before )
+			elif name == 'console':
+				task = ( self.storage.expire_console, before )
+			else:
+				task = ( self.storage.expire_rollups,
+						periods[name[7:]], before )
+
+			self.tasks.append(( name, task ))
+			self.report[name] = 0
+
+		self.step()
+
+	def step(self):
+		self.timeout = None
+
+		try:
+			done = self.run_task()
+		except Exception as e:
+			sensorino.log_err('Retention pass failed: ' + str(e))
+			self.tasks = []
+			done = True
+
+		if not done:
+			self.timeout = timers.call_later(self.step,
+					self.step_delay)
+			return
+
+		self.last_report = self.report
+		if any(self.report.values()):
+			sensorino.log_warn('Retention pass deleted ' +
+				', '.join([ str(count) + ' ' + name + ' rows'
+					for name, count in
+					sorted(self.report.items())
+					if name != 'bytes' ]) +
+				', freed ' + str(self.report['bytes']) +
+				' bytes')
+
+		self.timeout = timers.call_later(self.start_pass,
+				self.pass_interval)
+
+	def run_task(self):
+		'''Do one batch of work, return True if the pass is done.'''
+
+		if not self.tasks:
+			freed, left = self.storage.reclaim_space(
+					self.vacuum_pages)
+			self.report['bytes'] += freed
+			return not left
+
+		name, task = self.tasks[0]
+		count = task[0](*(task[1:] + ( self.batch, )))
+		self.storage.commit()
+
+		self.report[name] += count
+		if count < self.batch:
+			self.tasks.pop(0)
+
+		return False
@@ -443,6 +443,11 @@ class sensorino_state():
 		except:
 			pass
 
+		# Write the values of a Set to the history
+		if r:
+			self.storage.confirm_saved_values(r)
+			self.storage.commit()
+
 		# Notify
 		if prev_callback is not None:
 			prev_callback(prev_msg, 'no-error', None)
@@ -476,12 +481,9 @@ class sensorino_state():
 				for handler in self.change_handlers:
 					handler(change_set, error=True)
 
-			# Mark all of the database records related to
-			# the failing message as unsuccessful.
-			for ref in ref_list:
-				self.storage.mark_saved_value_failure(ref)
-			if ref_list:
-				self.storage.commit()
+			# The values were never written to the history,
+			# just forget them.
+			self.storage.discard_saved_values(ref_list)
 
 		if prev_callback is not None:
 			prev_callback(prev_msg, 'error', msg)
@@ -693,7 +695,9 @@ class sensorino_state():
 	def update_state(self, timestamp, msg, addr, base_id, is_set, pending):
 		'''Process an incoming or outgoing message such as Publish
 		or Set and see what state changes it implies.  Update our
-		local copy of the state and the database.'''
+		local copy of the state and the database.  The values of
+		a Set are only saved provisionally until the node confirms
+		the change, see queued_success().'''
 
 		changes = []
 		change_refs = []
@@ -704,7 +708,7 @@ class sensorino_state():
 			self.state[addr] = { '_addr': addr }
 
 			ref = self.storage.save_value(timestamp,
-					( addr, '_addr' ), addr)
+					( addr, '_addr' ), addr, is_set)
 			change_refs.append(ref)
 
 			changes.append(( addr, ))
@@ -715,7 +719,7 @@ class sensorino_state():
 			node_state['_base'] = base_id
 
 			ref = self.storage.save_value(timestamp,
-					( addr, '_base' ), base_id)
+					( addr, '_base' ), base_id, is_set)
 			change_refs.append(ref)
 
 			changes.append(( addr, '_base' ))
@@ -765,7 +769,7 @@ class sensorino_state():
 
 				path = ( addr, main_service_id, datatype, num )
 				ref = self.storage.save_value(timestamp,
-						path, val)
+						path, val, is_set)
 				change_refs.append(ref)
 
 				changes.append(path)
@@ -789,7 +793,7 @@ class sensorino_state():
 			for subpath, value in desc_changes:
 				ref = self.storage.save_value(timestamp,
 						( addr, main_service_id ) +
-						subpath, value)
+						subpath, value, is_set)
 				change_refs.append(ref)
 
 		fields = []
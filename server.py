@@ -17,9 +17,14 @@
 import sensorino
 import config
 import base_server
+import ingest
 import api_server
 import discovery
+import retention
+import maintenance
 import db
+import chunkdb
+import logdb
 import timers
 
 import json
@@ -98,7 +103,7 @@ class console_log():
 	def get_lines_at_timestamp(self, timestamp):
 		return self.storage.get_console_at_timestamp(timestamp)
 
-def base_message_handler(raw_msg, base):
+def base_message_handler(obj, base):
 	global state, console
 
 	timestamp = time.time()
@@ -109,29 +114,22 @@ def base_message_handler(raw_msg, base):
 	# our state keeping object as an invalid message, and to the
 	# console log object.
 
-	try:
-		msg = sensorino.message_dict(json.loads(raw_msg))
-
-		# Basic validation
-		if 'type' not in msg and 'error' not in msg:
-			raise Exception('No type')
-		type = msg.get('type', 'err')
+	# With config.base_workers the message comes decoded and
+	# validated as far as possible without the state
+	if not isinstance(obj, ingest.parsed_message):
+		obj = ingest.parse_message(obj)
+	raw_msg = obj.raw_msg
+	msg = obj.msg
+	valid = obj.valid
 
-		if type not in [ 'publish', 'request', 'set', 'err' ]:
-			raise Exception('Unknown type')
-
-		if type == 'publish':
-			sensorino.validate_incoming_publish(msg)
-			state.validate_incoming_publish(msg)
-		elif type == 'request':
-			sensorino.validate_incoming_request(msg)
-		elif type == 'set':
-			sensorino.validate_incoming_set(msg)
-			state.validate_incoming_set(msg)
-		else:
-			sensorino.validate_incoming_error(msg)
+	try:
+		if valid:
+			type = msg.get('type', 'err')
 
-		valid = True
+			if type == 'publish':
+				state.validate_incoming_publish(msg)
+			elif type == 'set':
+				state.validate_incoming_set(msg)
 	except Exception as e:
 		sensorino.log_warn(str(e.args))
 
@@ -151,9 +149,8 @@ def base_message_handler(raw_msg, base):
 				state.handle_set(timestamp, msg, base_id)
 			else:
 				state.handle_error(timestamp, msg, base_id)
-		else:
+		elif msg is not None:
 			# If it parses, submit it to the state handler anyway
-			msg = sensorino.message_dict(json.loads(raw_msg))
 			state.handle_invalid_incoming(timestamp, msg, base_id)
 	except Exception as e:
 		if valid:
@@ -196,6 +193,12 @@ def httpd_request_handler(raw_req, conn):
 
 	base = request_find_base(msg)
 
+	# Don't let a Base that isn't reading what we send make us queue
+	# requests without limit, the user can retry later
+	if base.congested():
+		raise Exception(503, 'Base busy, ' + str(base.pending()) +
+				' bytes waiting to be sent')
+
 	# Send first because a socket error may happen here and we
 	# can't be held responsible
 	try:
@@ -276,15 +279,31 @@ def discovery_request_handler(req):
 
 	console.handle_line(False, valid, req_str, timestamp)
 
-# Create and introduce all the helpers to each other
-db = db.connection()
+# Create and introduce all the helpers to each other.  The workers are
+# forked first so that they don't inherit the database.
+pool = None
+if config.base_workers:
+	pool = ingest.pool(config.base_workers)
+
+if config.history_storage == 'chunks':
+	db = chunkdb.connection(convert=config.history_convert)
+elif config.history_storage == 'log':
+	db = logdb.connection(convert=config.history_convert)
+else:
+	chunkdb.revert(convert=config.history_convert)
+	logdb.revert(convert=config.history_convert)
+	db = db.connection(shard_months=config.history_shard_months)
 state = sensorino.sensorino_state(db)
 console = console_log(db)
 discovery_agent = discovery.agent(state)
+retention_engine = retention.engine(db, config.retention)
+maintenance_engine = maintenance.engine(db)
 
 httpd = api_server.sensorino_httpd_server(config.httpd_address,
 		state, console, db)
 base_server = base_server.sensorino_base_server(config.base_server_address)
+base_server.pool = pool
+httpd.bases = base_server.bases
 
 state.load()
 console.load()
@@ -304,4 +323,6 @@ try:
 	timers.loop()
 except KeyboardInterrupt:
 	pass
+# Commit whatever is still queued in the write-behind buffers
+db.flush()
 db.close()
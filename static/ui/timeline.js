@@ -25,8 +25,25 @@ function timeline(obj, handler) {
 	this.hover_marker.classList.add('timeline-marker');
 	this.hover_marker.classList.add('timeline-hover-marker');
 
+	/* Activity density bar, one column per density_columns-th of the width */
+	this.density_div = document.createElement('div');
+	this.density_div.classList.add('timeline-density');
+	this.density_cols = [];
+	for (var i = 0; i < this.density_columns; i++) {
+		var col = document.createElement('div');
+		col.classList.add('timeline-density-col');
+		col.style.left = (i * 100 / this.density_columns) + '%';
+		col.style.width = (100 / this.density_columns) + '%';
+		this.density_div.appendChild(col);
+		this.density_cols.push(col);
+	}
+	this.activity = [];
+	this.activity_seq = 0;
+	this.activity_cache = {};
+
 	this.obj.appendChild(this.value_div);
 	this.obj.appendChild(this.line_div);
+	this.line_div.appendChild(this.density_div);
 	this.line_div.appendChild(this.axis_div);
 	this.line_div.appendChild(this.timestamp_marker);
 	this.line_div.appendChild(this.current_marker);
@@ -113,6 +130,159 @@ timeline.prototype.update = function() {
 		this.add_label(month_timestamp - i * 30 * 24 * 60 * 60, 3); /* FIXME */
 	}
 	this.add_label(this.upper_limit, 0);
+
+	this.update_activity();
+}
+
+timeline.prototype.density_columns = 100;
+
+/*
+ * The axis is logarithmic around the selected timestamp so the event
+ * counts are loaded for a few ranges of growing length around it,
+ * and every column of the density bar uses the finest one that covers
+ * it.  The ranges are aligned to a grid, three spans long in steps of
+ * half a span, and the counts are cached so that scrubbing only loads
+ * a range when the timestamp moves out of it.  The whole axis is only
+ * reloaded after activity_refresh.
+ */
+timeline.prototype.activity_spans = [ 60 * 60, 24 * 60 * 60,
+	30 * 24 * 60 * 60, 0 /* Whole axis */ ];
+
+/* Seconds after which the counts of a range reaching up to the
+ * present are loaded again */
+timeline.prototype.activity_refresh = 5 * 60;
+
+timeline.prototype.activity_cache_size = 32;
+
+timeline.prototype.update_activity = function() {
+	var this_obj = this;
+	var seq = ++this.activity_seq;
+	var now = Date.now() * 0.001;
+	var keys = [];
+	var pending = 0;
+
+	function show() {
+		var activity = [];
+		for (var i = 0; i < keys.length; i++)
+			if (keys[i] in this_obj.activity_cache)
+				activity.push(this_obj.activity_cache[keys[i]]);
+
+		activity.sort(function(a, b) { return (a.t1 - a.t0) - (b.t1 - b.t0); });
+		this_obj.activity = activity;
+		this_obj.draw_activity();
+	}
+
+	function load_end() {
+		if (--pending || seq !== this_obj.activity_seq)
+			return;
+
+		show();
+	}
+
+	function load_done(key, level, ret) {
+		/* The range was requested with ago= values, the server
+		 * tells us where exactly that put it on its clock */
+		level.t0 = ret.at0;
+		level.t1 = ret.at1;
+		level.counts = ret.counts;
+		this_obj.activity_cache[key] = level;
+		load_end();
+	}
+
+	function load_error(err) {
+		console.log(err);
+		/* Show the other ranges, this one is retried next time */
+		load_end();
+	}
+
+	for (var i = 0; i < this.activity_spans.length; i++) {
+		var span = this.activity_spans[i];
+		var t0, end, buckets, key;
+
+		if (span) {
+			/* Same bucket length as two spans in density_columns */
+			var step = span / 2;
+			t0 = Math.floor((this.timestamp - span) / step) * step;
+			end = t0 + 3 * span;
+			buckets = this.density_columns * 3 / 2;
+			key = span + ':' + t0;
+		} else {
+			t0 = this.lower_limit;
+			end = Infinity;
+			buckets = this.density_columns;
+			key = 'all:' + t0;
+		}
+		keys.push(key);
+
+		/* Ranges entirely in the past when loaded don't change */
+		var level = this.activity_cache[key];
+		if (level && (level.end <= level.loaded ||
+					now - level.loaded < this.activity_refresh))
+			continue;
+
+		var t1 = Math.min(end, now);
+		if (t1 <= t0)
+			continue;
+
+		level = { t0: t0, t1: t1, end: end, counts: null, loaded: now };
+		pending++;
+		oboe('/api/activity.json?ago0=' + (now - t0) + '&ago1=' + (now - t1) +
+				'&buckets=' + buckets).
+			fail(load_error).
+			done(load_done.bind(null, key, level));
+	}
+
+	/* Beyond the limit forget the ranges loaded longest ago */
+	var cached = Object.keys(this.activity_cache);
+	if (cached.length > this.activity_cache_size) {
+		cached = cached.filter(function(key) { return keys.indexOf(key) < 0; });
+		cached.sort(function(a, b) {
+			return this_obj.activity_cache[a].loaded - this_obj.activity_cache[b].loaded;
+		});
+		cached = cached.slice(0, cached.length - this.activity_cache_size / 2);
+		for (var i = 0; i < cached.length; i++)
+			delete this.activity_cache[cached[i]];
+	}
+
+	if (!pending)
+		show();
+	else
+		/* Redraw with what's known until the new counts arrive */
+		this.draw_activity();
+}
+
+timeline.prototype.draw_activity = function() {
+	var cols = [];
+	var max = 0;
+
+	for (var i = 0; i < this.density_columns; i++) {
+		var ts0 = this.pos_to_timestamp(i * 100 / this.density_columns);
+		var ts1 = this.pos_to_timestamp((i + 1) * 100 / this.density_columns);
+		var count = 0;
+
+		for (var j = 0; ts0 !== null && ts1 !== null && j < this.activity.length; j++) {
+			var level = this.activity[j];
+			if (ts0 < level.t0 || ts1 > level.t1)
+				continue;
+
+			/* Buckets partially within the column count proportionally */
+			var width = (level.t1 - level.t0) / level.counts.length;
+			for (var k = Math.floor((ts0 - level.t0) / width);
+					k < level.counts.length && level.t0 + k * width < ts1; k++) {
+				var b0 = Math.max(ts0, level.t0 + k * width);
+				var b1 = Math.min(ts1, level.t0 + (k + 1) * width);
+				count += level.counts[k] * (b1 - b0) / width;
+			}
+			break;
+		}
+
+		cols.push(count);
+		max = Math.max(max, count);
+	}
+
+	for (var i = 0; i < this.density_columns; i++)
+		this.density_cols[i].style.opacity =
+			max ? Math.log(1 + cols[i]) / Math.log(1 + max) : 0;
 }
 
 timeline.prototype.add_label = function(ts, precision) {
@@ -0,0 +1,126 @@
+#! /usr/bin/python
+#
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Compare the history storage engines (see history_storage in config.py)
+# on the machine and the filesystem that the server is going to use.
+# Run it with a directory on the target medium as argument, e.g. the
+# router's flash, otherwise a temporary directory is used.  For each
+# engine a few sensors are simulated reporting every few seconds with
+# the writes committed the way the server does it, then the history
+# is read back through the API queries.
+#
+# "disk writes" are the bytes the kernel reports having sent to the
+# storage for this process (/proc/self/io), which includes the
+# journal and the index updates -- on flash that's what wears the
+# medium and what the writes are waiting for.
+
+import sys
+import os
+import time
+import random
+import shutil
+import tempfile
+
+import db
+import chunkdb
+import logdb
+
+engines = [
+	( 'rows', db.connection ),
+	( 'chunks', chunkdb.connection ),
+	( 'log', logdb.connection ),
+]
+
+channels = 8
+values = 100000
+interval = 5.0
+# Values saved per commit, like a burst of messages
+burst = 4
+
+def disk_writes():
+	try:
+		for line in open('/proc/self/io'):
+			if line.startswith('write_bytes:'):
+				return int(line.split()[1])
+	except IOError:
+		pass
+	return None
+
+def disk_usage(path):
+	total = 0
+	for root, dirs, files in os.walk(path):
+		for name in files:
+			total += os.path.getsize(os.path.join(root, name))
+	return total
+
+def run(name, engine, path):
+	random.seed(1)
+	start = 1420070400.0
+	paths = [ ( 10, 2, 'temperature', i ) for i in range(channels) ]
+	state = [ 20.0 ] * channels
+
+	written = disk_writes()
+	t = time.time()
+	storage = engine(os.path.join(path, 'sensorino.db'))
+	timestamp = start
+	for i in xrange(values):
+		timestamp += interval / channels
+		chan = i % channels
+		state[chan] = round(state[chan] +
+				random.choice([ -0.1, 0, 0, 0, 0.1 ]), 1)
+		storage.save_value(timestamp, paths[chan], state[chan])
+		if i % burst == burst - 1:
+			storage.commit()
+			# Stand in for the event loop's flush timer
+			storage.flush()
+	storage.flush()
+	write_time = time.time() - t
+	if written is not None:
+		written = disk_writes() - written
+
+	t = time.time()
+	count = 0
+	for chan in range(channels):
+		cursor = None
+		while True:
+			page, cursor = storage.get_values_page(paths[chan],
+					start, timestamp + 1, 1024, cursor)
+			count += len(page)
+			if cursor is None:
+				break
+	scan_time = time.time() - t
+
+	t = time.time()
+	for i in range(200):
+		at = start + random.random() * (timestamp - start)
+		storage.get_values_within_period(paths[i % channels],
+				at, at + 3600)
+		storage.get_tree_at_timestamp(at)
+	query_time = time.time() - t
+
+	storage.close()
+
+	print('%-8s write %6.2fs  scan %6.2fs  200 queries %6.2fs  ' \
+		'size %6.2fMB  disk writes %s' % ( name, write_time,
+			scan_time, query_time, disk_usage(path) / 1e6,
+			'%.2fMB' % (written / 1e6) if written is not None
+			else 'n/a' ))
+	if count != values:
+		print('  read back ' + str(count) + ' values, expected ' +
+				str(values))
+
+base = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp()
+print(str(values) + ' values, ' + str(channels) + ' channels, in ' + base)
+for name, engine in engines:
+	path = os.path.join(base, 'bench-' + name)
+	shutil.rmtree(path, True)
+	os.mkdir(path)
+	try:
+		run(name, engine, path)
+	finally:
+		shutil.rmtree(path, True)
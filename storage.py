@@ -0,0 +1,204 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# The interface between the server and its persistent storage.  The
+# sensorino state, the console log, the API server and the retention
+# and maintenance engines only use the methods below.  db.connection is
+# the SQLite implementation, chunkdb and logdb store the value history
+# differently.
+#
+# Timestamps are in seconds since the epoch, as floats, paths are
+# sensorino state paths as in sensorino.py, ( node_addr, svc_id,
+# datatype, chan_id ) or a prefix of that.
+#
+
+class storage():
+	# Maximum number of rows returned by the *_within_period queries
+	max_values = 1024
+
+	# Maximum number of paths per get_series_within_period() call
+	max_series = 100
+
+	# ( name, seconds ) pairs, the resolutions of the aggregates
+	# kept for numeric channels
+	rollup_periods = []
+
+	def close(self):
+		raise NotImplementedError()
+
+	# Writes
+
+	def save_value(self, timestamp, path, value, provisional=False):
+		'''Queue a new value of a channel.  Returns a reference to
+		the value.  Provisional values, such as those of a Set
+		request that the node hasn't confirmed yet, are invisible
+		until passed to confirm_saved_values().'''
+		raise NotImplementedError()
+
+	def confirm_saved_values(self, changes):
+		'''Add provisional values to the history, as if saved
+		now but with their original timestamps.'''
+		raise NotImplementedError()
+
+	def discard_saved_values(self, changes):
+		'''Forget provisional values, e.g. of a failed Set.'''
+		raise NotImplementedError()
+
+	def save_console_line(self, timestamp, line):
+		raise NotImplementedError()
+
+	def save_floorplan_version(self, timestamp, data):
+		raise NotImplementedError()
+
+	def commit(self):
+		'''Mark the end of a logical group of changes.  The storage
+		may delay the actual write.'''
+		raise NotImplementedError()
+
+	def flush(self):
+		'''Write everything queued so far now.'''
+		raise NotImplementedError()
+
+	# Sensorino state
+
+	def get_value_current(self, path):
+		raise NotImplementedError()
+
+	def get_value_at_timestamp(self, path, timestamp):
+		'''The last value of the channel at or before timestamp,
+		or the current value if timestamp is None.'''
+		raise NotImplementedError()
+
+	def get_tree_current(self):
+		raise NotImplementedError()
+
+	def get_tree_at_timestamp(self, timestamp):
+		'''The whole state tree as of timestamp, see
+		get_value_at_timestamp().'''
+		raise NotImplementedError()
+
+	def get_values_within_period(self, path, t0, t1):
+		'''Return the newest max_values ( timestamp, value ) tuples
+		from [t0, t1) in ascending order.'''
+		raise NotImplementedError()
+
+	def get_values_page(self, path, t0, t1, limit, cursor=None):
+		'''Return up to limit ( timestamp, value ) tuples from
+		[t0, t1) in ascending order, starting after the cursor
+		if given, and the cursor for the next page or None if
+		there are no more values.  The cursor is a tuple of two
+		ints whose meaning depends on the implementation.'''
+		raise NotImplementedError()
+
+	def get_rollups_within_period(self, path, t0, t1, period):
+		'''Return the newest max_values ( timestamp, avg, min, max,
+		count ) tuples for the period-long buckets overlapping
+		[t0, t1), in ascending order.'''
+		raise NotImplementedError()
+
+	def get_rollups_page(self, path, t0, t1, period, limit, cursor=None):
+		'''Like get_values_page() for the rollups of given period.'''
+		raise NotImplementedError()
+
+	def get_series_within_period(self, paths, t0, t1, period=None):
+		'''For each path return a ( value at t0, values within
+		[t0, t1) ) pair, the values being rollups of given period if
+		period is not None, or None if there's nothing to return.
+		Same as get_value_at_timestamp() followed by
+		get_values_within_period() or get_rollups_within_period()
+		for each path.'''
+		raise NotImplementedError()
+
+	def get_event_counts(self, paths, t0, t1, buckets):
+		'''Split [t0, t1) into buckets periods of equal length and
+		return the number of values saved within each, for the
+		channels at or under any of the paths, which may be path
+		prefixes, or for all channels if paths is None.'''
+		raise NotImplementedError()
+
+	def estimate_value_count(self, path, t0, t1):
+		'''Quick upper bound on the number of numeric values saved
+		for the path within [t0, t1).'''
+		raise NotImplementedError()
+
+	def export_values(self, paths, t0=None, t1=None):
+		'''Yield ( timestamp, path, value ) for the values of the
+		channels given, or of all channels if paths is None, with
+		timestamps in [t0, t1) in ascending order.  None stands for
+		no bound.  Must work in constant memory and let other calls
+		be made while the export is in progress.'''
+		raise NotImplementedError()
+
+	def import_values(self, rows, drop_indexes=True):
+		'''Add ( timestamp, path, value ) rows, as yielded by
+		export_values(), to the history in bulk and bring everything
+		derived from the history up to date.  Returns the number
+		of rows imported.'''
+		raise NotImplementedError()
+
+	# Console and floorplan
+
+	def get_console_current(self):
+		raise NotImplementedError()
+
+	def get_console_at_timestamp(self, timestamp):
+		'''The last 64 ( timestamp, line ) pairs at or before
+		timestamp, in ascending order.'''
+		raise NotImplementedError()
+
+	def search_console(self, text, t0, t1, limit, cursor=None):
+		'''Return up to limit ( timestamp, line ) pairs from
+		[t0, t1) where the line contains text, ignoring case, newest
+		first, and the cursor for the next page or None.  None
+		stands for no bound.'''
+		raise NotImplementedError()
+
+	def get_floorplan_current(self):
+		raise NotImplementedError()
+
+	def get_floorplan_at_timestamp(self, timestamp):
+		'''The JSON text of the last floorplan version at or before
+		timestamp, or None.'''
+		raise NotImplementedError()
+
+	# Retention, see retention.py
+
+	def expire_values(self, timestamp, limit):
+		'''Delete up to about limit values older than timestamp.
+		Returns the number deleted, less than limit once done.'''
+		raise NotImplementedError()
+
+	def expire_console(self, timestamp, limit):
+		raise NotImplementedError()
+
+	def expire_rollups(self, period, timestamp, limit):
+		raise NotImplementedError()
+
+	def reclaim_space(self, pages):
+		'''Give some of the freed space back to the filesystem.
+		Returns the number of bytes freed and an estimate of how
+		much work is left, 0 when done.'''
+		raise NotImplementedError()
+
+	# Maintenance, see maintenance.py
+
+	def optimize(self):
+		'''Refresh whatever statistics the storage keeps for
+		planning its queries.  Called when the server is idle.'''
+		raise NotImplementedError()
+
+	def seal_shards(self, limit=None):
+		'''Compact and make read-only up to limit of the history
+		files that no longer receive writes, all by default, if the
+		storage has such files.  Slow, one VACUUM each.  Returns the
+		number left to seal.'''
+		raise NotImplementedError()
+
+	def get_query_plans(self):
+		'''Return ( name, index, plan, ok ) for the storage's most
+		frequent queries, ok being False if the query doesn't use
+		the index it's meant to.'''
+		raise NotImplementedError()
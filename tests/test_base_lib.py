@@ -0,0 +1,66 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# The Base side of the framing handshake, see base_lib.base_run().
+#
+
+import os
+import sys
+import json
+import socket
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import base_lib
+import base_server
+
+class base_run_test(unittest.TestCase):
+	def setUp(self):
+		self.server, base_lib.s = socket.socketpair()
+		base_lib.framing = None
+		base_lib.framing_asked = True
+		base_lib.parse_state = base_server.obj_parser()
+		base_lib.parse_state.one_obj = True
+
+		self.msgs = []
+		self.handle_input = base_lib.base_handle_input
+		base_lib.base_handle_input = self.msgs.append
+
+	def tearDown(self):
+		base_lib.base_handle_input = self.handle_input
+		base_lib.s.close()
+		self.server.close()
+
+	def run_chunk(self, data):
+		self.server.sendall(data)
+		base_lib.base_run(1)
+
+	def check_reply_and_frame(self, fmt):
+		msg = { 'type': 'request', 'to': 2, 'serviceId': 1 }
+		# The reply and a framed request in one recv()
+		self.run_chunk(json.dumps({ 'framing': fmt }) +
+				base_server.pack_frame(fmt, [ msg ]))
+
+		self.assertEqual(base_lib.framing, fmt)
+		self.assertEqual(self.msgs, [ msg ])
+
+	def test_json_frame(self):
+		self.check_reply_and_frame('json')
+
+	def test_msgpack_frame(self):
+		self.check_reply_and_frame('msgpack')
+
+	def test_no_framing(self):
+		msg = '{"type": "request", "to": 2}'
+		self.run_chunk(json.dumps({ 'framing': None }) + msg)
+
+		self.assertEqual(base_lib.framing, None)
+		self.assertEqual(self.msgs, [ msg ])
+
+if __name__ == '__main__':
+	unittest.main()
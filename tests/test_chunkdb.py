@@ -0,0 +1,67 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# The block encoding of chunkdb.connection.
+#
+
+import os
+import sys
+import math
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import chunkdb
+
+start = 1420848000000
+
+class block_test(unittest.TestCase):
+	def round_trip(self, timestamps, values):
+		kind = chunkdb.value_kind(values[0])
+		data = chunkdb.encode_block(kind, timestamps, values)
+		return chunkdb.decode_block(timestamps[0], kind,
+				len(timestamps), buffer(data))
+
+	def test_timestamps(self):
+		# Regular, repeated, late and far apart
+		timestamps = [ start + ms for ms in
+			[ 0, 1000, 2000, 3000, 3000, 2500, 3500, 3600000,
+				3600001, -5 ] ]
+		result = self.round_trip(timestamps, [ 1.0 ] * 10)
+		self.assertEqual(result[0], timestamps)
+
+	def test_floats(self):
+		values = [ 0.0, 0.0, -0.0, 1.5, -1.5, 1e300, -1e-300,
+			float('inf'), float('-inf'), 0.1, 0.1, 0.0 ]
+		timestamps = range(start, start + len(values))
+		result = self.round_trip(timestamps, values)[1]
+
+		self.assertEqual(result, values)
+		self.assertEqual([ math.copysign(1, v) for v in result ],
+				[ math.copysign(1, v) for v in values ])
+
+		result = self.round_trip([ start, start + 1, start + 2 ],
+				[ float('nan'), 1.0, float('nan') ])[1]
+		self.assertTrue(math.isnan(result[0]))
+		self.assertEqual(result[1], 1.0)
+		self.assertTrue(math.isnan(result[2]))
+
+	def test_ints(self):
+		values = [ 0, 0, 1, -1, -(1 << 61), (1 << 61), 7, 0 ]
+		timestamps = range(start, start + len(values))
+		self.assertEqual(self.round_trip(timestamps, values)[1],
+				values)
+
+	def test_json(self):
+		values = [ True, None, False, { 'a': [ 1, 2.5 ], 'b': None },
+			'text', u'ł', 1 << 70, [] ]
+		timestamps = range(start, start + len(values))
+		self.assertEqual(self.round_trip(timestamps, values)[1],
+				values)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,88 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Console log search, see db.connection.search_console().
+#
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import db
+
+start = 1420848000
+
+class console_test(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.db = db.connection(os.path.join(self.dir, 's.db'))
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.dir)
+
+	def test_vacuum(self):
+		for i in range(100):
+			self.db.save_console_line(start + i,
+					'line %i node %i' % ( i, i % 7 ))
+		self.db.flush()
+
+		# Leave a gap at the start, then let VACUUM move the rows
+		self.db.expire_console(start + 50, 1000)
+		self.db.flush()
+		self.db.conn.execute('VACUUM')
+
+		for text in [ 'node 3', 'NODE 3', 'e 3' ]:
+			lines, cursor = self.db.search_console(text, None,
+					None, 100)
+			self.assertEqual([ line for timestamp, line in lines ],
+				[ 'line %i node 3' % i
+					for i in range(99, 49, -1)
+					if i % 7 == 3 ])
+
+	def test_migrate(self):
+		for i in range(10):
+			self.db.save_console_line(start + i, 'line %i' % i)
+		self.db.flush()
+		self.db.close()
+
+		# Back to the version 12 table, without the id
+		name = os.path.join(self.dir, 's.db')
+		conn = sqlite3.connect(name)
+		conn.execute('DROP TABLE console_fts')
+		conn.execute('DROP INDEX console_time')
+		conn.execute('CREATE TABLE old AS SELECT timestamp, line ' +
+				'FROM console')
+		conn.execute('DROP TABLE console')
+		conn.execute('ALTER TABLE old RENAME TO console')
+		conn.execute('CREATE INDEX console_time ON console ' +
+				'(timestamp DESC)')
+		conn.execute('CREATE VIRTUAL TABLE console_fts USING ' +
+				'fts5(line, content=\'console\', ' +
+				'tokenize=\'trigram\', detail=none)')
+		conn.execute('INSERT INTO console_fts (console_fts) ' +
+				'VALUES (\'rebuild\')')
+		conn.execute('PRAGMA user_version = 12')
+		conn.commit()
+		conn.close()
+
+		self.db = db.connection(name)
+		self.db.save_console_line(start + 10, 'line 10')
+		self.db.flush()
+		lines, cursor = self.db.search_console('line 1', None,
+				None, 100)
+		self.assertEqual([ line for timestamp, line in lines ],
+				[ 'line 10', 'line 1' ])
+		self.assertEqual(len(self.db.get_console_current()), 11)
+
+if __name__ == '__main__':
+	unittest.main()
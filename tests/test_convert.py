@@ -0,0 +1,93 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Conversion of the value history between db.connection and the
+# sample storage engines, see config.history_convert.
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import db
+import chunkdb
+import logdb
+
+a = [ 1, 1, 'float', 0 ]
+b = [ 1, 1, 'int', 0 ]
+start = 1420848000
+
+class convert_test(unittest.TestCase):
+	engine = chunkdb
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.name = os.path.join(self.dir, 's.db')
+
+		rows = db.connection(self.name)
+		for i in range(100):
+			rows.save_value(start + i * 60, a, i * 0.5)
+			rows.save_value(start + i * 90, b, i)
+		rows.flush()
+		rows.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def values(self, storage):
+		return ( storage.get_values_within_period(a, start,
+				start + 10000),
+			storage.get_values_within_period(b, start,
+				start + 10000) )
+
+	def test_round_trip(self):
+		rows = db.connection(self.name)
+		expected = self.values(rows)
+		rows.close()
+		self.assertEqual(map(len, expected), [ 100, 100 ])
+
+		# Nothing is converted unless asked for
+		self.assertRaises(Exception, self.engine.connection,
+				self.name)
+		rows = db.connection(self.name)
+		self.assertEqual(self.values(rows), expected)
+		rows.close()
+
+		storage = self.engine.connection(self.name, convert=True)
+		self.assertEqual(self.values(storage), expected)
+		storage.save_value(start + 10000, a, 100.0)
+		storage.flush()
+		storage.close()
+
+		self.assertRaises(Exception, self.engine.revert, self.name)
+		self.engine.revert(self.name, True)
+		self.engine.revert(self.name)
+
+		rows = db.connection(self.name)
+		self.assertEqual(self.values(rows), expected)
+		self.assertEqual(rows.get_value_current(a), 100.0)
+		rows.close()
+
+	def test_new_database(self):
+		# What server.py does before opening a new database
+		name = os.path.join(self.dir, 'new.db')
+		self.engine.revert(name)
+		rows = db.connection(name)
+		rows.save_value(start, a, 1.0)
+		rows.flush()
+		self.assertEqual(rows.get_value_current(a), 1.0)
+		rows.close()
+
+class log_convert_test(convert_test):
+	engine = logdb
+
+if __name__ == '__main__':
+	unittest.main()
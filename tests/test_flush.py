@@ -0,0 +1,107 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Group commit of the queued rows, see db.connection.flush().
+#
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import db
+import chunkdb
+import logdb
+
+path = [ 1, 1, 'float', 0 ]
+start = 1420848000
+
+class failing_conn():
+	'''Wraps a connection whose next commit fails.'''
+
+	def __init__(self, conn):
+		self.conn = conn
+
+	def commit(self):
+		self.commit = self.conn.commit
+		raise sqlite3.OperationalError('disk I/O error')
+
+	def __getattr__(self, name):
+		return getattr(self.conn, name)
+
+class flush_test(unittest.TestCase):
+	engine = db.connection
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.db = self.engine(os.path.join(self.dir, 's.db'))
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.dir)
+
+	def test_failed_commit(self):
+		for i in range(10):
+			self.db.save_value(start + i, path, float(i))
+		self.db.save_console_line(start, 'line')
+		self.db.save_floorplan_version(start, '{"a": 1}')
+
+		self.db.conn = failing_conn(self.db.conn)
+		self.assertRaises(sqlite3.OperationalError, self.db.flush)
+		self.assertEqual(self.db.pending_count(), 12)
+
+		self.db.save_value(start + 10, path, 10.0)
+		self.db.flush()
+		self.assertEqual(self.db.pending_count(), 0)
+
+		values = self.db.get_values_within_period(path, start,
+				start + 60)
+		self.assertEqual([ value for timestamp, value in values ],
+				[ float(i) for i in range(11) ])
+		self.assertEqual(self.db.get_value_current(path), 10.0)
+		self.assertEqual(len(self.db.get_console_current()), 1)
+		self.assertEqual(self.db.get_floorplan_current(), '{"a":1}')
+
+	def test_read_own_writes(self):
+		self.db.save_value(start, path, 1.0)
+		self.db.save_floorplan_version(start, '{"a": 1}')
+		self.db.commit()
+
+		self.assertEqual(self.db.get_value_at_timestamp(path,
+			start + 1), 1.0)
+		self.assertEqual(self.db.get_values_within_period(path,
+			start, start + 1), [ ( start, 1.0 ) ])
+		self.assertEqual(self.db.get_floorplan_at_timestamp(start),
+				'{"a":1}')
+		self.assertEqual(self.db.pending_count(), 0)
+
+	def test_discard_floorplan(self):
+		self.db.save_floorplan_version(start, '{"a": 1}')
+		self.db.flush()
+
+		self.db.save_value(start, path, 1.0)
+		self.db.save_floorplan_version(start + 1, '{"a": 2}')
+		self.db.conn = failing_conn(self.db.conn)
+		self.assertRaises(sqlite3.OperationalError, self.db.flush)
+		self.db.discard_floorplan_version(start + 1, '{"a": 2}')
+		self.db.flush()
+
+		self.assertEqual(self.db.get_floorplan_current(), '{"a":1}')
+		self.assertEqual(self.db.get_value_current(path), 1.0)
+
+class chunk_flush_test(flush_test):
+	engine = chunkdb.connection
+
+class log_flush_test(flush_test):
+	engine = logdb.connection
+
+if __name__ == '__main__':
+	unittest.main()
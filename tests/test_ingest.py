@@ -0,0 +1,109 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# The worker side of ingest.py, fed directly without a process, and a
+# pool losing a worker.
+#
+
+import os
+import sys
+import json
+import time
+import asyncore
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import ingest
+import base_server
+
+class worker_test(unittest.TestCase):
+	def feed(self, worker, chunks):
+		records = []
+		for chunk in chunks:
+			worker.parse(1, chunk, records)
+		return records
+
+	def test_handshake_split(self):
+		hs = json.dumps({ 'base-name': 'b', 'framing': [ 'json' ] })
+		msg = { 'type': 'publish', 'from': 2, 'serviceId': 1,
+			'float': 20.5 }
+		frame = base_server.pack_frame('json', [ msg ])
+
+		for split in range(1, len(hs)):
+			# Frames only come once the Base has the reply
+			records = self.feed(ingest.worker(None),
+					[ hs[:split], hs[split:], frame ])
+
+			self.assertEqual([ record[1] for record in records ],
+					[ 'handshake', 'msg' ])
+			self.assertEqual(records[0][2], hs)
+			self.assertEqual(json.loads(records[1][2]), msg)
+			self.assertTrue(records[1][4])
+
+	def test_handshake_in_one_chunk(self):
+		hs = json.dumps({ 'base-name': 'b' })
+		records = self.feed(ingest.worker(None),
+				[ hs + '{"type": "err", "error": "x"}' ])
+
+		self.assertEqual([ record[1] for record in records ],
+				[ 'handshake', 'msg' ])
+
+class fake_base():
+	client_address = ( 'test', 0 )
+	connected = True
+
+	def __init__(self, pool):
+		self.pool = pool
+		self.handshakes = []
+		self.closed = False
+
+	def handshake(self, raw_msg):
+		self.handshakes.append(raw_msg)
+
+	def done(self):
+		self.pool.detach(self)
+
+	def close(self):
+		self.closed = True
+
+class pool_test(unittest.TestCase):
+	def setUp(self):
+		self.pool = ingest.pool(1)
+
+	def tearDown(self):
+		for channel in self.pool.channels:
+			channel.close()
+		for proc in self.pool.processes:
+			proc.join()
+
+	def run_until(self, cond):
+		deadline = time.time() + 10
+		while not cond() and time.time() < deadline:
+			asyncore.loop(0.05, count=1)
+		self.assertTrue(cond())
+
+	def test_respawn(self):
+		base = fake_base(self.pool)
+		self.pool.feed(base, '{"base-name"')
+
+		proc = self.pool.processes[0]
+		proc.terminate()
+		proc.join()
+		self.run_until(lambda: base.closed)
+		self.assertEqual(self.pool.conns, {})
+		self.assertTrue(self.pool.processes[0].is_alive())
+
+		# The new worker takes the next Base
+		base = fake_base(self.pool)
+		self.pool.feed(base, '{"base-name": "b"}')
+		self.run_until(lambda: base.handshakes)
+		self.assertEqual(base.handshakes, [ '{"base-name": "b"}' ])
+		self.assertFalse(base.closed)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,81 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# The per-channel files of logdb.connection.
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import logdb
+
+start = 1420848000
+week = 7 * 24 * 60 * 60
+
+def path(i):
+	return [ 1, 1, 'float', i ]
+
+class log_test(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.db = logdb.connection(os.path.join(self.dir, 's.db'))
+		self.db.max_open_logs = 2
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.dir)
+
+	def test_evicted(self):
+		# Three files for each of three channels
+		for i in range(3):
+			for j in range(30):
+				self.db.save_value(start + j * week / 10,
+						path(i), float(j))
+		self.db.flush()
+		self.assertEqual(len(self.db.logs), 2)
+
+		first = self.db.logs.values()[0]
+		self.db.get_values_within_period(path(2), start,
+				start + 3 * week)
+		self.assertFalse(first in self.db.logs.values())
+		self.assertTrue(first.file.closed)
+		self.assertTrue(first.index.closed)
+		self.assertEqual(first.map, None)
+
+		# Logs evicted in the middle of the reads
+		expected = [ ( start + j * week / 10, float(j) )
+			for j in range(30) ]
+		self.assertEqual(self.db.get_series_within_period(
+			[ path(i) for i in range(3) ], start,
+			start + 3 * week)[0][1], expected)
+		values = self.db.export_values(None)
+		self.assertEqual(len(list(values)), 90)
+		self.assertEqual(len(self.db.logs), 2)
+
+	def test_expired(self):
+		self.db.max_open_logs = 8
+		self.db.snapshot_interval = 0
+		for j in range(30):
+			self.db.save_value(start + j * week / 10, path(0),
+					float(j))
+			self.db.flush()
+		logs = self.db.logs.values()
+		self.assertEqual(len(logs), 4)
+
+		self.assertTrue(self.db.expire_values(start + 2 * week,
+			1000) > 0)
+		self.assertEqual(len(self.db.logs), 2)
+		self.assertEqual([ log.file.closed for log in logs ],
+				[ True, True, False, False ])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,86 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Values of Set requests waiting for the node's answer, see
+# db.connection.save_value().
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import db
+import chunkdb
+import logdb
+
+path = [ 1, 1, 'float', 0 ]
+start = 1420848000
+
+class provisional_test(unittest.TestCase):
+	engine = db.connection
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.name = os.path.join(self.dir, 's.db')
+		self.open()
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.dir)
+
+	def open(self):
+		self.db = self.engine(self.name)
+		# Let chunkdb save its open blocks with every flush
+		self.db.save_interval = 0
+
+	def values(self):
+		return [ value for timestamp, value in
+			self.db.get_values_within_period(path, start,
+				start + 60) ]
+
+	def test_same_time(self):
+		# Two Sets of a channel within the same millisecond
+		ref_a = self.db.save_value(start, path, 1.0, True)
+		ref_b = self.db.save_value(start, path, 2.0, True)
+		self.db.discard_saved_values([ ref_a ])
+		self.db.confirm_saved_values([ ref_b ])
+		self.db.flush()
+
+		self.assertEqual(self.values(), [ 2.0 ])
+
+	def test_crash(self):
+		self.db.save_value(start, path, 1.0)
+		ref_a = self.db.save_value(start + 1, path, 2.0, True)
+		self.db.save_value(start + 2, path, 3.0, True)
+		ref_c = self.db.save_value(start + 3, path, 4.0, True)
+		self.db.discard_saved_values([ ref_a ])
+		self.db.confirm_saved_values([ ref_c ])
+		self.db.flush()
+
+		# Killed while one is still unconfirmed
+		self.db.rconn.close()
+		self.db.conn.close()
+		self.open()
+		self.db.flush()
+
+		self.assertEqual(self.values(), [ 1.0, 3.0, 4.0 ])
+		self.assertEqual(self.db.provisional, {})
+		self.db.cur.execute('SELECT COUNT(*) FROM provisional')
+		self.assertEqual(self.db.cur.fetchone()[0], 0)
+
+class chunk_provisional_test(provisional_test):
+	engine = chunkdb.connection
+
+class log_provisional_test(provisional_test):
+	engine = logdb.connection
+
+if __name__ == '__main__':
+	unittest.main()
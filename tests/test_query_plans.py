@@ -0,0 +1,48 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# The indexes used by the frequent queries, see
+# db.connection.planned_queries().
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import db
+import chunkdb
+import logdb
+
+class query_plan_test(unittest.TestCase):
+	engine = db.connection
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.db = self.engine(os.path.join(self.dir, 's.db'))
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.dir)
+
+	def test_indexes(self):
+		plans = self.db.get_query_plans()
+		self.assertTrue(len(plans) >= 10)
+		self.assertEqual([ ( name, plan ) for name, index, plan, ok
+				in plans if not ok ], [])
+
+class chunk_query_plan_test(query_plan_test):
+	engine = chunkdb.connection
+
+class log_query_plan_test(query_plan_test):
+	engine = logdb.connection
+
+if __name__ == '__main__':
+	unittest.main()
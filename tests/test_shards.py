@@ -0,0 +1,151 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Value history spanning several shards, see db.connection.
+#
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import calendar
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import db
+
+path = [ 1, 1, 'float', 0 ]
+start = calendar.timegm(( 2015, 1, 10, 0, 0, 0 ))
+day = 24 * 60 * 60
+
+class shards_test(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.db = db.connection(os.path.join(self.dir, 's.db'),
+				shard_months=1)
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.dir)
+
+	def count(self):
+		return len(self.db.get_values_within_period(path, start,
+			start + 365 * day))
+
+	def test_flush_across_months(self):
+		# One batch creating five shards, the older ones must
+		# still take their rows
+		for i in range(120):
+			self.db.save_value(start + i * day, path, float(i))
+		self.db.flush()
+
+		self.assertEqual(len(self.db.shards), 5)
+		self.assertEqual(self.count(), 120)
+		self.assertFalse([ shard for shard in self.db.shards
+			if shard[3] ])
+
+		self.assertEqual(self.db.seal_shards(1), 2)
+		self.assertEqual(self.db.seal_shards(), 0)
+		self.assertEqual([ shard[3] for shard in self.db.shards ],
+				[ True, True, True, False, False ])
+		self.assertEqual(self.count(), 120)
+
+	def test_flush_many_months(self):
+		# More shards than can be attached at once
+		count = self.db.max_attached * 2 + 4
+		for i in range(count):
+			self.db.save_value(start + i * 31 * day, path, float(i))
+		self.db.flush()
+
+		self.assertEqual(len(self.db.shards), count)
+		self.assertEqual(len(self.db.get_values_within_period(path,
+			start, start + 3 * 365 * day)), count)
+		self.assertEqual(self.db.get_value_current(path),
+				float(count - 1))
+
+	def test_failed_flush(self):
+		for i in range(120):
+			self.db.save_value(start + i * day, path, float(i))
+		self.db.flush()
+
+		# A batch over the existing shards is one transaction
+		for i in range(120):
+			self.db.save_value(start + i * day + 1, path, float(i))
+		def fail():
+			raise sqlite3.OperationalError('disk I/O error')
+		self.db.commit_written = fail
+		self.assertRaises(sqlite3.OperationalError, self.db.flush)
+		del self.db.commit_written
+		self.db.flush()
+
+		self.assertEqual(self.count(), 240)
+
+	def test_sealed_period(self):
+		for i in range(120):
+			self.db.save_value(start + i * day, path, float(i))
+		self.db.flush()
+		self.db.seal_shards()
+
+		# Late values for a sealed month are dropped, not fatal
+		ref = self.db.save_value(start + day, path, -1.0, True)
+		self.db.save_value(start + 119 * day + 1, path, 1.0)
+		self.db.confirm_saved_values([ ref ])
+		self.db.flush()
+		self.assertEqual(self.count(), 121)
+
+	def test_import_months(self):
+		rows = [ ( start + i * day / 4, path, float(i) )
+			for i in range(150 * 4) ]
+		self.assertEqual(self.db.import_values(iter(rows)), 600)
+
+		self.assertEqual(len(self.db.shards), 6)
+		self.assertEqual([ shard[3] for shard in self.db.shards ],
+				[ True ] * 4 + [ False ] * 2)
+		self.assertEqual(self.count(), 600)
+		self.assertEqual(self.db.get_value_at_timestamp(path,
+			start + 150 * day), 599.0)
+
+	def test_import_many_months(self):
+		# More shards than can be attached at once, the indexes
+		# are dropped and rebuilt in all of them
+		self.db.save_value(start, path, -1.0)
+		self.db.save_value(start + 40 * day, path, -1.0)
+		self.db.flush()
+
+		def indexes(shard):
+			table = self.db.history_table(self.db.conn, shard)
+			schema = table.split('.')[0]
+			self.db.cur.execute('SELECT name FROM ' + schema +
+					'.sqlite_master WHERE type = \'index\'')
+			return sorted(self.db.cur.fetchall())
+
+		found = []
+		import_batch_rows = self.db.import_batch_rows
+		def check_batch(rows):
+			import_batch_rows(rows)
+			found.extend([ indexes(shard)
+				for shard in self.db.shards ])
+		self.db.import_batch_rows = check_batch
+		self.db.import_batch = 100
+
+		rows = [ ( start + i * day / 4 + 1, path, float(i) )
+			for i in range(330 * 4) ]
+		self.assertEqual(self.db.import_values(iter(rows)), 1320)
+		self.assertEqual(found, [ [] ] * len(found))
+
+		self.assertEqual(len(self.db.shards), 12)
+		self.assertEqual(self.db.get_values_page(path, start,
+			start + 365 * day, 2000)[0][-1][1], 1319.0)
+		for shard in self.db.shards:
+			self.assertEqual(indexes(shard),
+					[ ( 'sensorino_chan_time', ),
+						( 'sensorino_time', ) ])
+
+if __name__ == '__main__':
+	unittest.main()
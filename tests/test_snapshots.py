@@ -0,0 +1,106 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Historical trees rebuilt from the snapshots, see db.connection.
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import db
+import chunkdb
+import logdb
+
+a = [ 1, 1, 'float', 0 ]
+b = [ 1, 1, 'float', 1 ]
+start = 1420848000
+
+class snapshot_test(unittest.TestCase):
+	engine = db.connection
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.db = self.engine(os.path.join(self.dir, 's.db'))
+		# A snapshot with every flush
+		self.db.snapshot_interval = 0
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.dir)
+
+	def tree_values(self, timestamp):
+		tree = self.db.get_tree_at_timestamp(timestamp)
+		return tree[1][1]['float']
+
+	def test_late_confirmation(self):
+		self.db.save_value(start, a, 1.0)
+		self.db.save_value(start, b, 1.0)
+		self.db.flush()
+
+		ref_a = self.db.save_value(start + 1, a, 2.0, True)
+		ref_b = self.db.save_value(start + 1, b, 2.0, True)
+		self.db.save_value(start + 5, b, 3.0)
+		self.db.save_value(start + 10, a, 4.0)
+		self.db.flush()
+		self.db.save_value(start + 20, a, 5.0)
+		self.db.flush()
+
+		# Confirmed after the snapshots at start + 10 and + 20
+		self.db.confirm_saved_values([ ref_a, ref_b ])
+		self.db.flush()
+
+		self.assertEqual(self.tree_values(start + 2), [ 2.0, 2.0 ])
+		self.assertEqual(self.tree_values(start + 10), [ 4.0, 3.0 ])
+		self.assertEqual(self.tree_values(start + 30), [ 5.0, 3.0 ])
+
+	def test_late_values(self):
+		self.db.save_value(start, a, 1.0)
+		self.db.save_value(start, b, 1.0)
+		self.db.flush()
+		self.db.save_value(start + 10, a, 2.0)
+		self.db.flush()
+
+		# Same timestamp as the last snapshot, then older
+		self.db.save_value(start + 10, b, 2.0)
+		self.db.flush()
+		self.db.save_value(start + 5, b, 3.0)
+		self.db.save_value(start + 20, a, 3.0)
+		self.db.flush()
+
+		self.assertEqual(self.tree_values(start + 10), [ 2.0, 2.0 ])
+		self.assertEqual(self.tree_values(start + 30), [ 3.0, 2.0 ])
+
+	def test_expired(self):
+		self.db.save_value(start, a, 1.0)
+		self.db.save_value(start, b, 1.0)
+		self.db.flush()
+		self.db.save_value(start + 8 * 86400, b, 2.0)
+		self.db.flush()
+
+		self.db.expire_values(start + 9 * 86400, 1000)
+		self.db.flush()
+		self.assertEqual(self.db.get_value_at_timestamp(a,
+			start + 10 * 86400), 1.0)
+		self.assertEqual(self.db.get_series_within_period([ a, b ],
+			start + 10 * 86400, start + 11 * 86400),
+			[ ( 1.0, [] ), ( 2.0, [] ) ])
+		self.assertEqual(self.tree_values(start + 10 * 86400),
+				[ 1.0, 2.0 ])
+
+class chunk_snapshot_test(snapshot_test):
+	engine = chunkdb.connection
+
+class log_snapshot_test(snapshot_test):
+	engine = logdb.connection
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,74 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# The epoll registrations kept by timers.poll().
+#
+
+import os
+import sys
+import socket
+import asyncore
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import timers
+
+class reader(asyncore.dispatcher):
+	def __init__(self, sock):
+		asyncore.dispatcher.__init__(self, sock)
+		self.want = True
+		self.data = ''
+
+	def readable(self):
+		return self.want
+
+	def writable(self):
+		return False
+
+	def handle_read(self):
+		self.data += self.recv(8192)
+
+@unittest.skipIf(timers.epoll is None, 'epoll not available')
+class registrations_test(unittest.TestCase):
+	def setUp(self):
+		sock, self.peer = socket.socketpair()
+		self.reader = reader(sock)
+
+	def tearDown(self):
+		self.reader.close()
+		self.peer.close()
+
+	def test_changed(self):
+		self.peer.sendall('a')
+		timers.poll(0)
+		self.assertEqual(self.reader.data, 'a')
+
+		# Not looked at again until it says so
+		self.reader.want = False
+		self.peer.sendall('b')
+		timers.poll(0)
+		self.assertFalse(self.reader.fileno() in timers.registered)
+
+		self.reader.want = True
+		timers.poll(0)
+		self.assertEqual(self.reader.data, 'a')
+		timers.changed(self.reader)
+		timers.poll(0)
+		self.assertEqual(self.reader.data, 'ab')
+
+	def test_closed(self):
+		timers.poll(0)
+		fd = self.reader.fileno()
+		self.assertTrue(fd in timers.registered)
+
+		self.reader.close()
+		self.assertFalse(fd in timers.registered)
+		timers.poll(0)
+
+if __name__ == '__main__':
+	unittest.main()
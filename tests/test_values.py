@@ -0,0 +1,62 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Values of the different types in the sensorino table, see
+# db.sqlite_to_value().
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+	__file__))))
+
+import db
+
+path = [ 1, 1, 'message', 0 ]
+start = 1420848000
+
+class values_test(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.db = db.connection(os.path.join(self.dir, 's.db'))
+
+	def tearDown(self):
+		self.db.close()
+		shutil.rmtree(self.dir)
+
+	def values(self):
+		return [ value for timestamp, value in
+			self.db.get_values_within_period(path, start,
+				start + 60) ]
+
+	def test_types(self):
+		values = [ { 'a': [ 1, 2.5 ], 'b': None }, {}, True, False,
+			None, 'text', u'ł', 7, -1.5 ]
+		for i, value in enumerate(values):
+			self.db.save_value(start + i, path, value)
+		self.db.flush()
+
+		self.assertEqual(self.values(), values)
+
+	def test_damaged(self):
+		for i in range(3):
+			self.db.save_value(start + i, path, { 'n': i })
+		self.db.flush()
+
+		self.db.cur.execute('UPDATE sensorino SET value = ? ' +
+				'WHERE timestamp = ?',
+				( buffer('\x82\xa1'), ( start + 1 ) * 1000 ))
+		self.db.conn.commit()
+
+		self.assertEqual(self.values(), [ { 'n': 0 }, None,
+			{ 'n': 2 } ])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -6,14 +6,138 @@
 #
 # Basic and quite generic timeout support for asyncore.
 #
+# Where available the asyncore channels are waited on with epoll rather
+# than with the select() that asyncore.loop() uses, which can't handle
+# file descriptors above 1024 and makes the kernel scan every
+# descriptor on each call.  The channels stay registered between the
+# calls and only the channels that may want different events are
+# looked at again: those added to asyncore.socket_map, those that have
+# just handled an event and those passed to changed() by whatever
+# changes their readable() or writable() from elsewhere, like data
+# queued for sending by another channel's handler.  Everything else
+# about asyncore dispatchers stays the same.
+#
 import sched
 import asyncore
+import select
+import errno
 import time
 
 timefunc = time.time
 
+if hasattr(select, 'epoll'):
+	epoll = select.epoll()
+else:
+	epoll = None
+
+# fd -> ( channel, event mask ) as last registered with epoll
+registered = {}
+
+# Channels whose readable() or writable() may have changed since they
+# were registered
+dirty = set()
+
+def changed(obj):
+	'''Note that obj.readable() or obj.writable() may return something
+	else now, for changes not made by obj's own event handlers.'''
+	if epoll is not None:
+		dirty.add(obj)
+
+class channel_map(dict):
+	'''asyncore.socket_map, noting the channels added and removed.'''
+
+	def __setitem__(self, fd, obj):
+		dict.__setitem__(self, fd, obj)
+		changed(obj)
+
+	def __delitem__(self, fd):
+		dict.__delitem__(self, fd)
+		if fd in registered:
+			unregister(fd)
+
+if epoll is not None:
+	asyncore.socket_map = channel_map(asyncore.socket_map)
+	for obj in asyncore.socket_map.values():
+		changed(obj)
+
+def update_registrations():
+	global dirty
+	socket_map = asyncore.socket_map
+	objs = dirty
+	dirty = set()
+
+	for obj in objs:
+		fd = obj._fileno
+		if socket_map.get(fd) is not obj:
+			# Closed since
+			continue
+
+		flags = 0
+		if obj.readable():
+			flags |= select.EPOLLIN | select.EPOLLPRI
+		# accepting sockets should not be writable
+		if obj.writable() and not obj.accepting:
+			flags |= select.EPOLLOUT
+
+		entry = registered.get(fd)
+
+		# epoll reports hangups and errors whatever the mask, a
+		# channel that wants no events mustn't stay registered or
+		# every poll would return right away.  Those events wait
+		# until the channel is readable or writable again, as
+		# with asyncore.poll2().
+		if not flags:
+			if entry is not None:
+				unregister(fd)
+			continue
+
+		if entry is not None and entry[0] is obj:
+			if entry[1] != flags:
+				epoll.modify(fd, flags)
+				registered[fd] = ( obj, flags )
+			continue
+
+		# New channel, or the fd closed and reused by another one
+		if entry is not None:
+			unregister(fd)
+		epoll.register(fd, flags)
+		registered[fd] = ( obj, flags )
+
+def unregister(fd):
+	del registered[fd]
+	try:
+		epoll.unregister(fd)
+	except ( IOError, ValueError ):
+		# Closed fds are removed automatically
+		pass
+
+def poll(timeout=30.0):
+	'''Wait for up to timeout seconds for the asyncore channels to
+	become ready and handle their events.'''
+
+	if epoll is None:
+		asyncore.loop(timeout=timeout, count=1)
+		return
+
+	update_registrations()
+	try:
+		events = epoll.poll(timeout)
+	except IOError as e:
+		if e.errno != errno.EINTR:
+			raise
+		return
+
+	socket_map = asyncore.socket_map
+	for fd, flags in events:
+		entry = registered.get(fd)
+		obj = socket_map.get(fd)
+		if obj is None or entry is None or entry[0] is not obj:
+			continue
+		asyncore.readwrite(obj, flags)
+		changed(obj)
+
 def delayfunc(timeout):
-	asyncore.loop(timeout=timeout, count=1)
+	poll(timeout)
 
 scheduler = sched.scheduler(timefunc, delayfunc)
 
@@ -21,7 +145,7 @@ def loop():
 	global scheduler
 	while True:
 		if scheduler.empty():
-			asyncore.loop(count=1)
+			poll()
 		else:
 			scheduler.run()
 
@@ -29,3 +153,29 @@ def call_later(fun, delay, args=None):
 	global scheduler
 	return scheduler.enter(delay, 0, fun, [] if args is None else args)
 cancel = scheduler.cancel
+
+def is_idle(margin=1.0):
+	'''True if no timeout is due within margin seconds and none of
+	the asyncore channels has input waiting, i.e. the loop would
+	otherwise just sleep.'''
+	global scheduler
+	queue = scheduler.queue
+	if queue and queue[0].time < timefunc() + margin:
+		return False
+
+	if epoll is not None:
+		# With the events registered by the last poll()
+		for fd, flags in epoll.poll(0):
+			entry = registered.get(fd)
+			if flags & ~select.EPOLLOUT and entry is not None and \
+					entry[1] & select.EPOLLIN:
+				return False
+		return True
+
+	fds = [ fd for fd, obj in asyncore.socket_map.items()
+		if obj.readable() ]
+	try:
+		r, w, e = select.select(fds, [], [], 0)
+	except select.error:
+		return False
+	return not r
@@ -0,0 +1,199 @@
+# Sensorino smarthome server
+#
+# Author: Andrew Zaborowski <andrew.zaborowski@intel.com>
+#
+# This software is provided under the 3-clause BSD license.
+#
+# Compact binary encoding for structured channel values, such as those
+# of 'message' channels.  The format is the subset of MessagePack
+# (msgpack.org) needed for JSON-like values: nil, booleans, integers
+# up to 64 bits, doubles, UTF-8 strings, arrays and maps, so the
+# values can also be read with any MessagePack library.  The first
+# byte always tells the type.
+#
+import struct
+
+s_B = struct.Struct('>B')
+s_H = struct.Struct('>H')
+s_I = struct.Struct('>I')
+s_Q = struct.Struct('>Q')
+s_b = struct.Struct('>b')
+s_h = struct.Struct('>h')
+s_i = struct.Struct('>i')
+s_q = struct.Struct('>q')
+s_f = struct.Struct('>f')
+s_d = struct.Struct('>d')
+
+# Integer forms: type byte, format, range.  The first that fits is used.
+int_formats = [
+	( '\xcc', s_B, 0, 0xff ),
+	( '\xcd', s_H, 0, 0xffff ),
+	( '\xce', s_I, 0, 0xffffffff ),
+	( '\xcf', s_Q, 0, (1 << 64) - 1 ),
+	( '\xd0', s_b, -0x80, 0x7f ),
+	( '\xd1', s_h, -0x8000, 0x7fff ),
+	( '\xd2', s_i, -(1 << 31), (1 << 31) - 1 ),
+	( '\xd3', s_q, -(1 << 63), (1 << 63) - 1 ),
+]
+
+def pack(obj):
+	'''Return the encoding of obj as a str.  Raises ValueError for
+	values that have no JSON equivalent.'''
+
+	out = []
+	pack_into(out, obj)
+	return ''.join(out)
+
+def pack_len(out, n, fix, fix_max, op16, op32):
+	if n <= fix_max:
+		out.append(chr(fix | n))
+	elif n < 0x10000:
+		out.append(op16 + s_H.pack(n))
+	else:
+		out.append(op32 + s_I.pack(n))
+
+def pack_into(out, obj):
+	if obj is None:
+		out.append('\xc0')
+	elif obj is True:
+		out.append('\xc3')
+	elif obj is False:
+		out.append('\xc2')
+	elif isinstance(obj, ( int, long )):
+		if 0 <= obj < 0x80:
+			out.append(chr(obj))
+		elif -0x20 <= obj < 0:
+			out.append(chr(obj & 0xff))
+		else:
+			for op, fmt, lo, hi in int_formats:
+				if lo <= obj <= hi:
+					out.append(op + fmt.pack(obj))
+					break
+			else:
+				raise ValueError('Integer out of range: ' +
+						str(obj))
+	elif isinstance(obj, float):
+		out.append('\xcb' + s_d.pack(obj))
+	elif isinstance(obj, basestring):
+		if isinstance(obj, unicode):
+			obj = obj.encode('utf-8')
+		n = len(obj)
+		if n < 0x20:
+			out.append(chr(0xa0 | n))
+		elif n < 0x100:
+			out.append('\xd9' + chr(n))
+		elif n < 0x10000:
+			out.append('\xda' + s_H.pack(n))
+		else:
+			out.append('\xdb' + s_I.pack(n))
+		out.append(obj)
+	elif isinstance(obj, ( list, tuple )):
+		pack_len(out, len(obj), 0x90, 15, '\xdc', '\xdd')
+		for elem in obj:
+			pack_into(out, elem)
+	elif isinstance(obj, dict):
+		pack_len(out, len(obj), 0x80, 15, '\xde', '\xdf')
+		for key, elem in obj.items():
+			pack_into(out, key)
+			pack_into(out, elem)
+	else:
+		raise ValueError('Can\'t encode ' + repr(obj))
+
+def unpack(data):
+	'''Decode a value encoded by pack() or by any MessagePack
+	encoder using only the types listed above.  Raises ValueError if
+	the data is not a single valid value.'''
+
+	data = str(data)
+	try:
+		obj, pos = unpack_from(data, 0)
+	except ( IndexError, struct.error ):
+		raise ValueError('Truncated value')
+	except TypeError:
+		raise ValueError('Unhashable map key')
+	if pos != len(data):
+		raise ValueError('Trailing data after value')
+	return obj
+
+def unpack_list(data):
+	'''Decode a sequence of values packed one after another.'''
+
+	data = str(data)
+	objs = []
+	pos = 0
+	try:
+		while pos < len(data):
+			obj, pos = unpack_from(data, pos)
+			objs.append(obj)
+	except ( IndexError, struct.error ):
+		raise ValueError('Truncated value')
+	except TypeError:
+		raise ValueError('Unhashable map key')
+	return objs
+
+def unpack_from(data, pos):
+	'''Return the value at pos and the position after it.'''
+
+	op = ord(data[pos])
+	pos += 1
+
+	# The fixed-size forms first, most values fit in these
+	if op < 0x80:
+		return op, pos
+	if op >= 0xe0:
+		return op - 0x100, pos
+	if 0xa0 <= op < 0xc0:
+		return str_at(data, pos, op & 0x1f)
+	if 0x90 <= op < 0xa0:
+		return list_at(data, pos, op & 0x0f)
+	if op < 0x90:
+		return dict_at(data, pos, op & 0x0f)
+
+	if op == 0xc0:
+		return None, pos
+	if op == 0xc2:
+		return False, pos
+	if op == 0xc3:
+		return True, pos
+	if op == 0xcb:
+		return s_d.unpack_from(data, pos)[0], pos + 8
+	if op == 0xca:
+		return s_f.unpack_from(data, pos)[0], pos + 4
+
+	if op in ints:
+		fmt = ints[op]
+		return fmt.unpack_from(data, pos)[0], pos + fmt.size
+
+	if op in lengths:
+		fmt, read = lengths[op]
+		n = fmt.unpack_from(data, pos)[0]
+		return read(data, pos + fmt.size, n)
+
+	raise ValueError('Unsupported type 0x%02x' % op)
+
+def str_at(data, pos, n):
+	if pos + n > len(data):
+		raise ValueError('Truncated value')
+	return data[pos:pos + n].decode('utf-8'), pos + n
+
+def list_at(data, pos, n):
+	obj = []
+	for i in xrange(n):
+		elem, pos = unpack_from(data, pos)
+		obj.append(elem)
+	return obj, pos
+
+def dict_at(data, pos, n):
+	obj = {}
+	for i in xrange(n):
+		key, pos = unpack_from(data, pos)
+		obj[key], pos = unpack_from(data, pos)
+	return obj, pos
+
+ints = dict([ ( ord(op), fmt ) for op, fmt, lo, hi in int_formats ])
+
+lengths = {
+	0xd9: ( s_B, str_at ), 0xda: ( s_H, str_at ), 0xdb: ( s_I, str_at ),
+	0xdc: ( s_H, list_at ), 0xdd: ( s_I, list_at ),
+	0xde: ( s_H, dict_at ), 0xdf: ( s_I, dict_at ),
+}